@@ -0,0 +1,161 @@
+# admission.py - Limitation de débit par clé API et file équitable pondérée devant le rendu
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from metrics import increment, observe, register_gauge
+
+# Seau à jetons par clé : débit moyen (requêtes/s) et rafale autorisée
+RATE_LIMIT_PER_SECOND = float(os.environ.get('RATE_LIMIT_PER_SECOND', '5'))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', '20'))
+# Rendus simultanés : par processus et par clé
+RENDER_SLOTS = int(os.environ.get('RENDER_SLOTS', '4'))
+MAX_CONCURRENT_RENDERS_PER_KEY = int(os.environ.get('MAX_CONCURRENT_RENDERS_PER_KEY', '2'))
+# File d'attente : longueur maximale et attente maximale avant un 429
+MAX_QUEUED_RENDERS = int(os.environ.get('MAX_QUEUED_RENDERS', '32'))
+QUEUE_TIMEOUT_S = float(os.environ.get('QUEUE_TIMEOUT_S', '10'))
+
+# Coût relatif d'un rendu par format (le DOCX est plus lent que le PDF)
+COUT_FORMAT = {
+    'pdf': 1.0,
+    'docx': 1.5,
+}
+# Nombre d'articles représentant une unité de coût
+ARTICLES_PAR_UNITE = 50
+
+class Overloaded(Exception):
+    """Requête refusée (429) : limite de débit, file pleine ou attente trop longue"""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+def render_cost(item_count, output_format='pdf'):
+    """Coût estimé d'un rendu d'après le nombre d'articles et le format"""
+    return (1 + item_count / ARTICLES_PAR_UNITE) * COUT_FORMAT.get(output_format, 1.0)
+
+class TokenBucket:
+    """Seaux à jetons par clé API"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, tokens=1):
+        """Prendre des jetons ; retourne 0 si la requête passe, sinon le délai d'attente (s)"""
+        now = time.monotonic()
+        with self._lock:
+            available, updated = self._buckets.get(key, (self.burst, now))
+            available = min(self.burst, available + (now - updated) * self.rate)
+            if available < tokens:
+                self._buckets[key] = (available, now)
+                return (tokens - available) / self.rate
+            self._buckets[key] = (available - tokens, now)
+            return 0
+
+class FairScheduler:
+    """File d'attente équitable pondérée (étiquettes de fin virtuelles) devant les rendus
+
+    Une clé qui envoie beaucoup de gros documents voit ses étiquettes avancer plus vite
+    que celles des autres clés : elle ne peut pas monopoliser les rendus.
+    """
+    def __init__(self, slots, per_key, max_waiting, timeout):
+        self.slots = slots
+        self.per_key = per_key
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._running_by_key = defaultdict(int)
+        self._virtual_time = 0.0
+        self._last_finish = {}
+        # Durée moyenne d'un rendu (lissée), pour estimer Retry-After
+        self._average_s = 1.0
+
+    def _eligible(self):
+        """Première requête en attente dont la clé n'a pas atteint sa limite de rendus simultanés"""
+        for entry in sorted(self._waiting):
+            if self._running_by_key[entry[2]] < self.per_key:
+                return entry
+        return None
+
+    def _retry_after(self):
+        return self._average_s * (len(self._waiting) + 1) / self.slots
+
+    def acquire(self, key, cost, weight=1.0):
+        with self._condition:
+            if len(self._waiting) >= self.max_waiting:
+                raise Overloaded("File de rendu pleine", self._retry_after())
+            start = max(self._virtual_time, self._last_finish.get(key, 0.0))
+            finish = start + cost / weight
+            self._last_finish[key] = finish
+            entry = (finish, next(self._sequence), key, start)
+            heapq.heappush(self._waiting, entry)
+
+            deadline = time.monotonic() + self.timeout
+            while not (self._running < self.slots and self._eligible() is entry):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    # L'étiquette n'a pas été servie : ne pas pénaliser la clé
+                    self._last_finish[key] = min(self._last_finish[key], start)
+                    self._condition.notify_all()
+                    raise Overloaded("Temps d'attente dépassé", self._retry_after())
+                self._condition.wait(remaining)
+
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+            self._virtual_time = max(self._virtual_time, start)
+            self._running += 1
+            self._running_by_key[key] += 1
+
+    def release(self, key, duration_s):
+        with self._condition:
+            self._running -= 1
+            self._running_by_key[key] -= 1
+            self._average_s = 0.8 * self._average_s + 0.2 * duration_s
+            self._condition.notify_all()
+
+    def queued(self):
+        return len(self._waiting)
+
+    def running(self):
+        return self._running
+
+rate_limiter = TokenBucket(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+scheduler = FairScheduler(RENDER_SLOTS, MAX_CONCURRENT_RENDERS_PER_KEY, MAX_QUEUED_RENDERS, QUEUE_TIMEOUT_S)
+
+register_gauge('render_queue_length', scheduler.queued)
+register_gauge('renders_in_progress', scheduler.running)
+
+def check_rate(key):
+    """Appliquer la limite de débit de la clé ; lève Overloaded si elle est dépassée"""
+    retry_after = rate_limiter.consume(key)
+    if retry_after:
+        increment('rate_limited')
+        raise Overloaded("Trop de requêtes pour cette clé API", retry_after)
+
+@contextmanager
+def admit(key, cost, weight=1.0):
+    """Attendre son tour dans la file équitable puis occuper un emplacement de rendu"""
+    queued_at = time.monotonic()
+    try:
+        scheduler.acquire(key, cost, weight)
+    except Overloaded:
+        increment('render_rejected')
+        raise
+    started = time.monotonic()
+    observe('render_queue_wait_ms', (started - queued_at) * 1000)
+    try:
+        yield
+    finally:
+        duration = time.monotonic() - started
+        scheduler.release(key, duration)
+        observe('render_duration_ms', duration * 1000)
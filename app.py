@@ -1,16 +1,54 @@
 # app.py - Version améliorée avec authentification, factures et thèmes colorés
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, g, request, jsonify, send_file
 from flask_cors import CORS
-from datetime import datetime, timedelta
-import uuid
 import os
+import uuid
 from functools import wraps
-from models import Devis, DevisItem, Facture
+from models import Devis, DevisItem, Facture, facture_from_devis
 from pdf_generator import generate_pdf_devis, generate_pdf_facture
 from docx_generator import generate_docx_devis, generate_docx_facture
+from status_stamp import apply_status, STATUTS_DISPONIBLES
+from document_store import save_document, load_document, stored_theme
+from profiles import get_profile, save_profile, apply_profile, is_valid_profile_id
+from logos import register_logo, logo_exists, logo_cached, prefetch_logo
+from schema import (SchemaError, DEVIS_SCHEMA, FACTURE_SCHEMA, CONVERSION_SCHEMA,
+                    STATUT_SCHEMA, MERGE_SCHEMA, PROFILE_SCHEMA, THEME_SCHEMA, CATALOG_SCHEMA,
+                    RECURRENCE_SCHEMA)
+from pdf_tools import merge_pdfs
+from document_index import index_document, index_status, search_documents, iso_date
+from numbering import next_numero, release_numero
+from reports import record_facture, record_status, summary, GROUPES
+from ingest import read_stream, FORMATS_FLUX
+from admission import Overloaded, admit, check_rate, render_cost
+from metrics import snapshot
+from catalog import import_products, get_product, resolve_items
+from recurring import save_recurrence, get_recurrence, emissions, is_valid_recurrence_id
+from themes import THEME_PAR_DEFAUT, is_valid_theme_name, list_themes, save_theme
+from shared_cache import make_cache, source_version
+from profiling import PROFILING_ENABLED, profile_render
+from memory_tracing import MEMORY_TRACING_ENABLED, FICHIERS_SUIVIS, reset_baseline, leak_report
+from request_log import configure_logging, begin_request, access_log, end_request, mark_stage
 
 app = Flask(__name__)  # CORRECTION: doubles underscores
 CORS(app)
+configure_logging()
+
+@app.before_request
+def start_request_log():
+    g.request_id = begin_request(request.headers.get('X-Request-ID'))
+
+@app.after_request
+def write_access_log(response):
+    """Journal d'accès (durée totale et par étape de rendu) et identifiant renvoyé au client"""
+    response.headers['X-Request-ID'] = g.request_id
+    access_log(request.method, request.path, response.status_code,
+               client=g.get('api_client'), taille=response.content_length)
+    return response
+
+@app.teardown_request
+def end_request_log(exc):
+    # Requête interrompue avant after_request : ne pas laisser d'étape ouverte au thread
+    end_request()
 
 # Configuration
 app.config['UPLOAD_FOLDER'] = 'generated'
@@ -20,8 +58,49 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 API_KEY_1 = os.environ.get('API_KEY_1', 'your-secret-key-1-here')
 API_KEY_2 = os.environ.get('API_KEY_2', 'your-secret-key-2-here')
 
-# Thèmes disponibles
-THEMES_DISPONIBLES = ['bleu', 'vert', 'rouge', 'violet', 'orange', 'noir']
+def load_api_clients():
+    """Clients API : API_KEYS='nom:cle1:cle2[:poids],...' en plus de la paire API_KEY_1/API_KEY_2
+
+    Le poids règle la part de rendus d'un client dans la file équitable (1 par défaut).
+    """
+    clients = {(API_KEY_1, API_KEY_2): ('default', 1.0)}
+    for entry in os.environ.get('API_KEYS', '').split(','):
+        parts = entry.strip().split(':')
+        if len(parts) in (3, 4):
+            clients[(parts[1], parts[2])] = (parts[0], float(parts[3]) if len(parts) == 4 else 1.0)
+    return clients
+
+API_CLIENTS = load_api_clients()
+
+# Valeurs fournisseur par défaut (remplacées par un profil enregistré ou par le payload)
+DEFAUTS_FOURNISSEUR = {
+    'fournisseur_nom': 'Infinytia',
+    'fournisseur_adresse': '61 Rue De Lyon',
+    'fournisseur_ville': '75012 Paris, FR',
+    'fournisseur_email': 'contact@infinytia.com',
+    'fournisseur_siret': '93968736400017',
+    'fournisseur_telephone': '+33 1 23 45 67 89',
+    'fournisseur_tva': 'FR89939687364',
+    'banque_nom': 'BNP Paribas',
+    'banque_iban': 'FR76 3000 4008 2800 0123 4567 890',
+    'banque_bic': 'BNPAFRPPXXX',
+    'penalites_retard': 'En cas de retard de paiement, une pénalité de 3 fois le taux d\'intérêt légal sera appliquée',
+    'logo_url': '',
+    'logo_id': '',
+}
+DEFAUTS_DEVIS = dict(DEFAUTS_FOURNISSEUR, conditions_paiement='Paiement à 30 jours')
+DEFAUTS_FACTURE = dict(DEFAUTS_FOURNISSEUR, conditions_paiement='Paiement à réception')
+
+MIMETYPES = {
+    'pdf': 'application/pdf',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+}
+
+def overloaded_response(error):
+    """Réponse 429 avec le délai conseillé avant de réessayer"""
+    response = jsonify({"error": str(error), "retry_after": error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
 
 def require_api_keys(f):
     """Décorateur pour vérifier les 2 clés API"""
@@ -34,8 +113,15 @@ def require_api_keys(f):
         if not key1 or not key2:
             return jsonify({"error": "Clés API manquantes"}), 401
         
-        if key1 != API_KEY_1 or key2 != API_KEY_2:
+        client = API_CLIENTS.get((key1, key2))
+        if client is None:
             return jsonify({"error": "Clés API invalides"}), 401
+        g.api_client, g.api_weight = client
+        
+        try:
+            check_rate(g.api_client)
+        except Overloaded as e:
+            return overloaded_response(e)
         
         return f(*args, **kwargs)
     return decorated_function
@@ -48,198 +134,599 @@ def health_check():
 def get_themes():
     """Retourner la liste des thèmes disponibles"""
     return jsonify({
-        "themes_disponibles": THEMES_DISPONIBLES,
-        "theme_par_defaut": "bleu"
+        "themes_disponibles": list_themes(),
+        "theme_par_defaut": THEME_PAR_DEFAUT
     }), 200
 
+@app.route('/api/themes', methods=['POST'])
+@require_api_keys
+def create_theme():
+    """Enregistrer un thème personnalisé à partir de couleurs hexadécimales"""
+    try:
+        data = THEME_SCHEMA.validate(request.get_json(silent=True))
+        if not is_valid_theme_name(data['theme']):
+            return jsonify({"error": "Nom de thème invalide (a-z, 0-9, _ et -, 32 caractères maximum)"}), 400
+        theme = save_theme(data['theme'], data)
+        return jsonify(theme), 201
+        
+    except SchemaError as e:
+        return jsonify(e.to_dict()), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/profiles', methods=['POST'])
+@require_api_keys
+def create_profile():
+    """Créer ou mettre à jour un profil fournisseur (coordonnées, banque, conditions)"""
+    try:
+        data = request.json or {}
+        profile_id = data.get('profile_id')
+        if not profile_id or not is_valid_profile_id(profile_id):
+            return jsonify({"error": "profile_id invalide (lettres, chiffres, '-' et '_')"}), 400
+        
+        profile = save_profile(profile_id, dict(DEFAUTS_FOURNISSEUR, **data))
+        return jsonify(profile), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+@require_api_keys
+def get_profile_route(profile_id):
+    """Retourner un profil fournisseur enregistré"""
+    profile = get_profile(profile_id)
+    if profile is None:
+        return jsonify({"error": "Profil fournisseur introuvable"}), 404
+    return jsonify(profile), 200
+
+@app.route('/api/logos', methods=['POST'])
+@require_api_keys
+def upload_logo():
+    """Enregistrer un logo une fois (fichier multipart 'file' ou image brute) et retourner son logo_id"""
+    try:
+        uploaded = request.files.get('file')
+        raw = uploaded.read() if uploaded else request.get_data()
+        if not raw:
+            return jsonify({"error": "Aucune image reçue"}), 400
+        
+        try:
+            logo = register_logo(raw)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(logo), 201
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/catalog', methods=['POST'])
+@require_api_keys
+def import_catalog():
+    """Importer des produits en masse ; les articles les référencent ensuite par leur sku"""
+    try:
+        payload = CATALOG_SCHEMA.validate(request.get_json(silent=True))
+        result = import_products(payload['produits'], replace=payload['remplacer'])
+        return jsonify(result), 200
+        
+    except SchemaError as e:
+        return jsonify(e.to_dict()), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/catalog/<sku>', methods=['GET'])
+@require_api_keys
+def get_catalog_product(sku):
+    """Retourner un produit du catalogue"""
+    product = get_product(sku)
+    if product is None:
+        return jsonify({"error": "Produit introuvable"}), 404
+    return jsonify(product), 200
+
+@app.route('/api/recurring', methods=['POST'])
+@require_api_keys
+def create_recurrence():
+    """Créer ou remplacer une facture récurrente (émise par `python recurring.py run`, lancé par cron)"""
+    try:
+        data = request.get_json(silent=True)
+        definition = RECURRENCE_SCHEMA.validate(data)
+        if not is_valid_recurrence_id(definition['recurrence_id']):
+            return jsonify({"error": "recurrence_id invalide (lettres, chiffres, '-' et '_')"}), 400
+        # Modèle vérifié dès l'enregistrement (les dates et le numéro sont fixés à l'émission)
+        template = data.get('facture')
+        resolve_items(FACTURE_SCHEMA.validate(template, prefix='facture.')['items'], path='facture.items')
+        
+        return jsonify(save_recurrence(definition, template)), 200
+        
+    except SchemaError as e:
+        return jsonify(e.to_dict()), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/recurring/<recurrence_id>', methods=['GET'])
+@require_api_keys
+def get_recurrence_route(recurrence_id):
+    """Retourner une facture récurrente et ses périodes réservées ou émises"""
+    definition = get_recurrence(recurrence_id)
+    if definition is None:
+        return jsonify({"error": "Facture récurrente introuvable"}), 404
+    return jsonify(dict(definition, emissions=emissions(recurrence_id))), 200
+
+def resolve_theme(payload):
+    """Thème demandé (son existence est vérifiée par le schéma : un thème inconnu est une erreur 400)"""
+    return payload['theme']
+
+def resolve_fournisseur(payload, defaults):
+    """Valeurs fournisseur (payload, profil enregistré, valeurs par défaut) et version du profil
+
+    Lève LookupError si le profil ou le logo référencé n'existe pas.
+    """
+    profile = None
+    if payload.get('profile_id'):
+        profile = get_profile(payload['profile_id'])
+        if profile is None:
+            raise LookupError("Profil fournisseur introuvable")
+    fournisseur, profile_version = apply_profile(payload, profile, defaults)
+    
+    # Le logo distant se télécharge pendant la construction du document
+    prefetch_logo(fournisseur['logo_url'])
+    if fournisseur['logo_id'] and not logo_exists(fournisseur['logo_id']):
+        raise LookupError("Logo introuvable. Enregistrez-le via /api/logos")
+    return fournisseur, profile_version
+
+def build_items(items_payload):
+    """Créer les articles à partir des lignes déjà validées (produits du catalogue résolus par sku)"""
+    return [DevisItem(**item) for item in resolve_items(items_payload)]
+
+def build_devis(payload):
+    """Créer l'objet devis (calculé) à partir du payload normalisé"""
+    mark_stage('model')
+    # Lignes résolues avant d'attribuer un numéro : un sku inconnu ne consomme pas la séquence
+    items = build_items(payload['items'])
+    fournisseur, profile_version = resolve_fournisseur(payload, DEFAUTS_DEVIS)
+    devis = Devis(
+        numero=payload.get('numero') or next_numero('D'),
+        date_emission=payload['date_emission'],
+        date_expiration=payload['date_expiration'],
+        client_nom=payload['client_nom'],
+        client_adresse=payload['client_adresse'],
+        client_ville=payload['client_ville'],
+        client_siret=payload['client_siret'],
+        client_tva=payload['client_tva'],
+        client_telephone=payload['client_telephone'],
+        client_email=payload['client_email'],
+        profile_id=payload.get('profile_id', ''),
+        profile_version=profile_version or '',
+        texte_intro=payload['texte_intro'],
+        texte_conclusion=payload['texte_conclusion'],
+        **fournisseur
+    )
+    devis.items = items
+    devis.calculate_totals()
+    return devis
+
+def build_facture(payload):
+    """Créer l'objet facture (calculé) à partir du payload normalisé"""
+    mark_stage('model')
+    # Lignes résolues avant d'attribuer un numéro : un sku inconnu ne consomme pas la séquence
+    items = build_items(payload['items'])
+    fournisseur, profile_version = resolve_fournisseur(payload, DEFAUTS_FACTURE)
+    facture = Facture(
+        numero=payload.get('numero') or next_numero('F'),
+        date_emission=payload['date_emission'],
+        date_echeance=payload['date_echeance'],
+        client_nom=payload['client_nom'],
+        client_adresse=payload['client_adresse'],
+        client_ville=payload['client_ville'],
+        client_siret=payload['client_siret'],
+        client_tva=payload['client_tva'],
+        client_telephone=payload['client_telephone'],
+        client_email=payload['client_email'],
+        profile_id=payload.get('profile_id', ''),
+        profile_version=profile_version or '',
+        statut_paiement=payload['statut_paiement'],
+        numero_commande=payload['numero_commande'],
+        reference_devis=payload['reference_devis'],
+        **fournisseur
+    )
+    facture.items = items
+    facture.calculate_totals()
+    return facture
+
+# Générateurs par type de document et format de sortie
+GENERATEURS = {
+    ('devis', 'pdf'): generate_pdf_devis,
+    ('devis', 'docx'): generate_docx_devis,
+    ('facture', 'pdf'): generate_pdf_facture,
+    ('facture', 'docx'): generate_docx_facture,
+}
+
+# Rendus déterministes déjà produits (taille en Mo, 0 pour désactiver) : mêmes données, même thème
+# et même code de rendu donnent les mêmes octets ; partagés entre workers avec CACHE_BACKEND=shared
+RENDER_CACHE_MB = int(os.environ.get('RENDER_CACHE_MB', '64'))
+RENDER_VERSION = source_version('pdf_generator', 'docx_generator', 'facturx', 'themes')
+render_cache = make_cache('renders', RENDER_CACHE_MB) if RENDER_CACHE_MB else None
+
+def render_cache_key(kind, document, theme, output_format, options):
+    """Clé d'un rendu réutilisable, ou None (mode non déterministe, logo distant pas encore disponible)"""
+    if render_cache is None or not options['deterministic']:
+        return None
+    # Un logo arrivé après le budget d'attente manquerait au rendu : ne pas figer ce rendu
+    if document.logo_url and not logo_cached(document.logo_url):
+        return None
+    return ':'.join([RENDER_VERSION, kind, output_format, theme, options.get('facturx', ''),
+                     document.content_hash()])
+
+def write_rendered(kind, document, theme, output_format, content):
+    """Recopier un rendu du cache à l'emplacement où le générateur l'aurait écrit"""
+    filename = os.path.join(app.config['UPLOAD_FOLDER'], f'{kind}_{document.numero}_{theme}.{output_format}')
+    tmp_path = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, filename)
+    return filename
+
+def render_options(payload):
+    """Options des générateurs tirées du payload normalisé (Factur-X : PDF seulement)"""
+    options = {'deterministic': payload['deterministic']}
+    if payload.get('facturx') and payload['format'] == 'pdf':
+        options['facturx'] = payload['facturx']
+    return options
+
+def render_document(kind, document, payload):
+    """Rendre le document, le conserver dans le stockage local et le retourner"""
+    theme = resolve_theme(payload)
+    output_format = payload['format']
+    options = render_options(payload)
+    
+    key = render_cache_key(kind, document, theme, output_format, options)
+    cached = render_cache.get(key) if key else None
+    try:
+        if cached is not None:
+            filename = write_rendered(kind, document, theme, output_format, cached)
+        else:
+            filename = GENERATEURS[(kind, output_format)](document, theme=theme, **options)
+            if key:
+                with open(filename, 'rb') as f:
+                    render_cache.put(key, f.read())
+    except Exception:
+        # Numéro attribué par le serveur et jamais remis : le rendre pour ne pas laisser de trou
+        if not payload.get('numero'):
+            release_numero(document.numero)
+        raise
+    
+    # Conserver le document calculé (conversion devis -> facture, changements de statut)
+    save_document(kind, document, theme)
+    index_document(kind, document, theme, output_format)
+    if kind == 'facture':
+        record_facture(document)
+    
+    response = send_file(
+        filename,
+        mimetype=MIMETYPES[output_format],
+        as_attachment=True,
+        download_name=f"{kind}_{document.numero}_{theme}.{output_format}"
+    )
+    if key:
+        response.headers['X-Render-Cache'] = 'hit' if cached is not None else 'miss'
+    return response
+
 @app.route('/api/devis', methods=['POST'])
 @require_api_keys
 def create_devis():
     """Créer un nouveau devis avec les données reçues"""
     try:
-        data = request.json
-        
-        # Récupérer et valider le thème
-        theme = data.get('theme', 'bleu')
-        if theme not in THEMES_DISPONIBLES:
-            theme = 'bleu'  # fallback vers le thème par défaut
-        
-        # Créer l'objet devis avec toutes les options modifiables
-        devis = Devis(
-            numero=data.get('numero', f"D-{datetime.now().year}-{str(uuid.uuid4())[:3]}"),
-            date_emission=data.get('date_emission', datetime.now().strftime('%d/%m/%Y')),
-            date_expiration=data.get('date_expiration', (datetime.now() + timedelta(days=30)).strftime('%d/%m/%Y')),
-            
-            # Informations fournisseur (tout modifiable)
-            fournisseur_nom=data.get('fournisseur_nom', 'Infinytia'),
-            fournisseur_adresse=data.get('fournisseur_adresse', '61 Rue De Lyon'),
-            fournisseur_ville=data.get('fournisseur_ville', '75012 Paris, FR'),
-            fournisseur_email=data.get('fournisseur_email', 'contact@infinytia.com'),
-            fournisseur_siret=data.get('fournisseur_siret', '93968736400017'),
-            fournisseur_telephone=data.get('fournisseur_telephone', '+33 1 23 45 67 89'),
-            
-            # Informations client
-            client_nom=data.get('client_nom'),
-            client_adresse=data.get('client_adresse'),
-            client_ville=data.get('client_ville'),
-            client_siret=data.get('client_siret'),
-            client_tva=data.get('client_tva'),
-            client_telephone=data.get('client_telephone', ''),
-            client_email=data.get('client_email', ''),
-            
-            # Logo de l'entreprise
-            logo_url=data.get('logo_url', ''),
-            
-            # Informations bancaires (modifiables)
-            banque_nom=data.get('banque_nom', 'BNP Paribas'),
-            banque_iban=data.get('banque_iban', 'FR76 3000 4008 2800 0123 4567 890'),
-            banque_bic=data.get('banque_bic', 'BNPAFRPPXXX'),
-            
-            # Conditions de paiement
-            conditions_paiement=data.get('conditions_paiement', 'Paiement à 30 jours'),
-            penalites_retard=data.get('penalites_retard', 'En cas de retard de paiement, une pénalité de 3 fois le taux d\'intérêt légal sera appliquée'),
-            
-            # Texte personnalisé
-            texte_intro=data.get('texte_intro', ''),
-            texte_conclusion=data.get('texte_conclusion', 'Nous restons à votre disposition pour toute information complémentaire.'),
+        # Validation complète avant tout rendu
+        payload = DEVIS_SCHEMA.validate(request.get_json(silent=True))
+        with admit(g.api_client, render_cost(len(payload['items']), payload['format']), g.api_weight):
+            devis = build_devis(payload)
+            return render_document('devis', devis, payload)
+        
+    except SchemaError as e:
+        return jsonify(e.to_dict()), 400
+    except Overloaded as e:
+        return overloaded_response(e)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/facture', methods=['POST'])
+@require_api_keys
+def create_facture():
+    """Créer une nouvelle facture avec les données reçues"""
+    try:
+        payload = FACTURE_SCHEMA.validate(request.get_json(silent=True))
+        with admit(g.api_client, render_cost(len(payload['items']), payload['format']), g.api_weight):
+            facture = build_facture(payload)
+            return render_document('facture', facture, payload)
+        
+    except SchemaError as e:
+        return jsonify(e.to_dict()), 400
+    except Overloaded as e:
+        return overloaded_response(e)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Schémas et constructeurs par type de document (lecture en flux)
+SCHEMAS = {
+    'devis': DEVIS_SCHEMA,
+    'facture': FACTURE_SCHEMA,
+}
+CONSTRUCTEURS = {
+    'devis': build_devis,
+    'facture': build_facture,
+}
+
+def create_from_stream(kind):
+    """Créer un document dont les articles arrivent en flux après l'en-tête (NDJSON ou CSV)"""
+    try:
+        if request.mimetype not in FORMATS_FLUX:
+            return jsonify({"error": f"Type de contenu non supporté. Utilisez: {', '.join(FORMATS_FLUX)}"}), 415
+        
+        header, items = read_stream(request.stream, request.mimetype)
+        payload = SCHEMAS[kind].validate(header)
+        with admit(g.api_client, render_cost(len(items), payload['format']), g.api_weight):
+            document = CONSTRUCTEURS[kind](payload)
             
-            # Articles
-            items=[]
-        )
+            # Totaux déjà cumulés pendant la lecture
+            document.items = items
+            document.total_ht, document.total_tva, document.total_ttc = items.totals()
+            document.tva_par_taux = items.tva_par_taux
+            return render_document(kind, document, payload)
         
-        # Ajouter les articles
-        for item_data in data.get('items', []):
-            item = DevisItem(
-                description=item_data.get('description'),
-                details=item_data.get('details', []),
-                quantite=item_data.get('quantite', 1),
-                prix_unitaire=item_data.get('prix_unitaire', 0),
-                tva_taux=item_data.get('tva_taux', 20),
-                remise=item_data.get('remise', 0)
+    except SchemaError as e:
+        return jsonify(e.to_dict()), 400
+    except Overloaded as e:
+        return overloaded_response(e)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/devis/stream', methods=['POST'])
+@require_api_keys
+def create_devis_stream():
+    """Créer un très gros devis : en-tête JSON en première ligne, puis un article par ligne"""
+    return create_from_stream('devis')
+
+@app.route('/api/facture/stream', methods=['POST'])
+@require_api_keys
+def create_facture_stream():
+    """Créer une très grosse facture : en-tête JSON en première ligne, puis un article par ligne"""
+    return create_from_stream('facture')
+
+@app.route('/api/devis/<numero>/facture', methods=['POST'])
+@require_api_keys
+def create_facture_from_devis(numero):
+    """Créer la facture d'un devis accepté à partir du devis stocké (sans renvoyer les articles)"""
+    try:
+        payload = CONVERSION_SCHEMA.validate(request.get_json(silent=True) or {})
+        
+        devis = load_document('devis', numero)
+        if devis is None:
+            return jsonify({"error": "Devis introuvable. Générez-le d'abord via /api/devis"}), 404
+        
+        with admit(g.api_client, render_cost(len(devis.items), payload['format']), g.api_weight):
+            # Seuls les champs propres à la facture peuvent être fournis ; le reste vient du devis
+            facture = facture_from_devis(
+                devis,
+                numero=payload.get('numero') or next_numero('F'),
+                date_emission=payload['date_emission'],
+                date_echeance=payload['date_echeance'],
+                statut_paiement=payload['statut_paiement'],
+                numero_commande=payload['numero_commande'],
+                conditions_paiement=payload.get('conditions_paiement')
             )
-            devis.items.append(item)
+            return render_document('facture', facture, payload)
+        
+    except SchemaError as e:
+        return jsonify(e.to_dict()), 400
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/facture/<numero>/status', methods=['POST'])
+@require_api_keys
+def update_facture_status(numero):
+    """Changer le statut d'une facture déjà générée en tamponnant le rendu stocké"""
+    try:
+        payload = STATUT_SCHEMA.validate(request.get_json(silent=True))
         
-        # Calculer les totaux
-        devis.calculate_totals()
+        statut = payload['statut_paiement']
+        if statut not in STATUTS_DISPONIBLES:
+            return jsonify({"error": f"Statut non supporté. Utilisez: {', '.join(STATUTS_DISPONIBLES)}"}), 400
         
-        # Format de sortie demandé
-        output_format = data.get('format', 'pdf').lower()
+        # Thème du dernier rendu si absent, comme /api/documents/merge
+        theme = payload.get('theme') or stored_theme('facture', numero)
+        output_format = payload['format']
         
-        if output_format == 'pdf':
-            filename = generate_pdf_devis(devis, theme=theme)
-            mimetype = 'application/pdf'
-        elif output_format == 'docx':
-            # CORRECTION: Passer le thème aussi pour DOCX
-            filename = generate_docx_devis(devis, theme=theme)
-            mimetype = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-        else:
-            return jsonify({"error": "Format non supporté. Utilisez 'pdf' ou 'docx'"}), 400
+        try:
+            if theme is None:
+                raise FileNotFoundError(f"Facture {numero} non enregistrée")
+            filename = apply_status(numero, statut, theme=theme, output_format=output_format,
+                                    folder=app.config['UPLOAD_FOLDER'])
+        except FileNotFoundError:
+            return jsonify({"error": "Facture introuvable. Générez-la d'abord via /api/facture"}), 404
+        index_status(numero, statut)
+        record_status(numero, statut)
         
-        # Retourner le fichier
         return send_file(
             filename,
-            mimetype=mimetype,
+            mimetype=MIMETYPES[output_format],
             as_attachment=True,
-            download_name=f"devis_{devis.numero}_{theme}.{output_format}"
+            download_name=f"facture_{numero}_{theme}.{output_format}"
         )
         
+    except SchemaError as e:
+        return jsonify(e.to_dict()), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/facture', methods=['POST'])
+@app.route('/api/documents', methods=['GET'])
 @require_api_keys
-def create_facture():
-    """Créer une nouvelle facture avec les données reçues"""
+def list_documents():
+    """Lister les documents générés (filtres type, client, siret, statut, dates ; pagination par curseur)"""
     try:
-        data = request.json
-        
-        # Récupérer et valider le thème
-        theme = data.get('theme', 'bleu')
-        if theme not in THEMES_DISPONIBLES:
-            theme = 'bleu'  # fallback vers le thème par défaut
-        
-        # Créer l'objet facture
-        facture = Facture(
-            numero=data.get('numero', f"F-{datetime.now().year}-{str(uuid.uuid4())[:3]}"),
-            date_emission=data.get('date_emission', datetime.now().strftime('%d/%m/%Y')),
-            date_echeance=data.get('date_echeance', (datetime.now() + timedelta(days=30)).strftime('%d/%m/%Y')),
-            
-            # Informations fournisseur
-            fournisseur_nom=data.get('fournisseur_nom', 'Infinytia'),
-            fournisseur_adresse=data.get('fournisseur_adresse', '61 Rue De Lyon'),
-            fournisseur_ville=data.get('fournisseur_ville', '75012 Paris, FR'),
-            fournisseur_email=data.get('fournisseur_email', 'contact@infinytia.com'),
-            fournisseur_siret=data.get('fournisseur_siret', '93968736400017'),
-            fournisseur_telephone=data.get('fournisseur_telephone', '+33 1 23 45 67 89'),
-            
-            # Informations client
-            client_nom=data.get('client_nom'),
-            client_adresse=data.get('client_adresse'),
-            client_ville=data.get('client_ville'),
-            client_siret=data.get('client_siret'),
-            client_tva=data.get('client_tva'),
-            client_telephone=data.get('client_telephone', ''),
-            client_email=data.get('client_email', ''),
-            
-            # Logo de l'entreprise
-            logo_url=data.get('logo_url', ''),
-            
-            # Informations bancaires
-            banque_nom=data.get('banque_nom', 'BNP Paribas'),
-            banque_iban=data.get('banque_iban', 'FR76 3000 4008 2800 0123 4567 890'),
-            banque_bic=data.get('banque_bic', 'BNPAFRPPXXX'),
-            
-            # Conditions et statut
-            conditions_paiement=data.get('conditions_paiement', 'Paiement à réception'),
-            penalites_retard=data.get('penalites_retard', 'En cas de retard de paiement, une pénalité de 3 fois le taux d\'intérêt légal sera appliquée'),
-            statut_paiement=data.get('statut_paiement', 'En attente'),
-            
-            # Références
-            numero_commande=data.get('numero_commande', ''),
-            reference_devis=data.get('reference_devis', ''),
-            
-            # Articles
-            items=[]
-        )
-        
-        # Ajouter les articles (même structure que devis)
-        for item_data in data.get('items', []):
-            item = DevisItem(
-                description=item_data.get('description'),
-                details=item_data.get('details', []),
-                quantite=item_data.get('quantite', 1),
-                prix_unitaire=item_data.get('prix_unitaire', 0),
-                tva_taux=item_data.get('tva_taux', 20),
-                remise=item_data.get('remise', 0)
+        args = request.args
+        dates = {}
+        for name in ('date_min', 'date_max'):
+            if args.get(name):
+                dates[name] = iso_date(args[name])
+                if not dates[name]:
+                    return jsonify({"error": f"{name} invalide (format jj/mm/aaaa)"}), 400
+        try:
+            limit = int(args.get('limit', 50))
+            documents, next_cursor = search_documents(
+                kind=args.get('type'),
+                client=args.get('client'),
+                siret=args.get('siret'),
+                statut=args.get('statut'),
+                cursor=args.get('cursor'),
+                limit=limit,
+                **dates
             )
-            facture.items.append(item)
+        except ValueError:
+            return jsonify({"error": "Paramètre limit ou cursor invalide"}), 400
+        
+        return jsonify({"documents": documents, "next_cursor": next_cursor}), 200
         
-        # Calculer les totaux
-        facture.calculate_totals()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/reports/summary', methods=['GET'])
+@require_api_keys
+def reports_summary():
+    """Chiffre d'affaires et TVA collectée par mois, par client ou par taux de TVA"""
+    try:
+        group = request.args.get('group', 'month')
+        if group not in GROUPES:
+            return jsonify({"error": f"Regroupement non supporté. Utilisez: {', '.join(GROUPES)}"}), 400
+        return jsonify({"group": group, "groupes": summary(group)}), 200
         
-        # Format de sortie
-        output_format = data.get('format', 'pdf').lower()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def rendered_pdf(kind, numero, theme):
+    """Dernier rendu PDF d'un document (version tamponnée si elle est plus récente), ou None"""
+    if '/' in numero or '\\' in numero:
+        return None
+    base_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{kind}_{numero}_{theme}.pdf')
+    if not os.path.exists(base_path):
+        return None
+    stamped_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{kind}_{numero}_{theme}_statut.pdf')
+    if os.path.exists(stamped_path) and os.path.getmtime(stamped_path) >= os.path.getmtime(base_path):
+        return stamped_path
+    return base_path
+
+@app.route('/api/documents/merge', methods=['POST'])
+@require_api_keys
+def merge_documents():
+    """Assembler les rendus PDF stockés de plusieurs documents en un seul fichier (publipostage)"""
+    try:
+        payload = MERGE_SCHEMA.validate(request.get_json(silent=True))
         
-        if output_format == 'pdf':
-            filename = generate_pdf_facture(facture, theme=theme)
-            mimetype = 'application/pdf'
-        elif output_format == 'docx':
-            # CORRECTION: Passer le thème aussi pour DOCX
-            filename = generate_docx_facture(facture, theme=theme)
-            mimetype = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-        else:
-            return jsonify({"error": "Format non supporté"}), 400
+        # Tous les rendus sont vérifiés avant d'envoyer le premier octet
+        paths = []
+        missing = []
+        for ref in payload['documents']:
+            theme = ref.get('theme') or stored_theme(ref['type'], ref['numero'])
+            path = rendered_pdf(ref['type'], ref['numero'], theme) if theme else None
+            if path is None:
+                missing.append(f"{ref['type']} {ref['numero']}")
+            else:
+                paths.append(path)
+        if missing:
+            return jsonify({"error": "Rendus PDF introuvables", "documents": missing}), 404
         
-        return send_file(
-            filename,
-            mimetype=mimetype,
-            as_attachment=True,
-            download_name=f"facture_{facture.numero}_{theme}.{output_format}"
+        return Response(
+            merge_pdfs(paths),
+            mimetype=MIMETYPES['pdf'],
+            headers={'Content-Disposition': 'attachment; filename=documents.pdf'}
         )
         
+    except SchemaError as e:
+        return jsonify(e.to_dict()), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+@require_api_keys
+def get_metrics():
+    """Métriques du processus : attente dans la file de rendu, rejets, rendus en cours"""
+    return jsonify(snapshot()), 200
+
+if PROFILING_ENABLED:
+    # Route absente tant que ENABLE_PROFILING n'est pas activé : aucun coût en production
+    @app.route('/api/debug/profile', methods=['POST'])
+    @require_api_keys
+    def profile_document():
+        """Rendre un payload sous profileur et retourner le profil (speedscope ou collapsed) et les fonctions les plus coûteuses"""
+        try:
+            data = request.get_json(silent=True) or {}
+            options = PROFILE_SCHEMA.validate(data)
+            kind = options['type']
+            payload = SCHEMAS[kind].validate(data.get('payload'))
+            # Numéro jetable : ni numéro de séquence consommé, ni rendu existant écrasé
+            payload['numero'] = f"_profil_{uuid.uuid4().hex[:8]}"
+            
+            with admit(g.api_client, render_cost(len(payload['items']), payload['format']), g.api_weight):
+                document = CONSTRUCTEURS[kind](payload)
+                generate = GENERATEURS[(kind, payload['format'])]
+                theme = resolve_theme(payload)
+                # Rendu jetable supprimé même si le rendu ou le profileur échoue
+                filename = os.path.join(app.config['UPLOAD_FOLDER'],
+                                        f"{kind}_{document.numero}_{theme}.{payload['format']}")
+                try:
+                    _, report = profile_render(
+                        lambda: generate(document, theme=theme, deterministic=payload['deterministic']),
+                        f"{kind} {payload['format']} ({len(document.items)} articles)",
+                        mode=options['mode'],
+                        output=options['format'],
+                        interval_ms=options['interval_ms']
+                    )
+                finally:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+            return jsonify(report), 200
+            
+        except SchemaError as e:
+            return jsonify(e.to_dict()), 400
+        except LookupError as e:
+            return jsonify({"error": str(e)}), 404
+        except Overloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+if MEMORY_TRACING_ENABLED:
+    # Routes absentes tant que ENABLE_MEMORY_TRACING n'est pas activé
+    @app.route('/api/debug/memory', methods=['GET'])
+    @require_api_keys
+    def memory_leaks():
+        """Croissance de la mémoire par fichier et ligne entre l'instantané de référence et le dernier"""
+        try:
+            limit = request.args.get('limit', 20, type=int)
+            # ?files=* pour ne pas filtrer, ou liste séparée par des virgules
+            files = request.args.get('files', '')
+            patterns = [pattern.strip() for pattern in files.split(',') if pattern.strip()] or FICHIERS_SUIVIS
+            return jsonify(leak_report(limit, patterns)), 200
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+    
+    @app.route('/api/debug/memory/baseline', methods=['POST'])
+    @require_api_keys
+    def memory_baseline():
+        """Prendre un nouvel instantané de référence"""
+        try:
+            reset_baseline()
+            return jsonify(leak_report()), 200
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
 @app.route('/api/test-auth', methods=['GET'])
 @require_api_keys
 def test_auth():
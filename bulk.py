@@ -0,0 +1,229 @@
+# bulk.py - python -m bulk : rendu en masse hors ligne de payloads devis / facture (reprises, migrations)
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from app import CONSTRUCTEURS, GENERATEURS, SCHEMAS, render_options
+from document_index import flush, index_document
+from document_store import save_document
+from numbering import next_numero
+from reports import record_facture
+from schema import SchemaError, TYPES_DOCUMENT
+
+# Processus de rendu (le rendu est limité par le CPU)
+BULK_WORKERS = int(os.environ.get('BULK_WORKERS', os.cpu_count() or 1))
+
+# Préfixe des numéros attribués aux payloads sans numéro
+PREFIXES_NUMERO = {
+    'devis': 'D',
+    'facture': 'F',
+}
+
+EXTENSIONS_JSON = ('.json',)
+EXTENSIONS_NDJSON = ('.ndjson', '.jsonl')
+
+def iter_payloads(path):
+    """(source, payload) pour un dossier, un fichier JSON (objet ou tableau) ou un fichier NDJSON
+
+    La source ('fichier[3]', 'fichier:12') identifie le payload dans le manifeste de reprise.
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(EXTENSIONS_JSON + EXTENSIONS_NDJSON):
+                yield from iter_payloads(os.path.join(path, name))
+    elif path.endswith(EXTENSIONS_NDJSON):
+        with open(path, encoding='utf-8') as f:
+            for number, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        yield f'{path}:{number}', json.loads(line)
+                    except ValueError:
+                        yield f'{path}:{number}', None
+    else:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, list):
+            for index, payload in enumerate(data):
+                yield f'{path}[{index}]', payload
+        else:
+            yield path, data
+
+def read_manifest(path):
+    """Dernier état de chaque source du manifeste (une ligne tronquée par un arrêt est ignorée)"""
+    states = {}
+    if not os.path.exists(path):
+        return states
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            states[entry['source']] = entry
+    return states
+
+def render_entry(kind, payload, output, store):
+    """Construire et rendre un payload déjà validé dans un processus de rendu ; retourne le résultat du manifeste"""
+    started = time.perf_counter()
+    try:
+        document = CONSTRUCTEURS[kind](payload)
+        theme = payload['theme']
+        filename = GENERATEURS[(kind, payload['format'])](document, theme=theme, **render_options(payload))
+        if os.path.realpath(os.path.dirname(filename)) != os.path.realpath(output):
+            target = os.path.join(output, os.path.basename(filename))
+            # --output peut être sur un autre système de fichiers que le dossier des rendus
+            shutil.move(filename, target)
+            filename = target
+        if store:
+            save_document(kind, document, theme)
+            index_document(kind, document, theme, payload['format'])
+            if kind == 'facture':
+                record_facture(document)
+            # Écritures de l'index terminées avant de déclarer le rendu fait
+            flush()
+    except SchemaError as e:
+        return {'statut': 'erreur', 'erreur': e.errors}
+    except Exception as e:
+        return {'statut': 'erreur', 'erreur': str(e)}
+    return {
+        'statut': 'ok',
+        'numero': document.numero,
+        'fichier': filename,
+        'duree_ms': round((time.perf_counter() - started) * 1000, 1),
+    }
+
+class Manifest:
+    """Manifeste NDJSON en ajout seul : une ligne par changement d'état, écrite immédiatement"""
+    def __init__(self, path):
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class Progress:
+    """Avancement sur la sortie d'erreur (au plus une ligne par seconde)"""
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self.started = time.monotonic()
+        self.last = 0
+        self.done = 0
+        self.errors = 0
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.done / elapsed if elapsed else 0
+
+    def update(self, ok, force=False):
+        if ok is not None:
+            self.done += 1
+            self.errors += not ok
+        now = time.monotonic()
+        if force or now - self.last >= 1:
+            self.last = now
+            self.stream.write(f"\r{self.done} documents, {self.errors} erreurs, {self.rate():.1f} documents/s")
+            self.stream.flush()
+
+def run(inputs, default_kind, output, manifest_path, workers=BULK_WORKERS, store=True):
+    """Rendre tous les payloads pas encore faits d'après le manifeste ; retourne le bilan"""
+    os.makedirs(output, exist_ok=True)
+    states = read_manifest(manifest_path)
+    manifest = Manifest(manifest_path)
+    progress = Progress()
+    summary = {'rendus': 0, 'erreurs': 0, 'deja_faits': 0}
+    pending = {}
+
+    def collect(done):
+        for future in done:
+            entry = pending.pop(future)
+            entry.update(future.result())
+            manifest.write(entry)
+            summary['rendus' if entry['statut'] == 'ok' else 'erreurs'] += 1
+            progress.update(entry['statut'] == 'ok')
+
+    # Processus démarrés à neuf : pas de fork d'un parent qui a déjà des threads (pool, journal)
+    context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            for path in inputs:
+                for source, payload in iter_payloads(path):
+                    state = states.get(source)
+                    if state and state['statut'] == 'ok':
+                        summary['deja_faits'] += 1
+                        continue
+
+                    entry = {'source': source}
+                    if not isinstance(payload, dict):
+                        entry.update(statut='erreur', erreur="objet JSON attendu")
+                        manifest.write(entry)
+                        summary['erreurs'] += 1
+                        progress.update(False)
+                        continue
+                    payload = dict(payload)
+                    kind = payload.pop('type', default_kind)
+                    if kind not in TYPES_DOCUMENT:
+                        entry.update(statut='erreur', erreur=f"type inconnu : {kind} ({', '.join(TYPES_DOCUMENT)})")
+                        manifest.write(entry)
+                        summary['erreurs'] += 1
+                        progress.update(False)
+                        continue
+
+                    # Validé avant d'attribuer un numéro : un payload invalide ne consomme pas la séquence
+                    try:
+                        payload = SCHEMAS[kind].validate(payload)
+                    except SchemaError as e:
+                        entry.update(type=kind, statut='erreur', erreur=e.errors)
+                        manifest.write(entry)
+                        summary['erreurs'] += 1
+                        progress.update(False)
+                        continue
+
+                    # Numéro attribué et noté avant le rendu : une reprise réutilise le même
+                    if not payload.get('numero'):
+                        payload['numero'] = (state or {}).get('numero') or next_numero(PREFIXES_NUMERO[kind])
+                    entry.update(type=kind, numero=payload['numero'], statut='prevu')
+                    manifest.write(entry)
+
+                    future = executor.submit(render_entry, kind, payload, output, store)
+                    pending[future] = dict(entry)
+                    # File bornée : au plus deux payloads en attente par processus
+                    if len(pending) >= 2 * workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    progress.update(None)
+            collect(wait(pending).done)
+    finally:
+        manifest.close()
+        progress.update(None, force=True)
+        progress.stream.write('\n')
+    summary['documents_par_s'] = round(progress.rate(), 2)
+    summary['duree_s'] = round(time.monotonic() - progress.started, 1)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m bulk',
+        description="Rendu hors ligne de payloads devis / facture (même schéma que /api/devis et /api/facture)")
+    parser.add_argument('inputs', nargs='+', help="dossiers, fichiers JSON (objet ou tableau) ou NDJSON")
+    parser.add_argument('--type', choices=TYPES_DOCUMENT, default='facture',
+                        help="type des payloads sans champ 'type'")
+    parser.add_argument('--output', default='generated', help="dossier des rendus")
+    parser.add_argument('--manifest', help="manifeste de reprise (OUTPUT/manifest.ndjson par défaut)")
+    parser.add_argument('--workers', type=int, default=BULK_WORKERS, help="processus de rendu")
+    parser.add_argument('--no-store', action='store_true',
+                        help="ne pas enregistrer les documents (stockage, index, agrégats)")
+    options = parser.parse_args()
+
+    manifest = options.manifest or os.path.join(options.output, 'manifest.ndjson')
+    summary = run(options.inputs, options.type, options.output, manifest, options.workers, not options.no_store)
+    print(json.dumps(summary, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
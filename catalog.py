@@ -0,0 +1,137 @@
+# catalog.py - Catalogue produits (SQLite) et index en mémoire des SKU pour les lignes d'articles
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from schema import SchemaError
+
+DATA_FOLDER = os.environ.get('DATA_FOLDER', 'data')
+CATALOG_PATH = os.path.join(DATA_FOLDER, 'catalog.sqlite3')
+
+# Champs d'un produit recopiés dans la ligne d'article (la ligne peut les surcharger)
+CHAMPS_PRODUIT = ['description', 'details', 'prix_unitaire', 'tva_taux']
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS produits (
+    sku TEXT PRIMARY KEY,
+    donnees TEXT NOT NULL,
+    version TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+"""
+
+UPSERT_SQL = """
+INSERT INTO produits (sku, donnees, version, updated_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (sku) DO UPDATE SET
+    donnees = excluded.donnees, version = excluded.version, updated_at = excluded.updated_at
+WHERE produits.version != excluded.version
+"""
+
+# Index du processus : sku -> (champs du produit, version) ; rechargé quand la base change
+_products = {}
+_connection = None
+_data_version = None
+_lock = threading.Lock()
+
+def _connect():
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    connection = sqlite3.connect(CATALOG_PATH, timeout=30, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA_SQL)
+    return connection
+
+def _version(fields):
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+def refresh_catalog():
+    """Recharger l'index si le catalogue a été modifié (par ce worker ou un autre) ; une requête sinon"""
+    global _connection, _data_version, _products
+    if _connection is None and not os.path.exists(CATALOG_PATH):
+        return
+    with _lock:
+        if _connection is None:
+            _connection = _connect()
+        # data_version change à chaque écriture validée par une autre connexion
+        data_version = _connection.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == _data_version:
+            return
+        _products = {
+            sku: (json.loads(donnees), version)
+            for sku, donnees, version in _connection.execute("SELECT sku, donnees, version FROM produits")
+        }
+        _data_version = data_version
+
+def import_products(products, replace=False):
+    """Importer des produits validés en une transaction ; `replace` vide d'abord le catalogue"""
+    now = datetime.now().isoformat(timespec='seconds')
+    rows = []
+    for product in products:
+        fields = {champ: product[champ] for champ in CHAMPS_PRODUIT}
+        rows.append((product['sku'], json.dumps(fields, ensure_ascii=False), _version(fields), now))
+
+    connection = _connect()
+    try:
+        with connection:
+            if replace:
+                connection.execute("DELETE FROM produits")
+            changed = connection.executemany(UPSERT_SQL, rows).rowcount
+        total = connection.execute("SELECT COUNT(*) FROM produits").fetchone()[0]
+    finally:
+        connection.close()
+    refresh_catalog()
+    return {'importes': len(rows), 'modifies': changed, 'total': total}
+
+def get_product(sku):
+    """Produit du catalogue, ou None"""
+    refresh_catalog()
+    entry = _products.get(sku)
+    if entry is None:
+        return None
+    fields, version = entry
+    return {'sku': sku, **fields, 'version': version}
+
+def resolve_item(line, errors, prefix):
+    """Champs d'un article pour une ligne validée : produit du catalogue, complété par la ligne
+
+    Retourne None (et ajoute l'erreur) si la ligne n'a ni sku ni description, ou si le sku est inconnu.
+    """
+    sku = line.get('sku')
+    if sku is None:
+        if 'description' not in line:
+            errors[prefix + 'description'] = "champ obligatoire (ou sku d'un produit du catalogue)"
+            return None
+        return line
+    entry = _products.get(sku)
+    if entry is None:
+        errors[prefix + 'sku'] = "produit inconnu (voir POST /api/catalog)"
+        return None
+    return {**entry[0], **line}
+
+def resolve_items(lines, path='items'):
+    """Champs de tous les articles d'un payload validé ; lève SchemaError sur les lignes invalides"""
+    refresh_catalog()
+    errors = {}
+    items = [resolve_item(line, errors, f'{path}[{index}].') for index, line in enumerate(lines)]
+    if errors:
+        raise SchemaError(errors)
+    return items
+
+def catalog_detail_key(item):
+    """Clé de cache des détails d'un article, ou None s'ils ne sont pas ceux du produit du catalogue"""
+    sku = getattr(item, 'sku', None)
+    entry = _products.get(sku) if sku else None
+    if entry is None or entry[0]['details'] != item.details:
+        return None
+    return (sku, entry[1])
+
+def _forget_connection():
+    # Une connexion SQLite ne doit pas être utilisée dans un processus forké
+    global _connection, _data_version, _lock
+    _connection = None
+    _data_version = None
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_connection)
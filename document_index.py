@@ -0,0 +1,227 @@
+# document_index.py - Index SQLite des documents générés (écritures groupées par un thread dédié)
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DATA_FOLDER = os.environ.get('DATA_FOLDER', 'data')
+INDEX_PATH = os.path.join(DATA_FOLDER, 'documents.sqlite3')
+
+# Nombre maximal de lignes écrites par transaction
+WRITE_BATCH_SIZE = 200
+# Taille maximale d'une page de résultats
+MAX_PAGE_SIZE = 200
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    numero TEXT NOT NULL,
+    client_nom TEXT NOT NULL DEFAULT '',
+    client_siret TEXT NOT NULL DEFAULT '',
+    date_emission TEXT NOT NULL DEFAULT '',
+    date_limite TEXT NOT NULL DEFAULT '',
+    date_tri TEXT NOT NULL DEFAULT '',
+    total_ht REAL NOT NULL DEFAULT 0,
+    total_tva REAL NOT NULL DEFAULT 0,
+    total_ttc REAL NOT NULL DEFAULT 0,
+    statut_paiement TEXT NOT NULL DEFAULT '',
+    theme TEXT NOT NULL DEFAULT '',
+    format TEXT NOT NULL DEFAULT '',
+    content_hash TEXT NOT NULL DEFAULT '',
+    updated_at TEXT NOT NULL,
+    UNIQUE (type, numero, theme, format)
+);
+CREATE INDEX IF NOT EXISTS idx_documents_client ON documents (client_nom, date_tri, id);
+CREATE INDEX IF NOT EXISTS idx_documents_siret ON documents (client_siret, date_tri, id);
+CREATE INDEX IF NOT EXISTS idx_documents_date ON documents (date_tri, id);
+CREATE INDEX IF NOT EXISTS idx_documents_statut ON documents (statut_paiement, date_tri, id);
+"""
+
+UPSERT_SQL = """
+INSERT INTO documents (type, numero, client_nom, client_siret, date_emission, date_limite, date_tri,
+                       total_ht, total_tva, total_ttc, statut_paiement, theme, format, content_hash,
+                       updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (type, numero, theme, format) DO UPDATE SET
+    client_nom = excluded.client_nom, client_siret = excluded.client_siret,
+    date_emission = excluded.date_emission, date_limite = excluded.date_limite,
+    date_tri = excluded.date_tri, total_ht = excluded.total_ht, total_tva = excluded.total_tva,
+    total_ttc = excluded.total_ttc, statut_paiement = excluded.statut_paiement,
+    content_hash = excluded.content_hash, updated_at = excluded.updated_at
+"""
+
+STATUT_SQL = "UPDATE documents SET statut_paiement = ?, updated_at = ? WHERE type = 'facture' AND numero = ?"
+
+# Colonnes renvoyées par la recherche
+COLONNES = [
+    'id', 'type', 'numero', 'client_nom', 'client_siret', 'date_emission', 'date_limite',
+    'total_ht', 'total_tva', 'total_ttc', 'statut_paiement', 'theme', 'format', 'content_hash',
+    'updated_at',
+]
+
+_queue = queue.Queue()
+_writer = None
+_lock = threading.Lock()
+# Écritures perdues (transaction en erreur) depuis le dernier flush()
+_failed = 0
+
+# Schémas créés par le thread écrivain au démarrage (index et tables des autres modules)
+_schemas = [SCHEMA_SQL]
+
+def register_schema(sql):
+    """Déclarer des tables supplémentaires stockées dans la base de l'index"""
+    _schemas.append(sql)
+    return sql
+
+def iso_date(value):
+    """Date 'jj/mm/aaaa' (format des documents) en 'aaaa-mm-jj' pour le tri, '' si illisible"""
+    for fmt in ('%d/%m/%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(str(value), fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return ''
+
+def connect():
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    connection = sqlite3.connect(INDEX_PATH, timeout=30)
+    # WAL : les lectures ne bloquent pas l'écriture (ni entre workers)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+def ensure_schema(connection):
+    """Créer les tables et index manquants"""
+    for sql in _schemas:
+        connection.executescript(sql)
+
+def _write_loop():
+    """Thread écrivain : regroupe les écritures en attente dans une seule transaction"""
+    global _failed
+    connection = connect()
+    ensure_schema(connection)
+    while True:
+        batch = [_queue.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            with connection:
+                for job in batch:
+                    job(connection)
+        except sqlite3.Error as e:
+            with _lock:
+                _failed += len(batch)
+            logger.error("Erreur lors de l'écriture de l'index des documents: %s", e, extra={'ecritures': len(batch)})
+        finally:
+            for _ in batch:
+                _queue.task_done()
+
+def submit(job):
+    """Confier une écriture job(connection) au thread écrivain (exécutée dans une transaction groupée)"""
+    global _writer
+    if _writer is None:
+        with _lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_write_loop, name='document-index', daemon=True)
+                _writer.start()
+    _queue.put(job)
+
+def _submit(sql, params):
+    submit(lambda connection: connection.execute(sql, params))
+
+def flush():
+    """Attendre que toutes les écritures en attente soient enregistrées ; retourne le nombre d'écritures perdues depuis le dernier appel"""
+    global _failed
+    if _writer is not None:
+        _queue.join()
+    with _lock:
+        failed, _failed = _failed, 0
+    return failed
+
+atexit.register(flush)
+
+def index_document(kind, document, theme, output_format):
+    """Enregistrer un rendu dans l'index (sans attendre l'écriture)"""
+    date_limite = getattr(document, 'date_echeance', None) or getattr(document, 'date_expiration', '')
+    _submit(UPSERT_SQL, (
+        kind, document.numero, document.client_nom, document.client_siret,
+        document.date_emission, date_limite, iso_date(document.date_emission),
+        document.total_ht, document.total_tva, document.total_ttc,
+        getattr(document, 'statut_paiement', ''), theme, output_format, document.content_hash(),
+        datetime.now().isoformat(timespec='seconds'),
+    ))
+
+def index_status(numero, statut):
+    """Mettre à jour le statut de paiement d'une facture dans l'index"""
+    _submit(STATUT_SQL, (statut, datetime.now().isoformat(timespec='seconds'), numero))
+
+def encode_cursor(row):
+    return f"{row['date_tri']}~{row['id']}"
+
+def decode_cursor(cursor):
+    """Curseur 'date~id' de la page précédente ; lève ValueError s'il est invalide"""
+    date_tri, _, row_id = str(cursor).rpartition('~')
+    return date_tri, int(row_id)
+
+def search_documents(kind=None, client=None, siret=None, statut=None,
+                     date_min=None, date_max=None, cursor=None, limit=50):
+    """Lister les documents du plus récent au plus ancien, par pagination à curseur
+
+    Retourne (documents, curseur de la page suivante ou None).
+    """
+    clauses = []
+    params = []
+    if kind:
+        clauses.append('type = ?')
+        params.append(kind)
+    if client:
+        # Recherche par préfixe, servie par l'index sur client_nom
+        clauses.append('client_nom >= ? AND client_nom < ?')
+        params.extend([client, client + '\U0010ffff'])
+    if siret:
+        clauses.append('client_siret = ?')
+        params.append(siret)
+    if statut:
+        clauses.append('statut_paiement = ?')
+        params.append(statut)
+    if date_min:
+        clauses.append('date_tri >= ?')
+        params.append(date_min)
+    if date_max:
+        clauses.append('date_tri <= ?')
+        params.append(date_max)
+    if cursor:
+        date_tri, row_id = decode_cursor(cursor)
+        clauses.append('(date_tri < ? OR (date_tri = ? AND id < ?))')
+        params.extend([date_tri, date_tri, row_id])
+
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    sql = f"SELECT {', '.join(COLONNES)}, date_tri FROM documents"
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    sql += ' ORDER BY date_tri DESC, id DESC LIMIT ?'
+    params.append(limit + 1)
+
+    if not os.path.exists(INDEX_PATH):
+        return [], None
+    connection = connect()
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute(sql, params).fetchall()
+    except sqlite3.OperationalError:
+        # Index pas encore créé par le thread écrivain
+        return [], None
+    finally:
+        connection.close()
+
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return [{colonne: row[colonne] for colonne in COLONNES} for row in rows[:limit]], next_cursor
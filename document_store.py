@@ -0,0 +1,78 @@
+# document_store.py - Stockage local des devis et factures déjà calculés (JSON par document)
+import json
+import os
+import re
+from models import Devis, Facture
+
+DATA_FOLDER = os.environ.get('DATA_FOLDER', 'data')
+STORE_FOLDER = os.path.join(DATA_FOLDER, 'documents')
+
+MODELES = {
+    'devis': Devis,
+    'facture': Facture,
+}
+
+def _document_path(kind, numero):
+    # Le numéro vient de l'URL : ne garder que des caractères sûrs pour un nom de fichier
+    safe_numero = re.sub(r'[^A-Za-z0-9._-]', '_', str(numero))
+    return os.path.join(STORE_FOLDER, kind, f'{safe_numero}.json')
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+def _write_document(f, header, items):
+    """Objet JSON {champs de l'en-tête..., "items": [...]} écrit champ par champ puis article par article"""
+    f.write('{')
+    for key, value in header.items():
+        f.write(f'{_dumps(key)}: {_dumps(value)}, ')
+    f.write('"items": [')
+    for index, item in enumerate(items):
+        if index:
+            f.write(', ')
+        f.write(_dumps(vars(item)))
+    f.write(']}')
+
+def save_document(kind, document, theme='bleu'):
+    """Enregistrer le modèle calculé (articles et totaux) après un rendu"""
+    path = _document_path(kind, document.numero)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {k: v for k, v in vars(document).items() if k != 'items'}
+    data['_theme'] = theme
+
+    # Écriture atomique : un lecteur ne voit jamais un fichier à moitié écrit
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        # Articles écrits un par un : une grosse facture n'est jamais sérialisée d'un bloc
+        _write_document(f, data, document.items)
+    os.replace(tmp_path, path)
+    return path
+
+def load_document(kind, numero):
+    """Recharger un document stocké, ou None s'il n'existe pas"""
+    path = _document_path(kind, numero)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    data.pop('_theme', None)
+    return MODELES[kind].from_dict(data)
+
+def iter_documents(kind):
+    """Parcourir tous les documents stockés d'un type"""
+    folder = os.path.join(STORE_FOLDER, kind)
+    if not os.path.isdir(folder):
+        return
+    for name in sorted(os.listdir(folder)):
+        if name.endswith('.json'):
+            with open(os.path.join(folder, name), encoding='utf-8') as f:
+                data = json.load(f)
+            theme = data.pop('_theme', 'bleu')
+            yield MODELES[kind].from_dict(data), theme
+
+def stored_theme(kind, numero):
+    """Thème du dernier rendu d'un document stocké, ou None s'il n'existe pas"""
+    path = _document_path(kind, numero)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('_theme', 'bleu')
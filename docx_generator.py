@@ -5,43 +5,31 @@ from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.enum.table import WD_TABLE_ALIGNMENT
 from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
+import logging
 import os
-import requests
+import zipfile
+from copy import deepcopy
+from datetime import datetime
 from io import BytesIO
+from profiles import register_block_cache, block_cache_key
+from logos import get_logo_data
+from request_log import mark_stage
+from themes import compiled_theme, register_theme_compiler
 
-# Thèmes de couleurs pour DOCX (format RGB)
-THEMES_COULEURS_DOCX = {
-    'bleu': {
-        'principale': RGBColor(44, 62, 80),
-        'header_bg': "2d3436",
-        'accent': RGBColor(52, 152, 219)
-    },
-    'vert': {
-        'principale': RGBColor(39, 174, 96),
-        'header_bg': "1e8449", 
-        'accent': RGBColor(88, 214, 141)
-    },
-    'rouge': {
-        'principale': RGBColor(231, 76, 60),
-        'header_bg': "c0392b",
-        'accent': RGBColor(241, 148, 138)
-    },
-    'violet': {
-        'principale': RGBColor(155, 89, 182),
-        'header_bg': "8e44ad",
-        'accent': RGBColor(215, 189, 226)
-    },
-    'orange': {
-        'principale': RGBColor(230, 126, 34),
-        'header_bg': "d35400",
-        'accent': RGBColor(245, 176, 65)
-    },
-    'noir': {
-        'principale': RGBColor(44, 62, 80),
-        'header_bg': "2c3e50",
-        'accent': RGBColor(149, 165, 166)
+logger = logging.getLogger(__name__)
+
+# Date figée utilisée en mode déterministe (propriétés du document et entrées zip)
+DATE_DETERMINISTE = datetime(2000, 1, 1)
+
+def compile_docx_theme(hex_colors):
+    """Couleurs python-docx d'un thème (RGB des textes, hexadécimal des fonds de cellule)"""
+    return {
+        'principale': RGBColor.from_string(hex_colors['principale'][1:].upper()),
+        'header_bg': hex_colors['header_bg'][1:],
+        'accent': RGBColor.from_string(hex_colors['accent'][1:].upper()),
     }
-}
+
+register_theme_compiler('docx', compile_docx_theme)
 
 def set_cell_background(cell, color):
     """Définir la couleur de fond d'une cellule"""
@@ -49,17 +37,42 @@ def set_cell_background(cell, color):
     shading_elm.set(qn("w:fill"), color)
     cell._element.get_or_add_tcPr().append(shading_elm)
 
-def download_and_add_logo(doc, logo_url):
-    """Télécharger le logo et l'ajouter au document DOCX"""
-    if not logo_url:
+def save_document(doc, filename, deterministic=False):
+    """Sauvegarder le DOCX, avec une sortie identique octet par octet en mode déterministe"""
+    mark_stage('save')
+    if not deterministic:
+        doc.save(filename)
+        return
+    
+    # Propriétés du document figées (python-docx écrit sinon la date courante)
+    props = doc.core_properties
+    props.created = DATE_DETERMINISTE
+    props.modified = DATE_DETERMINISTE
+    props.last_printed = DATE_DETERMINISTE
+    props.last_modified_by = ''
+    props.revision = 1
+    
+    buffer = BytesIO()
+    doc.save(buffer)
+    
+    # Réécrire l'archive avec horodatages fixes et ordre stable des entrées
+    with zipfile.ZipFile(buffer) as source:
+        names = sorted(source.namelist(), key=lambda name: (name != '[Content_Types].xml', name))
+        with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as target:
+            for name in names:
+                info = zipfile.ZipInfo(name, date_time=DATE_DETERMINISTE.timetuple()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                target.writestr(info, source.read(name))
+
+def download_and_add_logo(doc, logo_url, logo_id=''):
+    """Charger le logo (registre local ou URL) et l'ajouter au document DOCX"""
+    if not logo_url and not logo_id:
         return None
     
     try:
-        # Télécharger l'image avec un timeout
-        response = requests.get(logo_url, timeout=10)
-        if response.status_code == 200:
-            img_data = BytesIO(response.content)
-            
+        img_data = get_logo_data(logo_url, logo_id)
+        if img_data is not None:
             # Créer un paragraphe pour le logo aligné à droite
             logo_paragraph = doc.add_paragraph()
             logo_paragraph.alignment = WD_ALIGN_PARAGRAPH.RIGHT
@@ -70,12 +83,12 @@ def download_and_add_logo(doc, logo_url):
             
             return logo_paragraph
     except Exception as e:
-        print(f"Erreur lors du téléchargement du logo: {e}")
+        logger.warning("Erreur lors du téléchargement du logo: %s", e, extra={'logo_url': logo_url, 'logo_id': logo_id})
         return None
     
     return None
 
-def create_header_with_logo_and_title(doc, logo_url, title):
+def create_header_with_logo_and_title(doc, logo_url, title, logo_id=''):
     """Créer l'en-tête avec titre à gauche et logo à droite"""
     # Créer un tableau invisible pour aligner titre (gauche) et logo (droite)
     header_table = doc.add_table(rows=1, cols=2)
@@ -101,16 +114,15 @@ def create_header_with_logo_and_title(doc, logo_url, title):
     logo_paragraph = logo_cell.paragraphs[0]
     logo_paragraph.alignment = WD_ALIGN_PARAGRAPH.RIGHT
     
-    # Télécharger et ajouter le logo
-    if logo_url:
+    # Charger et ajouter le logo
+    if logo_url or logo_id:
         try:
-            response = requests.get(logo_url, timeout=10)
-            if response.status_code == 200:
-                img_data = BytesIO(response.content)
+            img_data = get_logo_data(logo_url, logo_id)
+            if img_data is not None:
                 run = logo_paragraph.add_run()
                 run.add_picture(img_data, width=Inches(1.2))  # 1.2 pouces de largeur
         except Exception as e:
-            print(f"Erreur lors du téléchargement du logo: {e}")
+            logger.warning("Erreur lors du téléchargement du logo: %s", e, extra={'logo_url': logo_url, 'logo_id': logo_id})
     
     # Supprimer les bordures du tableau
     tbl = header_table._tbl
@@ -126,10 +138,73 @@ def create_header_with_logo_and_title(doc, logo_url, title):
     
     return header_table
 
-def generate_docx_devis(devis, theme='bleu'):
+# Blocs statiques des profils fournisseur : fragments XML recopiés d'un rendu à l'autre
+BLOCS_PROFILS_DOCX = register_block_cache({})
+
+def _body_children(body):
+    return [child for child in body if child.tag != qn('w:sectPr')]
+
+def add_profile_block(doc, document, theme, block, build):
+    """Ajouter un bloc de profil fournisseur : construit une fois, puis recopié au niveau XML"""
+    key = block_cache_key(document, theme, block)
+    body = doc.element.body
+    fragments = BLOCS_PROFILS_DOCX.get(key) if key else None
+    if fragments is not None:
+        for fragment in fragments:
+            if body.sectPr is not None:
+                body.sectPr.addprevious(deepcopy(fragment))
+            else:
+                body.append(deepcopy(fragment))
+        return
+    
+    before = len(_body_children(body))
+    build(doc, document)
+    if key:
+        BLOCS_PROFILS_DOCX[key] = [deepcopy(child) for child in _body_children(body)[before:]]
+
+def add_company_name(doc, document, couleurs):
+    """Nom de l'entreprise avec couleur du thème"""
+    company = doc.add_paragraph()
+    company.add_run(document.fournisseur_nom.upper()).bold = True
+    company.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+    company.runs[0].font.size = Pt(16)
+    company.runs[0].font.color.rgb = couleurs['principale']
+
+def add_emetteur(doc, document):
+    """Bloc émetteur (fournisseur)"""
+    doc.add_heading('ÉMETTEUR', level=2)
+    doc.add_paragraph(f'{document.fournisseur_nom}\n{document.fournisseur_adresse}\n{document.fournisseur_ville}')
+    doc.add_paragraph(f'Email: {document.fournisseur_email}\nTél: {document.fournisseur_telephone}\nSIRET: {document.fournisseur_siret}')
+
+def add_conditions(doc, document):
+    """Conditions de paiement et pénalités de retard"""
+    doc.add_heading('CONDITIONS DE PAIEMENT', level=2)
+    doc.add_paragraph(document.conditions_paiement)
+    if document.penalites_retard:
+        doc.add_paragraph(document.penalites_retard).runs[0].font.size = Pt(8)
+
+def add_bank_details(doc, document):
+    """Coordonnées bancaires"""
+    doc.add_heading('COORDONNÉES BANCAIRES', level=2)
+    bank_table = doc.add_table(rows=3, cols=2)
+    bank_table.style = 'Light Grid'
+    
+    bank_data = [
+        ('Banque:', document.banque_nom),
+        ('IBAN:', document.banque_iban),
+        ('BIC:', document.banque_bic)
+    ]
+    
+    for i, (label, value) in enumerate(bank_data):
+        bank_table.cell(i, 0).text = label
+        bank_table.cell(i, 1).text = value
+        bank_table.cell(i, 0).paragraphs[0].runs[0].bold = True
+
+def generate_docx_devis(devis, theme='bleu', deterministic=False):
     """Générer un DOCX de devis modifiable avec thème coloré et logo"""
+    mark_stage('flowables')
     # Récupérer les couleurs du thème
-    couleurs = THEMES_COULEURS_DOCX.get(theme, THEMES_COULEURS_DOCX['bleu'])
+    couleurs = compiled_theme(theme)['docx']
     
     filename = os.path.join('generated', f'devis_{devis.numero}_{theme}.docx')
     doc = Document()
@@ -140,15 +215,9 @@ def generate_docx_devis(devis, theme='bleu'):
     font.name = 'Arial'
     font.size = Pt(10)
     
-    # NOUVEAU: En-tête avec titre et logo
-    create_header_with_logo_and_title(doc, devis.logo_url, "DEVIS")
-    
     # Nom de l'entreprise avec couleur du thème
-    company = doc.add_paragraph()
-    company.add_run(devis.fournisseur_nom.upper()).bold = True
-    company.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    company.runs[0].font.size = Pt(16)
-    company.runs[0].font.color.rgb = couleurs['principale']
+    add_profile_block(doc, devis, theme, 'devis:entete',
+                      lambda doc, document: add_company_name(doc, document, couleurs))
     
     doc.add_paragraph()  # Espace
     
@@ -172,9 +241,7 @@ def generate_docx_devis(devis, theme='bleu'):
     doc.add_paragraph()  # Espace
     
     # Informations Fournisseur / Client
-    doc.add_heading('ÉMETTEUR', level=2)
-    doc.add_paragraph(f'{devis.fournisseur_nom}\n{devis.fournisseur_adresse}\n{devis.fournisseur_ville}')
-    doc.add_paragraph(f'Email: {devis.fournisseur_email}\nTél: {devis.fournisseur_telephone}\nSIRET: {devis.fournisseur_siret}')
+    add_profile_block(doc, devis, theme, 'devis:emetteur', add_emetteur)
     
     doc.add_heading('CLIENT', level=2)
     doc.add_paragraph(f'{devis.client_nom}\n{devis.client_adresse}\n{devis.client_ville}')
@@ -270,27 +337,12 @@ def generate_docx_devis(devis, theme='bleu'):
     doc.add_paragraph()  # Espace
     
     # Conditions de paiement
-    doc.add_heading('CONDITIONS DE PAIEMENT', level=2)
-    doc.add_paragraph(devis.conditions_paiement)
-    doc.add_paragraph(devis.penalites_retard).runs[0].font.size = Pt(8)
+    add_profile_block(doc, devis, theme, 'devis:conditions', add_conditions)
     
     doc.add_paragraph()  # Espace
     
     # Informations bancaires
-    doc.add_heading('COORDONNÉES BANCAIRES', level=2)
-    bank_table = doc.add_table(rows=3, cols=2)
-    bank_table.style = 'Light Grid'
-    
-    bank_data = [
-        ('Banque:', devis.banque_nom),
-        ('IBAN:', devis.banque_iban),
-        ('BIC:', devis.banque_bic)
-    ]
-    
-    for i, (label, value) in enumerate(bank_data):
-        bank_table.cell(i, 0).text = label
-        bank_table.cell(i, 1).text = value
-        bank_table.cell(i, 0).paragraphs[0].runs[0].bold = True
+    add_profile_block(doc, devis, theme, 'devis:banque', add_bank_details)
     
     # Texte de conclusion
     if devis.texte_conclusion:
@@ -304,14 +356,21 @@ def generate_docx_devis(devis, theme='bleu'):
     doc.add_paragraph('Date et signature:')
     doc.add_paragraph('_______________________')
     
+    # En-tête avec titre et logo, construit en dernier (le logo se télécharge pendant
+    # la construction du document) puis placé en tête du corps
+    mark_stage('logo')
+    header_table = create_header_with_logo_and_title(doc, devis.logo_url, "DEVIS", devis.logo_id)
+    doc.element.body.insert(0, header_table._tbl)
+    
     # Sauvegarder
-    doc.save(filename)
+    save_document(doc, filename, deterministic)
     return filename
 
-def generate_docx_facture(facture, theme='bleu'):
+def generate_docx_facture(facture, theme='bleu', deterministic=False):
     """Générer un DOCX de facture modifiable avec thème coloré et logo"""
+    mark_stage('flowables')
     # Récupérer les couleurs du thème
-    couleurs = THEMES_COULEURS_DOCX.get(theme, THEMES_COULEURS_DOCX['bleu'])
+    couleurs = compiled_theme(theme)['docx']
     
     filename = os.path.join('generated', f'facture_{facture.numero}_{theme}.docx')
     doc = Document()
@@ -322,15 +381,9 @@ def generate_docx_facture(facture, theme='bleu'):
     font.name = 'Arial'
     font.size = Pt(10)
     
-    # NOUVEAU: En-tête avec titre et logo
-    create_header_with_logo_and_title(doc, facture.logo_url, "FACTURE")
-    
     # Nom de l'entreprise avec couleur du thème
-    company = doc.add_paragraph()
-    company.add_run(facture.fournisseur_nom.upper()).bold = True
-    company.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    company.runs[0].font.size = Pt(16)
-    company.runs[0].font.color.rgb = couleurs['principale']
+    add_profile_block(doc, facture, theme, 'facture:entete',
+                      lambda doc, document: add_company_name(doc, document, couleurs))
     
     doc.add_paragraph()  # Espace
     
@@ -375,9 +428,7 @@ def generate_docx_facture(facture, theme='bleu'):
     doc.add_paragraph()  # Espace
     
     # Informations Fournisseur / Client
-    doc.add_heading('ÉMETTEUR', level=2)
-    doc.add_paragraph(f'{facture.fournisseur_nom}\n{facture.fournisseur_adresse}\n{facture.fournisseur_ville}')
-    doc.add_paragraph(f'Email: {facture.fournisseur_email}\nTél: {facture.fournisseur_telephone}\nSIRET: {facture.fournisseur_siret}')
+    add_profile_block(doc, facture, theme, 'facture:emetteur', add_emetteur)
     
     doc.add_heading('CLIENT', level=2)
     doc.add_paragraph(f'{facture.client_nom}\n{facture.client_adresse}\n{facture.client_ville}')
@@ -441,25 +492,10 @@ def generate_docx_facture(facture, theme='bleu'):
     
     # Conditions et informations bancaires
     doc.add_paragraph()
-    doc.add_heading('CONDITIONS DE PAIEMENT', level=2)
-    doc.add_paragraph(facture.conditions_paiement)
-    doc.add_paragraph(facture.penalites_retard).runs[0].font.size = Pt(8)
+    add_profile_block(doc, facture, theme, 'facture:conditions', add_conditions)
     
     doc.add_paragraph()
-    doc.add_heading('COORDONNÉES BANCAIRES', level=2)
-    bank_table = doc.add_table(rows=3, cols=2)
-    bank_table.style = 'Light Grid'
-    
-    bank_data = [
-        ('Banque:', facture.banque_nom),
-        ('IBAN:', facture.banque_iban),
-        ('BIC:', facture.banque_bic)
-    ]
-    
-    for i, (label, value) in enumerate(bank_data):
-        bank_table.cell(i, 0).text = label
-        bank_table.cell(i, 1).text = value
-        bank_table.cell(i, 0).paragraphs[0].runs[0].bold = True
+    add_profile_block(doc, facture, theme, 'facture:banque', add_bank_details)
     
     # Mentions légales
     doc.add_paragraph()
@@ -469,6 +505,12 @@ def generate_docx_facture(facture, theme='bleu'):
     legal.add_run('TVA sur les encaissements. En cas de retard de paiement, seront exigibles, conformément à l\'article L441-10 du code de commerce, une indemnité calculée sur la base de trois fois le taux de l\'intérêt légal en vigueur ainsi qu\'une indemnité forfaitaire pour frais de recouvrement de 40 euros.')
     legal.runs[1].font.size = Pt(8)
     
+    # En-tête avec titre et logo, construit en dernier (le logo se télécharge pendant
+    # la construction du document) puis placé en tête du corps
+    mark_stage('logo')
+    header_table = create_header_with_logo_and_title(doc, facture.logo_url, "FACTURE", facture.logo_id)
+    doc.element.body.insert(0, header_table._tbl)
+    
     # Sauvegarder
-    doc.save(filename)
+    save_document(doc, filename, deterministic)
     return filename
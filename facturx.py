@@ -0,0 +1,292 @@
+# facturx.py - XML Factur-X (CII, EN 16931) d'une facture calculée et pièce jointe du PDF
+import argparse
+import glob
+import os
+import re
+import sys
+from datetime import datetime
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
+from reportlab.pdfbase.pdfdoc import (PDFArray, PDFCatalog, PDFDictionary, PDFName, PDFStream,
+                                      PDFStreamFilterZCompress, PDFString)
+from models import round_amount, tva_breakdown
+from schema import PROFILS_FACTURX, SchemaError
+
+# Identifiant de la spécification (BT-24)
+GUIDELINES = {
+    'minimum': 'urn:factur-x.eu:1p0:minimum',
+    'basic': 'urn:cen.eu:en16931:2017#compliant#urn:factur-x.eu:1p0:basic',
+    'en16931': 'urn:cen.eu:en16931:2017',
+}
+# Niveau de chaque profil dans les noms des XSD officiels
+NIVEAUX_FACTURX = {'minimum': 'MINIMUM', 'basic': 'BASIC', 'en16931': 'EN16931'}
+
+FICHIER_FACTURX = 'factur-x.xml'
+DEVISE = 'EUR'
+# Pays des adresses sans code pays en fin de ville (« 75012 Paris, FR »)
+PAYS_PAR_DEFAUT = os.environ.get('FACTURX_PAYS', 'FR')
+
+# Dossier des XSD officiels (un sous-dossier ou un fichier par profil) pour la validation locale
+FACTURX_XSD_DIR = os.environ.get('FACTURX_XSD_DIR', '')
+
+NAMESPACES = (
+    ' xmlns:rsm="urn:un:unece:uncefact:data:standard:CrossIndustryInvoice:100"'
+    ' xmlns:qdt="urn:un:unece:uncefact:data:standard:QualifiedDataType:100"'
+    ' xmlns:ram="urn:un:unece:uncefact:data:standard:ReusableAggregateBusinessInformationEntity:100"'
+    ' xmlns:udt="urn:un:unece:uncefact:data:standard:UnqualifiedDataType:100"'
+)
+
+def _amount(value):
+    return round_amount(value)
+
+def _text(tag, value, **attributes):
+    attrs = ''.join(f' {name}={quoteattr(str(attr))}' for name, attr in attributes.items())
+    return f'<{tag}{attrs}>{escape(str(value))}</{tag}>'
+
+def _date(value, champ):
+    """Date du document ('jj/mm/aaaa' ou 'aaaa-mm-jj') au format 102 (aaaammjj)"""
+    for fmt in ('%d/%m/%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(str(value), fmt).strftime('%Y%m%d')
+        except ValueError:
+            continue
+    raise SchemaError({champ: "date jj/mm/aaaa attendue pour Factur-X"})
+
+def _date_time(tag, value, champ):
+    return f'<{tag}><udt:DateTimeString format="102">{_date(value, champ)}</udt:DateTimeString></{tag}>'
+
+def _siren(siret):
+    digits = re.sub(r'\D', '', siret or '')
+    return digits[:9] if len(digits) >= 9 else ''
+
+def _split_city(ville):
+    """« 75012 Paris, FR » : code postal, ville et code pays (chaînes vides si absents)"""
+    match = re.fullmatch(r'\s*(?:(\d{4,5})\s+)?(.*?)(?:\s*,\s*([A-Z]{2}))?\s*', ville or '')
+    return match.group(1) or '', match.group(2), match.group(3) or ''
+
+def _address(adresse, ville, country_only=False):
+    """Adresse postale : « 69001 Lyon, FR » est séparé en code postal, ville et pays"""
+    postcode, city, country = _split_city(ville)
+    parts = ['<ram:PostalTradeAddress>']
+    if not country_only:
+        if postcode:
+            parts.append(_text('ram:PostcodeCode', postcode))
+        if adresse:
+            parts.append(_text('ram:LineOne', adresse))
+        if city:
+            parts.append(_text('ram:CityName', city))
+    parts.append(_text('ram:CountryID', country or PAYS_PAR_DEFAUT))
+    parts.append('</ram:PostalTradeAddress>')
+    return ''.join(parts)
+
+def _party(tag, nom, siret, adresse, ville, email, tva, profile):
+    parts = [f'<{tag}>', _text('ram:Name', nom)]
+    siren = _siren(siret)
+    if siren:
+        parts.append(f'<ram:SpecifiedLegalOrganization>{_text("ram:ID", siren, schemeID="0002")}</ram:SpecifiedLegalOrganization>')
+    # MINIMUM : seul le pays du vendeur figure dans les adresses
+    if profile != 'minimum':
+        parts.append(_address(adresse, ville))
+    elif tag == 'ram:SellerTradeParty':
+        parts.append(_address(adresse, ville, country_only=True))
+    if profile == 'en16931' and email:
+        parts.append(f'<ram:URIUniversalCommunication>{_text("ram:URIID", email, schemeID="EM")}</ram:URIUniversalCommunication>')
+    if tva and (profile != 'minimum' or tag == 'ram:SellerTradeParty'):
+        parts.append(f'<ram:SpecifiedTaxRegistration>{_text("ram:ID", tva, schemeID="VA")}</ram:SpecifiedTaxRegistration>')
+    parts.append(f'</{tag}>')
+    return ''.join(parts)
+
+def _category(rate):
+    # Taux nul : catégorie Z (taux zéro) ; les exonérations demanderaient un motif
+    return 'S' if rate > 0 else 'Z'
+
+def _line(index, item):
+    rate = Decimal(str(item.tva_taux))
+    parts = [
+        '<ram:IncludedSupplyChainTradeLineItem>',
+        f'<ram:AssociatedDocumentLineDocument>{_text("ram:LineID", index)}</ram:AssociatedDocumentLineDocument>',
+        f'<ram:SpecifiedTradeProduct>{_text("ram:Name", item.description)}</ram:SpecifiedTradeProduct>',
+        '<ram:SpecifiedLineTradeAgreement><ram:NetPriceProductTradePrice>',
+        _text('ram:ChargeAmount', _amount(item.prix_unitaire)),
+        '</ram:NetPriceProductTradePrice></ram:SpecifiedLineTradeAgreement>',
+        f'<ram:SpecifiedLineTradeDelivery>{_text("ram:BilledQuantity", item.quantite, unitCode="C62")}</ram:SpecifiedLineTradeDelivery>',
+        '<ram:SpecifiedLineTradeSettlement>',
+        '<ram:ApplicableTradeTax><ram:TypeCode>VAT</ram:TypeCode>',
+        _text('ram:CategoryCode', _category(rate)),
+        _text('ram:RateApplicablePercent', rate),
+        '</ram:ApplicableTradeTax>',
+    ]
+    if item.remise > 0:
+        parts += [
+            '<ram:SpecifiedTradeAllowanceCharge>',
+            '<ram:ChargeIndicator><udt:Indicator>false</udt:Indicator></ram:ChargeIndicator>',
+            _text('ram:ActualAmount', _amount(item.remise)),
+            '<ram:Reason>Remise</ram:Reason>',
+            '</ram:SpecifiedTradeAllowanceCharge>',
+        ]
+    parts += [
+        '<ram:SpecifiedTradeSettlementLineMonetarySummation>',
+        _text('ram:LineTotalAmount', _amount(item.total_ht)),
+        '</ram:SpecifiedTradeSettlementLineMonetarySummation>',
+        '</ram:SpecifiedLineTradeSettlement>',
+        '</ram:IncludedSupplyChainTradeLineItem>',
+    ]
+    return ''.join(parts)
+
+def facturx_chunks(facture, profile='basic'):
+    """XML Factur-X produit en un seul passage sur les articles (fragments de texte)
+
+    Les totaux et la ventilation par taux sont ceux déjà calculés (et arrondis) sur la
+    facture : l'XML, le PDF et le DOCX portent les mêmes montants.
+    """
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield f'<rsm:CrossIndustryInvoice{NAMESPACES}>'
+    yield ('<rsm:ExchangedDocumentContext><ram:GuidelineSpecifiedDocumentContextParameter>'
+           f'{_text("ram:ID", GUIDELINES[profile])}'
+           '</ram:GuidelineSpecifiedDocumentContextParameter></rsm:ExchangedDocumentContext>')
+    yield ('<rsm:ExchangedDocument>'
+           f'{_text("ram:ID", facture.numero)}<ram:TypeCode>380</ram:TypeCode>'
+           f'{_date_time("ram:IssueDateTime", facture.date_emission, "date_emission")}'
+           '</rsm:ExchangedDocument>')
+    yield '<rsm:SupplyChainTradeTransaction>'
+
+    if profile != 'minimum':
+        for index, item in enumerate(facture.items, 1):
+            yield _line(index, item)
+
+    yield '<ram:ApplicableHeaderTradeAgreement>'
+    yield _party('ram:SellerTradeParty', facture.fournisseur_nom, facture.fournisseur_siret,
+                 facture.fournisseur_adresse, facture.fournisseur_ville, facture.fournisseur_email,
+                 getattr(facture, 'fournisseur_tva', ''), profile)
+    yield _party('ram:BuyerTradeParty', facture.client_nom, facture.client_siret,
+                 facture.client_adresse, facture.client_ville, facture.client_email,
+                 facture.client_tva, profile)
+    if facture.numero_commande:
+        yield f'<ram:BuyerOrderReferencedDocument>{_text("ram:IssuerAssignedID", facture.numero_commande)}</ram:BuyerOrderReferencedDocument>'
+    yield '</ram:ApplicableHeaderTradeAgreement>'
+    yield '<ram:ApplicableHeaderTradeDelivery/>'
+
+    yield '<ram:ApplicableHeaderTradeSettlement>'
+    yield _text('ram:InvoiceCurrencyCode', DEVISE)
+    # Factures stockées avant la ventilation par taux : la recalculer depuis les lignes
+    tva_par_taux = getattr(facture, 'tva_par_taux', None) or tva_breakdown(facture.items)
+    rates = sorted(tva_par_taux.items(), key=lambda rate: Decimal(rate[0]))
+    if profile != 'minimum':
+        if facture.banque_iban:
+            yield ('<ram:SpecifiedTradeSettlementPaymentMeans><ram:TypeCode>58</ram:TypeCode>'
+                   '<ram:PayeePartyCreditorFinancialAccount>'
+                   f'{_text("ram:IBANID", facture.banque_iban.replace(" ", ""))}'
+                   '</ram:PayeePartyCreditorFinancialAccount></ram:SpecifiedTradeSettlementPaymentMeans>')
+        for rate, line in rates:
+            yield ('<ram:ApplicableTradeTax>'
+                   f'{_text("ram:CalculatedAmount", _amount(line["tva"]))}<ram:TypeCode>VAT</ram:TypeCode>'
+                   f'{_text("ram:BasisAmount", _amount(line["base_ht"]))}'
+                   f'{_text("ram:CategoryCode", _category(Decimal(rate)))}'
+                   f'{_text("ram:RateApplicablePercent", rate)}'
+                   '</ram:ApplicableTradeTax>')
+        if facture.conditions_paiement or facture.date_echeance:
+            yield '<ram:SpecifiedTradePaymentTerms>'
+            if facture.conditions_paiement:
+                yield _text('ram:Description', facture.conditions_paiement)
+            if facture.date_echeance:
+                yield _date_time('ram:DueDateDateTime', facture.date_echeance, 'date_echeance')
+            yield '</ram:SpecifiedTradePaymentTerms>'
+
+    # Totaux enregistrés sur la facture (arrondis par calculate_totals), ceux imprimés sur le PDF
+    total_ht = _amount(facture.total_ht)
+    yield '<ram:SpecifiedTradeSettlementHeaderMonetarySummation>'
+    if profile != 'minimum':
+        yield _text('ram:LineTotalAmount', total_ht)
+    yield _text('ram:TaxBasisTotalAmount', total_ht)
+    yield _text('ram:TaxTotalAmount', _amount(facture.total_tva), currencyID=DEVISE)
+    yield _text('ram:GrandTotalAmount', _amount(facture.total_ttc))
+    yield _text('ram:DuePayableAmount', _amount(facture.total_ttc))
+    yield '</ram:SpecifiedTradeSettlementHeaderMonetarySummation>'
+    yield '</ram:ApplicableHeaderTradeSettlement>'
+    yield '</rsm:SupplyChainTradeTransaction>'
+    yield '</rsm:CrossIndustryInvoice>\n'
+
+def facturx_xml(facture, profile='basic'):
+    return ''.join(facturx_chunks(facture, profile)).encode('utf-8')
+
+def attach_facturx(canvas_obj, xml, profile):
+    """Joindre l'XML au PDF en cours d'écriture (fichier associé et /AF)
+
+    Appelé juste avant l'enregistrement du canvas : pas de second passage sur le PDF.
+    Ni identification PDF/A-3 ni niveau Factur-X dans des métadonnées XMP : polices non
+    incorporées (Helvetica standard) et pas d'OutputIntent, le PDF ne serait pas PDF/A-3 conforme.
+    """
+    document = canvas_obj._doc
+    embedded = PDFStream(PDFDictionary({
+        'Type': PDFName('EmbeddedFile'),
+        # Type MIME en nom PDF : PDFName n'échappe pas la barre oblique
+        'Subtype': '/text#2Fxml',
+        'Params': PDFDictionary({'Size': len(xml)}),
+    }), xml, filters=[PDFStreamFilterZCompress()])
+    embedded_ref = document.Reference(embedded)
+    filespec = document.Reference(PDFDictionary({
+        'Type': PDFName('Filespec'),
+        'F': PDFString(FICHIER_FACTURX),
+        'UF': PDFString(FICHIER_FACTURX),
+        'Desc': PDFString('Factur-X'),
+        # MINIMUM ne porte pas toute la facture : l'XML est une donnée, pas une alternative au PDF
+        'AFRelationship': PDFName('Data' if profile == 'minimum' else 'Alternative'),
+        'EF': PDFDictionary({'F': embedded_ref, 'UF': embedded_ref}),
+    }))
+
+    catalog = document.Catalog
+    catalog.Names = PDFDictionary({
+        'EmbeddedFiles': PDFDictionary({'Names': PDFArray([PDFString(FICHIER_FACTURX), filespec])}),
+    })
+    # /AF n'est pas une entrée connue du catalogue reportlab : l'ajouter à celles qu'il écrit
+    catalog.__NoDefault__ = PDFCatalog.__NoDefault__ + ['AF']
+    catalog.AF = PDFArray([filespec])
+
+def _schema_path(profile, xsd_dir):
+    """XSD du profil (Factur-X_MINIMUM.xsd, Factur-X_BASIC.xsd...) dans le dossier des schémas officiels"""
+    filename = f"Factur-X_{NIVEAUX_FACTURX[profile]}.xsd"
+    candidates = glob.glob(os.path.join(xsd_dir, '**', filename), recursive=True)
+    if not candidates:
+        raise FileNotFoundError(f"{filename} introuvable dans {xsd_dir}")
+    return candidates[0]
+
+def validate_xml(xml, profile, xsd_dir=FACTURX_XSD_DIR):
+    """Erreurs de validation de l'XML (liste vide si valide) ; XSD locaux si xsd_dir est renseigné"""
+    from lxml import etree
+    try:
+        tree = etree.fromstring(xml)
+    except etree.XMLSyntaxError as e:
+        return [str(e)]
+    if not xsd_dir:
+        return []
+    schema = etree.XMLSchema(etree.parse(_schema_path(profile, xsd_dir)))
+    if schema.validate(tree):
+        return []
+    return [f"ligne {error.line}: {error.message}" for error in schema.error_log]
+
+def main():
+    from document_store import load_document
+
+    parser = argparse.ArgumentParser(description="XML Factur-X d'une facture enregistrée et validation XSD locale")
+    parser.add_argument('numero', help="numéro de la facture enregistrée")
+    parser.add_argument('--profil', choices=PROFILS_FACTURX, default='basic')
+    parser.add_argument('--xsd-dir', default=FACTURX_XSD_DIR, help="dossier des XSD Factur-X officiels")
+    parser.add_argument('--output', help="écrire l'XML dans ce fichier")
+    options = parser.parse_args()
+
+    facture = load_document('facture', options.numero)
+    if facture is None:
+        parser.error(f"Facture {options.numero} introuvable")
+    xml = facturx_xml(facture, options.profil)
+    if options.output:
+        with open(options.output, 'wb') as f:
+            f.write(xml)
+    errors = validate_xml(xml, options.profil, options.xsd_dir)
+    for error in errors:
+        print(error, file=sys.stderr)
+    if not errors:
+        print("XML valide" + ("" if options.xsd_dir else " (bien formé ; XSD non fourni)"))
+    sys.exit(1 if errors else 0)
+
+if __name__ == '__main__':
+    main()
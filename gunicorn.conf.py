@@ -0,0 +1,118 @@
+# gunicorn.conf.py - Profil de production : workers, préchargement et recyclage des workers
+import gc
+import math
+import os
+import resource
+
+# --- Workers ---
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+def available_cpus():
+    """Cœurs réellement utilisables : affinité du processus bornée par le quota CPU du cgroup
+
+    os.cpu_count() donne les cœurs de l'hôte, pas la part allouée au conteneur (Railway...).
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # cgroup v2 (cpu.max : « quota période » ou « max ») puis cgroup v1
+    for quota_path, period_path in (('/sys/fs/cgroup/cpu.max', None),
+                                    ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us')):
+        try:
+            with open(quota_path) as f:
+                values = f.read().split()
+            if period_path:
+                with open(period_path) as f:
+                    values.append(f.read().strip())
+            quota, period = values[0], values[1]
+        except (OSError, IndexError):
+            continue
+        if quota not in ('max', '-1'):
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+        break
+    return cpus
+
+# Le rendu est limité par le CPU (GIL) : un processus par cœur alloué
+workers = int(os.environ.get('WEB_CONCURRENCY', available_cpus()))
+# Un thread par worker par défaut : sur 1 vCPU, 4 threads gthread ne font pas mieux que 1
+# (passages alternés de 20 s : 22,5 et 20,3 req/s contre 19,2 et 20,6 req/s, p99 plus long, threads
+# en concurrence pour le GIL) et aucun gain n'est mesuré sur plusieurs cœurs. Passer à
+# GUNICORN_THREADS > 1 seulement si le banc de charge le montre sur la machine cible :
+#   python -m loadtest --scenario "un_thread:GUNICORN_THREADS=1" \
+#                      --scenario "quatre_threads:GUNICORN_THREADS=4" --mix facture:1 --duration 30
+threads = int(os.environ.get('GUNICORN_THREADS', '1'))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread' if threads > 1 else 'sync')
+
+# Mise en page parallèle des très grosses factures : les workers occupent déjà les cœurs,
+# un pool par worker n'a que les cœurs restants (1 : morceaux mis en page sur place)
+os.environ.setdefault('PARALLEL_LAYOUT_WORKERS', str(max(1, available_cpus() // workers)))
+
+# Un emplacement de rendu par thread (file équitable de admission.py)
+os.environ.setdefault('RENDER_SLOTS', str(threads))
+
+# Logos distants et rendus déterministes en cache commun à tous les workers (shared_cache.py)
+os.environ.setdefault('CACHE_BACKEND', 'shared')
+
+# --- Délais (alignés sur le budget de rendu) ---
+
+# Attente maximale dans la file de rendu + rendu d'un très gros document
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+
+# --- Préchargement ---
+
+# L'application et ses caches sont chargés une fois dans le maître puis partagés
+# (copie à l'écriture) par les workers
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+# --- Recyclage ---
+
+# Les workers reportlab / python-docx grossissent avec le temps : redémarrage après N requêtes
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', '100'))
+# ... ou dès que la mémoire résidente dépasse ce seuil (en Mo)
+max_rss_mb = int(os.environ.get('GUNICORN_MAX_RSS_MB', '512'))
+
+# Journal d'accès écrit par l'application (JSON, durées par étape) : pas de doublon gunicorn
+accesslog = os.environ.get('GUNICORN_ACCESSLOG') or None
+
+def current_rss_mb():
+    """Mémoire résidente actuelle du processus (pic si /proc n'est pas disponible)"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def warm_caches():
+    """Rendre un document de démonstration dans le maître : polices, styles et modules chargés une fois"""
+    from models import Devis, DevisItem
+    from pdf_generator import generate_pdf_devis
+    from docx_generator import generate_docx_devis
+
+    devis = Devis('_prechauffage', '01/01/2000', '01/01/2000', 'Fournisseur', '', '', '', '',
+                  'Client', '', '', '', '')
+    devis.items = [DevisItem('Article', details=['Détail'], quantite=1, prix_unitaire=1, remise=0)]
+    devis.calculate_totals()
+    for generate in (generate_pdf_devis, generate_docx_devis):
+        filename = generate(devis)
+        os.remove(filename)
+
+def when_ready(server):
+    if preload_app:
+        try:
+            warm_caches()
+        except Exception as e:
+            server.log.warning(f"Préchauffage des caches impossible: {e}")
+        # Objets du maître exclus du ramasse-miettes : leurs pages restent partagées après le fork
+        gc.freeze()
+
+def post_request(worker, req, environ, resp):
+    rss = current_rss_mb()
+    if rss > max_rss_mb:
+        worker.log.info(f"Worker {worker.pid} : {rss:.0f} Mo > {max_rss_mb} Mo, redémarrage")
+        worker.alive = False
@@ -0,0 +1,100 @@
+# ingest.py - Lecture en flux des très grosses factures : en-tête JSON puis une ligne par article
+import csv
+import json
+import os
+from catalog import refresh_catalog, resolve_item
+from models import CompactItems
+from schema import ITEM_SCHEMA, SchemaError
+
+# Nombre maximal d'articles reçus en flux (le rendu reste borné par la taille d'une page)
+MAX_STREAM_ITEMS = int(os.environ.get('MAX_STREAM_ITEMS', '100000'))
+# Nombre d'erreurs rapportées avant d'interrompre la lecture
+MAX_LINE_ERRORS = 20
+
+# Types de contenu acceptés -> format des lignes d'articles
+FORMATS_FLUX = {
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'text/csv': 'csv',
+}
+
+# Colonnes numériques du CSV (les cellules sont des chaînes)
+COLONNES_NOMBRES = ['quantite', 'prix_unitaire', 'tva_taux', 'remise']
+
+def _decode(stream):
+    """Lignes du corps de la requête, décodées une à une"""
+    for line in stream:
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError:
+            raise SchemaError({'body': "encodage UTF-8 attendu"})
+
+def _ndjson_rows(lines, first_line):
+    for number, line in enumerate(lines, start=first_line):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+def _csv_rows(lines, first_line):
+    reader = csv.reader(lines)
+    columns = next(reader, None)
+    if not columns:
+        return
+    columns = [column.strip() for column in columns]
+    for number, values in enumerate(reader, start=first_line + 1):
+        if not any(values):
+            continue
+        row = {column: value for column, value in zip(columns, values) if value != ''}
+        for column in COLONNES_NOMBRES:
+            if column in row:
+                try:
+                    row[column] = float(row[column].replace(',', '.'))
+                except ValueError:
+                    pass  # laissé tel quel : le schéma signale l'erreur
+        if 'details' in row:
+            row['details'] = row['details'].split('|')
+        yield number, row
+
+def read_stream(stream, mimetype):
+    """Lire l'en-tête puis les articles ligne par ligne dans un stockage compact
+
+    Retourne (en-tête, articles) ; les erreurs sont signalées par numéro de ligne.
+    """
+    row_format = FORMATS_FLUX[mimetype]
+    lines = _decode(stream)
+
+    first = next(lines, '')
+    try:
+        header = json.loads(first)
+    except ValueError:
+        raise SchemaError({'ligne 1': "en-tête JSON attendu"})
+    if not isinstance(header, dict):
+        raise SchemaError({'ligne 1': "objet JSON attendu"})
+    if 'items' in header:
+        raise SchemaError({'ligne 1.items': "les articles suivent l'en-tête, une ligne par article"})
+
+    rows = _ndjson_rows(lines, 2) if row_format == 'ndjson' else _csv_rows(lines, 2)
+    refresh_catalog()
+    items = CompactItems()
+    errors = {}
+    for number, row in rows:
+        prefix = f'ligne {number}.'
+        if not isinstance(row, dict):
+            errors[prefix.rstrip('.')] = "objet JSON attendu"
+        elif len(items) >= MAX_STREAM_ITEMS:
+            errors[prefix.rstrip('.')] = f"{MAX_STREAM_ITEMS} articles maximum"
+        else:
+            before = len(errors)
+            item = ITEM_SCHEMA.validate(row, errors, prefix)
+            if len(errors) == before:
+                item = resolve_item(item, errors, prefix)
+            if len(errors) == before:
+                items.append(**item)
+        if len(errors) >= MAX_LINE_ERRORS:
+            break
+    if errors:
+        raise SchemaError(errors)
+    return header, items
@@ -0,0 +1 @@
+# loadtest - Banc de charge local : python -m loadtest --help
@@ -0,0 +1,74 @@
+# loadtest/__main__.py - python -m loadtest : comparer des profils gunicorn sous une charge réaliste
+import argparse
+import json
+from loadtest.logo_server import LogoServer, MODES_PANNE
+from loadtest.payloads import parse_mix
+from loadtest.runner import run_scenario
+
+COLONNES = ['scenario', 'debit_rps', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'erreurs_pct',
+            'refus_429', 'hits_rendu_pct', 'rss_maitre_mb', 'rss_workers_pic_mb', 'rss_workers_total_mb',
+            'requetes_logo']
+
+def parse_scenario(value):
+    """'gthread:GUNICORN_WORKER_CLASS=gthread,GUNICORN_THREADS=8' -> (nom, variables)"""
+    name, _, assignments = value.partition(':')
+    overrides = {}
+    for assignment in filter(None, assignments.split(',')):
+        key, _, setting = assignment.partition('=')
+        overrides[key.strip()] = setting.strip()
+    return name, overrides
+
+def parse_items(value):
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
+
+def print_table(summaries):
+    rows = [[str(summary[colonne]) for colonne in COLONNES] for summary in summaries]
+    widths = [max(len(colonne), *(len(row[index]) for row in rows)) for index, colonne in enumerate(COLONNES)]
+    print('  '.join(colonne.ljust(width) for colonne, width in zip(COLONNES, widths)))
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc de charge local (gunicorn + serveur de logos factice)")
+    parser.add_argument('--scenario', action='append', type=parse_scenario,
+                        help="NOM:VAR=VALEUR,... (répétable ; variables d'environnement du serveur)")
+    parser.add_argument('--duration', type=float, default=20, help="durée mesurée par scénario (s)")
+    parser.add_argument('--warmup', type=float, default=3, help="durée de préchauffage non mesurée (s)")
+    parser.add_argument('--rps', type=float, help="débit cible (boucle ouverte) ; sinon concurrence fixe")
+    parser.add_argument('--concurrency', type=int, default=8, help="clients simultanés (boucle fermée)")
+    parser.add_argument('--mix', default='devis:1,facture:1,docx:0',
+                        help="poids devis/facture et part de DOCX, ex. devis:1,facture:3,docx:0.2")
+    parser.add_argument('--items', type=parse_items, default=(1, 30), help="articles par document, ex. 1-30")
+    parser.add_argument('--distinct', type=int, default=0,
+                        help="rejouer N documents déterministes fixes (mesure des caches) ; 0 : tous différents")
+    parser.add_argument('--logo-urls', type=int, default=4,
+                        help="nombre d'URL de logo distinctes (0 : sans logo)")
+    parser.add_argument('--logo-latency-ms', type=float, default=50)
+    parser.add_argument('--logo-jitter-ms', type=float, default=0)
+    parser.add_argument('--logo-failure-rate', type=float, default=0.0)
+    parser.add_argument('--logo-failure-mode', choices=MODES_PANNE, default='error')
+    parser.add_argument('--port', type=int, default=8150)
+    parser.add_argument('--json', help="écrire les résultats dans ce fichier")
+    options = parser.parse_args()
+    options.weights, options.docx_share = parse_mix(options.mix)
+
+    scenarios = options.scenario or [('profil', {})]
+    logo_server = LogoServer(options.logo_latency_ms, options.logo_jitter_ms,
+                             options.logo_failure_rate, options.logo_failure_mode).start()
+    summaries = []
+    try:
+        for name, overrides in scenarios:
+            print(f"Scénario {name} {overrides or ''}...", flush=True)
+            summaries.append(run_scenario(name, overrides, options, logo_server, options.port))
+    finally:
+        logo_server.stop()
+
+    print()
+    print_table(summaries)
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as f:
+            json.dump(summaries, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
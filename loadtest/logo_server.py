@@ -0,0 +1,84 @@
+# loadtest/logo_server.py - Serveur de logos factice : latence et pannes configurables
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from PIL import Image as PILImage
+
+# Modes de panne : réponse normale, erreur HTTP 500, connexion coupée, réponse jamais envoyée
+MODES_PANNE = ['error', 'reset', 'hang']
+
+def _png(width=400, height=160):
+    output = BytesIO()
+    PILImage.new('RGB', (width, height), (52, 152, 219)).save(output, format='PNG')
+    return output.getvalue()
+
+class LogoServer:
+    """Serveur HTTP local servant un PNG après `latency_ms` (± jitter), avec un taux de pannes"""
+    def __init__(self, latency_ms=50, jitter_ms=0, failure_rate=0.0, failure_mode='error',
+                 host='127.0.0.1', port=0):
+        if failure_mode not in MODES_PANNE:
+            raise ValueError(f"Mode de panne inconnu : {failure_mode} ({', '.join(MODES_PANNE)})")
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.failure_mode = failure_mode
+        self.image = _png()
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def logo_url(self, index=0):
+        """URL d'un logo ; des index différents contournent le cache de logos de l'application"""
+        return f'{self.url}/logo/{index}.png'
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                    fail = random.random() < server.failure_rate
+                    if fail:
+                        server.failures += 1
+                delay = server.latency_ms + random.uniform(-server.jitter_ms, server.jitter_ms)
+                time.sleep(max(delay, 0) / 1000)
+                if fail and server.failure_mode == 'hang':
+                    time.sleep(60)
+                    return
+                if fail and server.failure_mode == 'reset':
+                    self.close_connection = True
+                    return
+                if fail:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(server.image)))
+                self.end_headers()
+                self.wfile.write(server.image)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='logo-stub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,65 @@
+# loadtest/payloads.py - Payloads de devis et de factures pour la charge
+import random
+
+CLIENTS = ['ACME SAS', 'Boulangerie Martin', 'Studio Lumière', 'Transports Bernard', 'Cabinet Roux']
+
+def _items(count):
+    return [{
+        'description': f'Prestation {index + 1}',
+        'details': ['Analyse', 'Mise en œuvre'] if index % 4 == 0 else [],
+        'quantite': random.randint(1, 10),
+        'prix_unitaire': round(random.uniform(10, 900), 2),
+        'tva_taux': random.choice([20, 20, 10, 5.5]),
+        'remise': 5 if index % 7 == 0 else 0,
+    } for index in range(count)]
+
+def make_payload(kind, items=(1, 30), output_format='pdf', logo_url='', theme=None):
+    """Payload aléatoire d'un devis ou d'une facture (nombre d'articles tiré dans `items`)"""
+    payload = {
+        'client_nom': random.choice(CLIENTS),
+        'client_adresse': '12 rue des Lilas',
+        'client_ville': '69001 Lyon',
+        'client_siret': '12345678900012',
+        'client_tva': 'FR12345678900',
+        'items': _items(random.randint(*items)),
+        'format': output_format,
+        'theme': theme or random.choice(['bleu', 'vert', 'rouge', 'violet', 'orange', 'noir']),
+    }
+    if logo_url:
+        payload['logo_url'] = logo_url
+    if kind == 'devis':
+        payload['texte_intro'] = 'Suite à notre échange, voici notre proposition.'
+    return payload
+
+def parse_mix(mix):
+    """'devis:1,facture:3,docx:0.2' -> poids par type de document et part de DOCX"""
+    weights = {'devis': 1.0, 'facture': 1.0}
+    docx_share = 0.0
+    for part in mix.split(','):
+        name, _, value = part.partition(':')
+        name = name.strip()
+        if name == 'docx':
+            docx_share = float(value)
+        elif name in weights:
+            weights[name] = float(value)
+        else:
+            raise ValueError(f"Élément de mélange inconnu : {name}")
+    return weights, docx_share
+
+def choose_request(weights, docx_share, logo_urls, items, pool=None):
+    """Tirer (chemin, payload) selon le mélange demandé, ou parmi un jeu de documents fixe"""
+    if pool:
+        return random.choice(pool)
+    kind = random.choices(list(weights), weights=list(weights.values()))[0]
+    output_format = 'docx' if random.random() < docx_share else 'pdf'
+    logo_url = random.choice(logo_urls) if logo_urls else ''
+    return f'/api/{kind}', make_payload(kind, items, output_format, logo_url)
+
+def make_pool(count, weights, docx_share, logo_urls, items):
+    """`count` documents déterministes renvoyés à l'identique : mesure du cache des rendus"""
+    pool = []
+    for index in range(count):
+        path, payload = choose_request(weights, docx_share, logo_urls, items)
+        payload.update({'numero': f'CHARGE-{index:05d}', 'deterministic': True})
+        pool.append((path, payload))
+    return pool
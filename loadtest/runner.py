@@ -0,0 +1,223 @@
+# loadtest/runner.py - Lancement de l'application sous gunicorn, injection de charge et mesures
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from loadtest.payloads import choose_request, make_pool
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+API_HEADERS = {
+    'X-API-Key-1': os.environ.get('API_KEY_1', 'your-secret-key-1-here'),
+    'X-API-Key-2': os.environ.get('API_KEY_2', 'your-secret-key-2-here'),
+}
+
+# Variables fixées pour la charge (surchargeables par scénario) : une seule clé API envoie
+# toute la charge, ses limites propres ne doivent pas fausser la mesure
+ENV_CHARGE = {
+    'RATE_LIMIT_PER_SECOND': '100000',
+    'RATE_LIMIT_BURST': '100000',
+    'MAX_CONCURRENT_RENDERS_PER_KEY': '1000',
+}
+
+def start_gunicorn(port, overrides, workdir):
+    """Démarrer gunicorn avec le profil du dépôt ; les données vont dans un dossier jetable
+
+    Le serveur tourne depuis le dépôt : send_file résout 'generated/' par rapport à l'application.
+    """
+    env = dict(os.environ, **ENV_CHARGE)
+    env.update(overrides)
+    env.update({
+        'PORT': str(port),
+        'DATA_FOLDER': os.path.join(workdir, 'data'),
+        'PYTHONPATH': REPO,
+    })
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'wb')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO, 'gunicorn.conf.py'), 'app:app'],
+        cwd=REPO, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn s'est arrêté (voir {log.name})")
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/health', timeout=1).status_code == 200:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("gunicorn ne répond pas sur /health")
+
+def stop_gunicorn(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def worker_pids(master_pid):
+    """Processus enfants du maître gunicorn (lus dans /proc)"""
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # Le nom du processus peut contenir des espaces : lire après la parenthèse fermante
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == master_pid:
+            pids.append(int(name))
+    return pids
+
+def rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+class RssSampler(threading.Thread):
+    """Relever la mémoire résidente du maître et de chaque worker pendant la charge"""
+    def __init__(self, master_pid, interval=0.5):
+        super().__init__(name='rss-sampler', daemon=True)
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peak = {}
+        self.last = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            for pid in [self.master_pid] + worker_pids(self.master_pid):
+                rss = rss_mb(pid)
+                if rss is not None:
+                    self.last[pid] = rss
+                    self.peak[pid] = max(rss, self.peak.get(pid, 0))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def _send(session_factory, base_url, weights, docx_share, logo_urls, items, pool, scheduled):
+    path, payload = choose_request(weights, docx_share, logo_urls, items, pool)
+    try:
+        response = session_factory().post(base_url + path, json=payload, headers=API_HEADERS, timeout=120)
+        status = response.status_code
+        error = None
+        cache = response.headers.get('X-Render-Cache')
+    except requests.RequestException as e:
+        status, error, cache = None, type(e).__name__, None
+    # Latence comptée depuis l'instant prévu : pas d'omission coordonnée en boucle ouverte
+    return time.monotonic() - scheduled, status, error, cache
+
+def run_load(base_url, duration, weights, docx_share, logo_urls, items, rps=None, concurrency=8, pool=None):
+    """Envoyer la charge pendant `duration` s : débit cible (boucle ouverte) ou concurrence fixe"""
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session
+
+    results = []
+    started = time.monotonic()
+    end = started + duration
+    if rps:
+        with ThreadPoolExecutor(max_workers=max(32, int(rps * 4))) as executor:
+            futures = []
+            index = 0
+            while True:
+                scheduled = started + index / rps
+                if scheduled >= end:
+                    break
+                time.sleep(max(0, scheduled - time.monotonic()))
+                futures.append(executor.submit(_send, session, base_url, weights, docx_share,
+                                               logo_urls, items, pool, scheduled))
+                index += 1
+            results = [future.result() for future in futures]
+    else:
+        lock = threading.Lock()
+
+        def loop():
+            while time.monotonic() < end:
+                result = _send(session, base_url, weights, docx_share, logo_urls, items, pool, time.monotonic())
+                with lock:
+                    results.append(result)
+
+        threads = [threading.Thread(target=loop) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return results, time.monotonic() - started
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summarize(results, elapsed):
+    latencies = sorted(latency * 1000 for latency, status, _, _ in results if status == 200)
+    total = len(results)
+    ok = len(latencies)
+    cacheable = [cache for _, _, _, cache in results if cache]
+    return {
+        'requetes': total,
+        'debit_rps': round(ok / elapsed, 2) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.50), 1),
+        'p90_ms': round(percentile(latencies, 0.90), 1),
+        'p99_ms': round(percentile(latencies, 0.99), 1),
+        'max_ms': round(latencies[-1], 1) if latencies else 0,
+        'erreurs_pct': round(100 * (total - ok) / total, 2) if total else 0,
+        'refus_429': sum(1 for _, status, _, _ in results if status == 429),
+        'exceptions': sum(1 for _, _, error, _ in results if error),
+        # Part des rendus déterministes servis par le cache (en-tête X-Render-Cache)
+        'hits_rendu_pct': round(100 * cacheable.count('hit') / len(cacheable), 1) if cacheable else 0,
+    }
+
+def run_scenario(name, overrides, options, logo_server, port):
+    """Un scénario complet : démarrage, préchauffage, charge, mesures, arrêt"""
+    generated = os.path.join(REPO, 'generated')
+    existing = set(os.listdir(generated)) if os.path.isdir(generated) else set()
+    with tempfile.TemporaryDirectory(prefix=f'loadtest-{name}-') as workdir:
+        process = start_gunicorn(port, overrides, workdir)
+        base_url = f'http://127.0.0.1:{port}'
+        logo_urls = [logo_server.logo_url(index) for index in range(options.logo_urls)]
+        pool = make_pool(options.distinct, options.weights, options.docx_share,
+                         logo_urls, options.items) if options.distinct else None
+        try:
+            # Quelques requêtes hors mesure (imports paresseux, premiers logos)
+            run_load(base_url, options.warmup, options.weights, options.docx_share,
+                     logo_urls, options.items, concurrency=2, pool=pool)
+            sampler = RssSampler(process.pid)
+            sampler.start()
+            logo_requests = logo_server.requests
+            results, elapsed = run_load(base_url, options.duration, options.weights, options.docx_share,
+                                        logo_urls, options.items, rps=options.rps,
+                                        concurrency=options.concurrency, pool=pool)
+            sampler.stop()
+        finally:
+            stop_gunicorn(process)
+            # Retirer les rendus produits par la charge (les fichiers déjà présents sont conservés)
+            for filename in set(os.listdir(generated)) - existing:
+                os.remove(os.path.join(generated, filename))
+
+    summary = summarize(results, elapsed)
+    summary['scenario'] = name
+    summary['rss_maitre_mb'] = round(sampler.peak.pop(process.pid, 0), 1)
+    summary['rss_workers_pic_mb'] = sorted(round(value, 1) for value in sampler.peak.values())
+    summary['rss_workers_total_mb'] = round(sum(sampler.peak.values()), 1)
+    summary['requetes_logo'] = logo_server.requests - logo_requests
+    return summary
@@ -0,0 +1,166 @@
+# logos.py - Registre local des logos (adressé par contenu) et chargement pour le rendu
+import hashlib
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from io import BytesIO
+import requests
+from PIL import Image as PILImage
+from shared_cache import make_cache
+
+DATA_FOLDER = os.environ.get('DATA_FOLDER', 'data')
+LOGOS_FOLDER = os.path.join(DATA_FOLDER, 'logos')
+
+# Taille maximale d'un logo normalisé (côté le plus long, en pixels)
+LOGO_MAX_PIXELS = 800
+# Taille maximale d'une image envoyée
+LOGO_MAX_UPLOAD = 5 * 1024 * 1024
+
+# Budget d'attente d'un logo distant, compté depuis le début du téléchargement (en ms)
+LOGO_FETCH_DEADLINE_MS = int(os.environ.get('LOGO_FETCH_DEADLINE_MS', '300'))
+# Logos distants gardés en cache : nombre (cache local) et taille totale en Mo (les deux backends)
+LOGO_CACHE_SIZE = int(os.environ.get('LOGO_CACHE_SIZE', '128'))
+LOGO_CACHE_MB = int(os.environ.get('LOGO_CACHE_MB', '32'))
+# Durée (en s) pendant laquelle un téléchargement en échec n'est pas retenté : les rendus
+# suivants partent aussitôt sans logo au lieu d'attendre à nouveau tout le budget
+LOGO_FAILURE_TTL_S = float(os.environ.get('LOGO_FAILURE_TTL_S', '60'))
+
+_lock = threading.Lock()
+
+# Logos distants : url -> contenu (local ou partagé entre workers, voir CACHE_BACKEND)
+# et téléchargements en cours : url -> (début, future)
+_url_cache = make_cache('logos', LOGO_CACHE_MB, LOGO_CACHE_SIZE)
+_inflight = {}
+# Échecs récents : url -> instant (monotonic) à partir duquel un nouvel essai est permis
+_failures = {}
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='logo-fetch')
+
+def _logo_path(logo_id):
+    return os.path.join(LOGOS_FOLDER, f'{logo_id}.png')
+
+def is_valid_logo_id(logo_id):
+    return bool(re.fullmatch(r'[0-9a-f]{64}', str(logo_id)))
+
+def logo_exists(logo_id):
+    return is_valid_logo_id(logo_id) and os.path.exists(_logo_path(logo_id))
+
+def register_logo(raw):
+    """Normaliser une image (PNG, taille bornée) et l'enregistrer sous l'empreinte de son contenu"""
+    if len(raw) > LOGO_MAX_UPLOAD:
+        raise ValueError("Image trop volumineuse (5 Mo maximum)")
+    try:
+        image = PILImage.open(BytesIO(raw))
+        image.load()
+    except Exception:
+        raise ValueError("Image illisible")
+
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or image.mode == 'P' else 'RGB')
+    image.thumbnail((LOGO_MAX_PIXELS, LOGO_MAX_PIXELS))
+
+    output = BytesIO()
+    image.save(output, format='PNG', optimize=True)
+    data = output.getvalue()
+    logo_id = hashlib.sha256(data).hexdigest()
+
+    path = _logo_path(logo_id)
+    if not os.path.exists(path):
+        os.makedirs(LOGOS_FOLDER, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return {'logo_id': logo_id, 'largeur': image.width, 'hauteur': image.height}
+
+@lru_cache(maxsize=LOGO_CACHE_SIZE)
+def _read_logo(logo_id):
+    """Contenu d'un logo enregistré, lu une fois (fichier adressé par contenu, donc immuable)"""
+    with open(_logo_path(logo_id), 'rb') as f:
+        return f.read()
+
+def load_logo(logo_id):
+    """Données d'un logo enregistré, sans copie par rendu
+
+    BytesIO sur un bytes partage le tampon tant qu'on n'y écrit pas : reportlab le garde
+    tel quel et python-docx en relit le même objet. Une projection mémoire serait recopiée
+    à chaque rendu (BytesIO(mmap), ou reportlab pour tout flux qui n'est pas un BytesIO).
+    """
+    if not logo_exists(logo_id):
+        return None
+    return BytesIO(_read_logo(logo_id))
+
+def _record_failure(logo_url):
+    now = time.monotonic()
+    with _lock:
+        # Échecs expirés oubliés : la table reste bornée par le nombre d'URL mortes récentes
+        if len(_failures) >= LOGO_CACHE_SIZE:
+            for url in [url for url, retry_at in _failures.items() if retry_at <= now]:
+                del _failures[url]
+        _failures[logo_url] = now + LOGO_FAILURE_TTL_S
+
+def _fetch(logo_url):
+    """Télécharger un logo distant et remplir le cache (exécuté en arrière-plan)"""
+    try:
+        response = requests.get(logo_url, timeout=10)
+        if response.status_code == 200:
+            _url_cache.put(logo_url, response.content)
+            return response.content
+        _record_failure(logo_url)
+        return None
+    except Exception:
+        _record_failure(logo_url)
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(logo_url, None)
+
+def logo_cached(logo_url):
+    """Logo distant déjà disponible sans téléchargement"""
+    return logo_url in _url_cache
+
+def prefetch_logo(logo_url):
+    """Lancer le téléchargement d'un logo dès la lecture de la requête, sans attendre"""
+    if not logo_url:
+        return None
+    with _lock:
+        if logo_url in _url_cache:
+            return None
+        if _failures.get(logo_url, 0) > time.monotonic():
+            return None
+        pending = _inflight.get(logo_url)
+        if pending is None:
+            pending = (time.monotonic(), _executor.submit(_fetch, logo_url))
+            _inflight[logo_url] = pending
+    return pending
+
+def get_logo_data(logo_url='', logo_id=''):
+    """Données du logo d'un document : registre local, cache, ou téléchargement borné par le budget
+
+    Si le logo distant n'est pas arrivé avant la fin du budget, le document est rendu
+    sans logo ; le téléchargement continue en arrière-plan pour la requête suivante.
+    Une URL en échec n'est pas retentée avant LOGO_FAILURE_TTL_S : rendu immédiat sans logo.
+    """
+    if logo_id:
+        return load_logo(logo_id)
+    if not logo_url:
+        return None
+
+    cached = _url_cache.get(logo_url)
+    if cached is not None:
+        return BytesIO(cached)
+
+    pending = prefetch_logo(logo_url)
+    if pending is None:
+        cached = _url_cache.get(logo_url)
+        return BytesIO(cached) if cached is not None else None
+
+    started, future = pending
+    remaining = started + LOGO_FETCH_DEADLINE_MS / 1000 - time.monotonic()
+    try:
+        content = future.result(timeout=max(remaining, 0))
+    except FutureTimeoutError:
+        return None
+    return BytesIO(content) if content is not None else None
@@ -0,0 +1,124 @@
+# memory_tracing.py - Mémoire allouée par étape de rendu (tracemalloc) et recherche de fuites
+import fnmatch
+import os
+import threading
+import tracemalloc
+from metrics import BUCKETS_KO, increment, observe, register_gauge
+
+# Activation explicite : tracemalloc ralentit chaque allocation, il reste coupé en production
+MEMORY_TRACING_ENABLED = os.environ.get('ENABLE_MEMORY_TRACING', '0').lower() in ('1', 'true', 'yes', 'oui')
+
+# Profondeur des piles conservées : une allocation faite dans reportlab ou python-docx
+# doit pouvoir être rattachée à la ligne des générateurs qui l'a provoquée
+MEMORY_TRACE_FRAMES = int(os.environ.get('MEMORY_TRACE_FRAMES', 16))
+
+# Un instantané toutes les N requêtes tracées, comparé à l'instantané de référence
+MEMORY_SNAPSHOT_EVERY = int(os.environ.get('MEMORY_SNAPSHOT_EVERY', 50))
+
+ETAPES = ['model', 'logo', 'flowables', 'build', 'save']
+
+# Fichiers dans lesquels les fuites sont localisées par défaut
+FICHIERS_SUIVIS = ['pdf_generator.py', 'docx_generator.py']
+
+# Étape en cours, propre à chaque thread de requête
+_state = threading.local()
+
+_lock = threading.Lock()
+_requests = 0
+_baseline = None
+_latest = None
+
+def memory_stage(name):
+    """Ouvrir l'étape `name` du rendu en cours (et clore la précédente)
+
+    Les étapes se succèdent sans s'imbriquer : le pic mesuré est celui de tracemalloc
+    depuis l'ouverture, remis à zéro à chaque changement d'étape. Le pic est global au
+    processus : les mesures sont exactes avec un seul rendu à la fois (un thread par worker).
+    """
+    if not MEMORY_TRACING_ENABLED:
+        return
+    _close_stage()
+    tracemalloc.reset_peak()
+    _state.stage = name
+    _state.start = tracemalloc.get_traced_memory()[0]
+
+def _close_stage():
+    stage = getattr(_state, 'stage', None)
+    if stage is None:
+        return False
+    current, peak = tracemalloc.get_traced_memory()
+    observe(f'memoire_{stage}_pic_ko', max(peak - _state.start, 0) / 1024, unit='ko', buckets=BUCKETS_KO)
+    observe(f'memoire_{stage}_retenue_ko', (current - _state.start) / 1024, unit='ko', buckets=BUCKETS_KO)
+    _state.stage = None
+    return True
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+
+def finish_request():
+    """Clore la dernière étape de la requête ; instantané périodique toutes les N requêtes tracées"""
+    global _requests, _baseline, _latest
+    if not MEMORY_TRACING_ENABLED or not _close_stage():
+        return
+    increment('memoire_requetes_tracees')
+    with _lock:
+        _requests += 1
+        if _baseline is None:
+            _baseline = _snapshot()
+        elif _requests % MEMORY_SNAPSHOT_EVERY == 0:
+            _latest = _snapshot()
+
+def reset_baseline():
+    """Nouvel instantané de référence ; la comparaison repart de la prochaine série de N requêtes"""
+    global _requests, _baseline, _latest
+    with _lock:
+        _requests = 0
+        _baseline = _snapshot()
+        _latest = None
+
+def _located_frame(traceback, files):
+    """Frame la plus récente de la pile qui appartient à l'un des fichiers suivis"""
+    for frame in reversed(traceback):
+        if any(fnmatch.fnmatch(os.path.basename(frame.filename), pattern) for pattern in files):
+            return frame
+    return None
+
+def leak_report(limit=20, files=FICHIERS_SUIVIS):
+    """Croissance de la mémoire entre l'instantané de référence et le dernier, par fichier et ligne"""
+    with _lock:
+        baseline, latest, requests = _baseline, _latest, _requests
+    report = {
+        'requetes_tracees': requests,
+        'instantane_toutes_les': MEMORY_SNAPSHOT_EVERY,
+        'memoire_tracee_ko': round(tracemalloc.get_traced_memory()[0] / 1024, 1),
+    }
+    if baseline is None or latest is None:
+        report['lignes'] = []
+        report['message'] = f"Pas encore de comparaison : {MEMORY_SNAPSHOT_EVERY} requêtes tracées sont nécessaires après la référence"
+        return report
+
+    growth = {}
+    for stat in latest.compare_to(baseline, 'traceback'):
+        frame = _located_frame(stat.traceback, files)
+        if frame is None:
+            continue
+        entry = growth.setdefault((frame.filename, frame.lineno), [0, 0])
+        entry[0] += stat.size_diff
+        entry[1] += stat.count_diff
+
+    rows = sorted(growth.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+    report['croissance_totale_ko'] = round(sum(size for size, _ in growth.values()) / 1024, 1)
+    report['lignes'] = [{
+        'fichier': os.path.basename(filename),
+        'ligne': lineno,
+        'croissance_ko': round(size / 1024, 1),
+        'blocs': count,
+    } for (filename, lineno), (size, count) in rows]
+    return report
+
+if MEMORY_TRACING_ENABLED:
+    tracemalloc.start(MEMORY_TRACE_FRAMES)
+    register_gauge('memoire_tracee_ko', lambda: round(tracemalloc.get_traced_memory()[0] / 1024, 1))
@@ -0,0 +1,54 @@
+# metrics.py - Compteurs et histogrammes en mémoire (par processus), exposés par /api/metrics
+import threading
+from collections import defaultdict
+
+# Bornes des histogrammes de durée (en millisecondes) et de mémoire (en Ko)
+BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+BUCKETS_KO = [16, 64, 256, 1024, 4096, 16384, 65536, 262144]
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+# nom -> {'unit', 'bounds', 'count', 'sum', 'max', 'buckets'}
+_histograms = {}
+# Valeurs instantanées calculées à la lecture : nom -> fonction
+_gauges = {}
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+def observe(name, value, unit='ms', buckets=BUCKETS_MS):
+    """Enregistrer une valeur (durée en ms par défaut) dans l'histogramme `name`"""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = {
+                'unit': unit, 'bounds': buckets,
+                'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * (len(buckets) + 1)}
+        histogram['count'] += 1
+        histogram['sum'] += value
+        histogram['max'] = max(histogram['max'], value)
+        bounds = histogram['bounds']
+        index = next((i for i, bound in enumerate(bounds) if value <= bound), len(bounds))
+        histogram['buckets'][index] += 1
+
+def register_gauge(name, read):
+    """Déclarer une valeur lue au moment de l'export (longueur de file, rendus en cours...)"""
+    _gauges[name] = read
+
+def snapshot():
+    """État courant de toutes les métriques, prêt à sérialiser en JSON"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {}
+        for name, histogram in _histograms.items():
+            unit = histogram['unit']
+            bounds = [str(bound) for bound in histogram['bounds']] + ['+inf']
+            histograms[name] = {
+                'count': histogram['count'],
+                f'avg_{unit}': round(histogram['sum'] / histogram['count'], 2),
+                f'max_{unit}': round(histogram['max'], 2),
+                f'buckets_{unit}': dict(zip(bounds, histogram['buckets'])),
+            }
+    gauges = {name: read() for name, read in _gauges.items()}
+    return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
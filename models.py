@@ -1,13 +1,158 @@
 # models.py
+import hashlib
+import json
+from array import array
+from decimal import Decimal, ROUND_HALF_UP
+
+CENT = Decimal('0.01')
+
+def _document_to_dict(document):
+    """Sérialiser un devis ou une facture (articles et totaux déjà calculés compris)"""
+    data = {k: v for k, v in vars(document).items() if k != 'items'}
+    data['items'] = [dict(vars(item)) for item in document.items]
+    return data
+
+def _document_from_dict(cls, data):
+    """Recréer un devis ou une facture sans recalculer les lignes ni les totaux"""
+    document = cls.__new__(cls)
+    document.__dict__.update({k: v for k, v in data.items() if k != 'items'})
+    document.items = [DevisItem.from_dict(item) for item in data.get('items', [])]
+    return document
+
+def _hash_document(document):
+    """Calculer une empreinte stable des données d'un devis ou d'une facture"""
+    # Articles hachés un par un : pas de copie complète des grosses factures
+    digest = hashlib.sha256()
+    header = {k: v for k, v in vars(document).items() if k != 'items'}
+    digest.update(json.dumps(header, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    for item in document.items:
+        digest.update(json.dumps(vars(item), sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
 class DevisItem:
-    def __init__(self, description, details=None, quantite=1, prix_unitaire=0, tva_taux=20, remise=0):
+    def __init__(self, description, details=None, quantite=1, prix_unitaire=0, tva_taux=20, remise=0, sku=None):
         self.description = description
         self.details = details or []
         self.quantite = quantite
         self.prix_unitaire = prix_unitaire
         self.tva_taux = tva_taux
         self.remise = remise
-        self.total_ht = (quantite * prix_unitaire) - remise
+        self.total_ht = line_total(quantite, prix_unitaire, remise)
+        # Référence catalogue : absente des articles saisis librement (empreinte inchangée)
+        if sku:
+            self.sku = sku
+    
+    @classmethod
+    def from_dict(cls, data):
+        """Recréer un article stocké en conservant son total HT déjà calculé"""
+        item = cls.__new__(cls)
+        item.__dict__.update(data)
+        return item
+
+def round_amount(value):
+    """Montant au centime, arrondi commercial (demi-centime vers le haut)"""
+    return Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+def line_total(quantite, prix_unitaire, remise):
+    """Total HT d'une ligne, arrondi au centime"""
+    return float(round_amount(quantite * prix_unitaire - remise))
+
+def rate_key(tva_taux):
+    """Clé d'un taux de TVA dans la ventilation ('20', '5.5')"""
+    return str(_number(float(tva_taux)))
+
+def _add_base(bases, tva_taux, total_ht):
+    key = rate_key(tva_taux)
+    bases[key] = bases.get(key, Decimal('0.00')) + round_amount(total_ht)
+
+def _breakdown(bases):
+    # TVA arrondie une fois par taux (EN 16931 : montant de TVA de chaque catégorie)
+    return {key: {'base_ht': float(base), 'tva': float(round_amount(base * Decimal(key) / 100))}
+            for key, base in bases.items()}
+
+def tva_breakdown(items):
+    """Base HT et TVA par taux, au centime : {'20': {'base_ht': ..., 'tva': ...}}"""
+    bases = {}
+    for item in items:
+        _add_base(bases, item.tva_taux, item.total_ht)
+    return _breakdown(bases)
+
+def breakdown_totals(breakdown):
+    """Totaux HT, TVA et TTC d'après la ventilation par taux (sommes exactes des montants arrondis)"""
+    total_ht = sum((round_amount(line['base_ht']) for line in breakdown.values()), Decimal('0.00'))
+    total_tva = sum((round_amount(line['tva']) for line in breakdown.values()), Decimal('0.00'))
+    return float(total_ht), float(total_tva), float(total_ht + total_tva)
+
+def _number(value):
+    # Les colonnes sont stockées en flottants : rendre les entiers tels qu'ils ont été reçus
+    return int(value) if value.is_integer() else value
+
+class CompactItems:
+    """Articles d'une très grosse facture stockés en colonnes, totaux cumulés à l'ajout
+
+    Les DevisItem ne sont recréés qu'au parcours, page par page : la mémoire reste
+    proportionnelle aux données brutes et non au nombre d'objets.
+    """
+    def __init__(self):
+        self.descriptions = []
+        self.details = []
+        self.skus = []
+        self.quantites = array('d')
+        self.prix_unitaires = array('d')
+        self.tva_taux = array('d')
+        self.remises = array('d')
+        # Bases HT par taux cumulées à l'ajout (Decimal : pas de dérive sur des milliers de lignes)
+        self._bases = {}
+    
+    def append(self, description, details=None, quantite=1, prix_unitaire=0, tva_taux=20, remise=0, sku=None):
+        self.descriptions.append(description)
+        # Détails gardés en une seule chaîne (None si absents)
+        self.details.append('\n'.join(details) if details else None)
+        self.skus.append(sku)
+        self.quantites.append(quantite)
+        self.prix_unitaires.append(prix_unitaire)
+        self.tva_taux.append(tva_taux)
+        self.remises.append(remise)
+        _add_base(self._bases, tva_taux, line_total(quantite, prix_unitaire, remise))
+    
+    @property
+    def tva_par_taux(self):
+        return _breakdown(self._bases)
+    
+    def __len__(self):
+        return len(self.descriptions)
+    
+    def __getitem__(self, index):
+        details = self.details[index]
+        return DevisItem(
+            self.descriptions[index],
+            details=details.split('\n') if details else [],
+            quantite=_number(self.quantites[index]),
+            prix_unitaire=_number(self.prix_unitaires[index]),
+            tva_taux=_number(self.tva_taux[index]),
+            remise=_number(self.remises[index]),
+            sku=self.skus[index]
+        )
+    
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+    
+    def pages(self, size):
+        """Parcourir les articles par lots de `size` (une page de tableau à la fois)"""
+        for start in range(0, len(self), size):
+            yield [self[index] for index in range(start, min(start + size, len(self)))]
+    
+    def slice(self, start, end):
+        """Articles [start, end) dans un nouveau stockage compact (sans les totaux, propres au document)"""
+        part = CompactItems()
+        for column in ('descriptions', 'details', 'skus', 'quantites', 'prix_unitaires', 'tva_taux', 'remises'):
+            setattr(part, column, getattr(self, column)[start:end])
+        return part
+    
+    def totals(self):
+        """Totaux HT, TVA et TTC cumulés pendant la lecture"""
+        return breakdown_totals(self.tva_par_taux)
 
 class Devis:
     def __init__(self, numero, date_emission, date_expiration, 
@@ -24,6 +169,8 @@ class Devis:
         self.fournisseur_ville = fournisseur_ville
         self.fournisseur_email = fournisseur_email
         self.fournisseur_siret = fournisseur_siret
+        self.fournisseur_telephone = kwargs.get('fournisseur_telephone', '')
+        self.fournisseur_tva = kwargs.get('fournisseur_tva', '')
         
         # Client
         self.client_nom = client_nom
@@ -32,9 +179,15 @@ class Devis:
         self.client_siret = client_siret
         self.client_tva = client_tva
         self.client_email = kwargs.get('client_email', '')
+        self.client_telephone = kwargs.get('client_telephone', '')
         
         # Logo de l'entreprise
         self.logo_url = kwargs.get('logo_url', '')
+        self.logo_id = kwargs.get('logo_id', '')
+        
+        # Profil fournisseur (version utilisée pour les blocs pré-rendus)
+        self.profile_id = kwargs.get('profile_id', '')
+        self.profile_version = kwargs.get('profile_version', '')
         
         # Autres champs
         self.banque_nom = kwargs.get('banque_nom', '')
@@ -49,11 +202,23 @@ class Devis:
         self.total_ht = 0
         self.total_tva = 0
         self.total_ttc = 0
+        self.tva_par_taux = {}
     
     def calculate_totals(self):
-        self.total_ht = sum(item.total_ht for item in self.items)
-        self.total_tva = sum((item.total_ht * item.tva_taux / 100) for item in self.items)
-        self.total_ttc = self.total_ht + self.total_tva
+        # Arrondis une fois (lignes, TVA par taux) : PDF, DOCX et Factur-X portent les mêmes montants
+        self.tva_par_taux = tva_breakdown(self.items)
+        self.total_ht, self.total_tva, self.total_ttc = breakdown_totals(self.tva_par_taux)
+    
+    def content_hash(self):
+        """Empreinte SHA-256 des données (utilisée par le mode déterministe)"""
+        return _hash_document(self)
+    
+    def to_dict(self):
+        return _document_to_dict(self)
+    
+    @classmethod
+    def from_dict(cls, data):
+        return _document_from_dict(cls, data)
 
 class Facture:
     def __init__(self, numero, date_emission, date_echeance,
@@ -70,6 +235,8 @@ class Facture:
         self.fournisseur_ville = fournisseur_ville
         self.fournisseur_email = fournisseur_email
         self.fournisseur_siret = fournisseur_siret
+        self.fournisseur_telephone = kwargs.get('fournisseur_telephone', '')
+        self.fournisseur_tva = kwargs.get('fournisseur_tva', '')
         
         # Client
         self.client_nom = client_nom
@@ -78,9 +245,15 @@ class Facture:
         self.client_siret = client_siret
         self.client_tva = client_tva
         self.client_email = kwargs.get('client_email', '')
+        self.client_telephone = kwargs.get('client_telephone', '')
         
         # Logo de l'entreprise
         self.logo_url = kwargs.get('logo_url', '')
+        self.logo_id = kwargs.get('logo_id', '')
+        
+        # Profil fournisseur (version utilisée pour les blocs pré-rendus)
+        self.profile_id = kwargs.get('profile_id', '')
+        self.profile_version = kwargs.get('profile_version', '')
         
         # Spécifique facture
         self.statut_paiement = kwargs.get('statut_paiement', 'En attente')
@@ -98,8 +271,48 @@ class Facture:
         self.total_ht = 0
         self.total_tva = 0
         self.total_ttc = 0
+        self.tva_par_taux = {}
     
     def calculate_totals(self):
-        self.total_ht = sum(item.total_ht for item in self.items)
-        self.total_tva = sum((item.total_ht * item.tva_taux / 100) for item in self.items)
-        self.total_ttc = self.total_ht + self.total_tva
+        # Arrondis une fois (lignes, TVA par taux) : PDF, DOCX et Factur-X portent les mêmes montants
+        self.tva_par_taux = tva_breakdown(self.items)
+        self.total_ht, self.total_tva, self.total_ttc = breakdown_totals(self.tva_par_taux)
+    
+    def content_hash(self):
+        """Empreinte SHA-256 des données (utilisée par le mode déterministe)"""
+        return _hash_document(self)
+    
+    def to_dict(self):
+        return _document_to_dict(self)
+    
+    @classmethod
+    def from_dict(cls, data):
+        return _document_from_dict(cls, data)
+
+# Champs communs recopiés d'un devis accepté vers sa facture
+CHAMPS_DEVIS_VERS_FACTURE = [
+    'fournisseur_nom', 'fournisseur_adresse', 'fournisseur_ville', 'fournisseur_email',
+    'fournisseur_siret', 'fournisseur_telephone', 'fournisseur_tva',
+    'client_nom', 'client_adresse', 'client_ville', 'client_siret', 'client_tva',
+    'client_email', 'client_telephone', 'logo_url', 'logo_id',
+    'banque_nom', 'banque_iban', 'banque_bic', 'penalites_retard',
+    # Profil fournisseur : la facture réutilise les blocs statiques pré-rendus du devis
+    'profile_id', 'profile_version',
+]
+
+def facture_from_devis(devis, numero, date_emission, date_echeance, **kwargs):
+    """Transformer un devis stocké en facture en réutilisant ses articles et ses totaux"""
+    champs = {champ: getattr(devis, champ, '') for champ in CHAMPS_DEVIS_VERS_FACTURE}
+    champs['conditions_paiement'] = devis.conditions_paiement
+    champs.update({k: v for k, v in kwargs.items() if v is not None})
+    champs.setdefault('reference_devis', devis.numero)
+    
+    facture = Facture(numero, date_emission, date_echeance, **champs)
+    # Les lignes sont déjà calculées : pas de nouveau calcul des totaux
+    facture.items = list(devis.items)
+    facture.total_ht = devis.total_ht
+    facture.total_tva = devis.total_tva
+    facture.total_ttc = devis.total_ttc
+    # Devis stockés avant la ventilation par taux : la recalculer depuis les lignes
+    facture.tva_par_taux = getattr(devis, 'tva_par_taux', None) or tva_breakdown(devis.items)
+    return facture
@@ -0,0 +1,128 @@
+# numbering.py - Numéros de devis et de factures séquentiels, partagés entre workers
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+from collections import deque
+from datetime import datetime
+
+DATA_FOLDER = os.environ.get('DATA_FOLDER', 'data')
+NUMBERING_PATH = os.path.join(DATA_FOLDER, 'numbering.sqlite3')
+
+# Numéros réservés d'un coup par chaque worker pour les devis (1 : ordre strictement chronologique)
+NUMBERING_BLOCK_SIZE = int(os.environ.get('NUMBERING_BLOCK_SIZE', '10'))
+# Préfixes numérotés un par un : factures chronologiques et sans trou, même avec plusieurs workers
+PREFIXES_CHRONOLOGIQUES = ('F',)
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS sequences (
+    nom TEXT PRIMARY KEY,
+    suivant INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS numeros_annules (
+    nom TEXT NOT NULL,
+    numero INTEGER NOT NULL,
+    annule_le TEXT NOT NULL,
+    PRIMARY KEY (nom, numero)
+);
+"""
+
+logger = logging.getLogger(__name__)
+
+# Blocs réservés par ce processus : nom de séquence -> numéros disponibles
+_blocks = {}
+_lock = threading.Lock()
+
+def _connect():
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    # isolation_level=None : transactions gérées explicitement (BEGIN IMMEDIATE)
+    connection = sqlite3.connect(NUMBERING_PATH, timeout=30, isolation_level=None)
+    connection.executescript(SCHEMA_SQL)
+    return connection
+
+def _reserve_block(nom, size):
+    """Réserver les `size` numéros suivants de la séquence"""
+    connection = _connect()
+    try:
+        # Verrou d'écriture exclusif entre processus le temps de la réservation
+        connection.execute('BEGIN IMMEDIATE')
+        row = connection.execute("SELECT suivant FROM sequences WHERE nom = ?", (nom,)).fetchone()
+        start = row[0] if row else 1
+        connection.execute(
+            "INSERT INTO sequences (nom, suivant) VALUES (?, ?) "
+            "ON CONFLICT (nom) DO UPDATE SET suivant = excluded.suivant",
+            (nom, start + size))
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+    return deque(range(start, start + size))
+
+def _give_back(nom, first, last):
+    """Rendre les numéros first..last à la séquence s'ils en sont les derniers distribués
+
+    Retourne False si un autre numéro a été réservé depuis : les rendre le ferait
+    réutiliser après lui et casserait l'ordre chronologique, ils sont alors annulés.
+    """
+    connection = _connect()
+    try:
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            rewound = connection.execute("UPDATE sequences SET suivant = ? WHERE nom = ? AND suivant = ?",
+                                         (first, nom, last + 1)).rowcount
+            if not rewound:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO numeros_annules (nom, numero, annule_le) VALUES (?, ?, ?)",
+                    [(nom, number, datetime.now().isoformat(timespec='seconds')) for number in range(first, last + 1)])
+    finally:
+        connection.close()
+    return bool(rewound)
+
+def next_numero(prefix):
+    """Prochain numéro de la séquence du préfixe pour l'année en cours (ex. F-2026-00042)
+
+    Devis : le plus souvent servi depuis le bloc réservé en mémoire, sans accès à la base.
+    """
+    year = datetime.now().year
+    nom = f'{prefix}-{year}'
+    size = 1 if prefix in PREFIXES_CHRONOLOGIQUES else NUMBERING_BLOCK_SIZE
+    with _lock:
+        block = _blocks.get(nom)
+        if not block:
+            block = _blocks[nom] = _reserve_block(nom, size)
+        number = block.popleft()
+    return f'{nom}-{number:05d}'
+
+def release_numero(numero):
+    """Rendre un numéro attribué par next_numero mais finalement inutilisé (rendu en échec)"""
+    nom, _, number = numero.rpartition('-')
+    number = int(number)
+    with _lock:
+        block = _blocks.get(nom)
+        # Numéro juste avant le reste du bloc en mémoire : il sera redonné en premier
+        if block and block[0] == number + 1:
+            block.appendleft(number)
+            return
+    if not _give_back(nom, number, number):
+        logger.warning("Numéro %s annulé : des numéros suivants sont déjà attribués", numero,
+                       extra={'numero': numero})
+
+def release_blocks():
+    """Rendre les numéros réservés mais non utilisés (seulement s'ils terminent la séquence)"""
+    with _lock:
+        unused = [(nom, block[0], block[-1]) for nom, block in _blocks.items() if block]
+        _blocks.clear()
+    for nom, first, last in unused:
+        _give_back(nom, first, last)
+
+def _forget_blocks():
+    # Un worker forké ne doit pas distribuer les numéros réservés par le processus parent
+    global _lock
+    _lock = threading.Lock()
+    _blocks.clear()
+
+atexit.register(release_blocks)
+os.register_at_fork(after_in_child=_forget_blocks)
@@ -0,0 +1,207 @@
+# parallel_layout.py - Mise en page des très grosses factures par morceaux de pages dans des processus séparés
+import multiprocessing
+import os
+import tempfile
+import threading
+import types
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from reportlab.lib import colors
+from reportlab.lib.units import cm
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.platypus import SimpleDocTemplate
+from pdf_generator import HAUTEUR_LIGNE_SIMPLE, ItemsRun, SegmentCanvas, estimate_item_height
+from pdf_tools import PDFFile, add_page_overlay, incremental_update, make_stream_object, merge_pdfs, pdf_string
+from request_log import mark_stage
+from themes import compiled_theme
+
+# Processus de mise en page par processus de l'application (1 ou moins : morceaux mis en page sur place) ;
+# plafonné par défaut, chaque worker gunicorn ayant son propre pool
+PARALLEL_LAYOUT_WORKERS = int(os.environ.get('PARALLEL_LAYOUT_WORKERS', min(os.cpu_count() or 1, 4)))
+# Nombre d'articles à partir duquel une facture est mise en page par morceaux (en parallèle si possible)
+PARALLEL_LAYOUT_MIN_ITEMS = int(os.environ.get('PARALLEL_LAYOUT_MIN_ITEMS', '5000'))
+# Pages estimées par morceau : le découpage ne dépend pas du nombre de processus (rendu déterministe stable)
+PARALLEL_LAYOUT_SEGMENT_PAGES = int(os.environ.get('PARALLEL_LAYOUT_SEGMENT_PAGES', '16'))
+
+# Marge intérieure des frames reportlab (haut, bas, gauche, droite)
+MARGE_FRAME = 6
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def segmented_layout(items):
+    """Mise en page par morceaux pour ces articles (décidée par leur seul nombre : même rendu sur tout hôte)"""
+    return len(items) >= PARALLEL_LAYOUT_MIN_ITEMS
+
+def _pool_enabled():
+    # Un processus de bulk.py ou recurring.py occupe déjà un cœur : pas de second niveau de processus
+    return PARALLEL_LAYOUT_WORKERS > 1 and multiprocessing.parent_process() is None
+
+def _layout_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Processus démarrés à neuf et gardés pour les factures suivantes (reportlab chargé une fois)
+            _executor = ProcessPoolExecutor(max_workers=PARALLEL_LAYOUT_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        _executor = None
+
+def _template_options(doc):
+    return {
+        'pagesize': doc.pagesize,
+        'leftMargin': doc.leftMargin,
+        'rightMargin': doc.rightMargin,
+        'topMargin': doc.topMargin,
+        'bottomMargin': doc.bottomMargin,
+        'invariant': doc.invariant,
+    }
+
+def render_segment(path, theme, items, carried, options):
+    """Mettre en page un morceau d'articles dans un processus de mise en page ; retourne son nombre de pages"""
+    doc = SimpleDocTemplate(path, **options)
+    doc.build([ItemsRun(items, 0, len(items), compiled_theme(theme)['pdf'], carried, True)],
+              canvasmaker=SegmentCanvas)
+    return doc.page
+
+def plan_pages(items, first_height, page_height):
+    """Premier article de chaque page d'après les hauteurs estimées des articles"""
+    starts = [0]
+    used = 0
+    budget = first_height
+    for index in range(len(items)):
+        height = estimate_item_height(items, index)
+        if used and used + height > budget:
+            starts.append(index)
+            used = 0
+            budget = page_height
+        used += height
+    return starts
+
+def plan_segments(items, head, width, height):
+    """Morceaux (début, fin) : la première page (après l'en-tête), les pages du milieu par lots, la dernière page"""
+    head_height = sum(flowable.wrap(width, height)[1] + flowable.getSpaceBefore() + flowable.getSpaceAfter()
+                      for flowable in head)
+    # En-tête du tableau et sous-total à reporter ; report en plus sur les pages suivantes
+    starts = plan_pages(items, height - head_height - 2 * HAUTEUR_LIGNE_SIMPLE, height - 3 * HAUTEUR_LIGNE_SIMPLE)
+    bounds = sorted({0, *starts[1:-1:PARALLEL_LAYOUT_SEGMENT_PAGES], starts[-1], len(items)})
+    return list(zip(bounds, bounds[1:]))
+
+def footer_objects(company_name, doc_number, page_num, total_pages, pagesize):
+    """Opérations du footer d'une page, identiques à SimpleCanvas.draw_footer"""
+    grey = b'%.4f %.4f %.4f rg' % colors.grey.rgb()
+    number = f"{doc_number} · {page_num}/{total_pages}"
+    x = pagesize[0] - 2*cm - stringWidth(number, "Helvetica", 9)
+    return b'\n'.join([
+        b'q ' + grey,
+        b'BT /FPied 9 Tf %.2f %.2f Td ' % (2*cm, 1.5*cm) + pdf_string(f"{company_name}, SAS") + b' Tj ET',
+        b'BT /FPied 9 Tf %.2f %.2f Td ' % (x, 1.5*cm) + pdf_string(number) + b' Tj ET',
+        b'Q',
+    ])
+
+def add_footers(filename, doc_info, pagesize):
+    """Footers « page N/total » de toutes les pages, en une mise à jour incrémentale du PDF assemblé"""
+    with open(filename, 'rb') as f:
+        pdf = PDFFile(f.read())
+    pages = pdf.pages()
+    font_num = pdf.size
+    content_num = font_num + 1
+    added = [
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+        # Même flux pour toutes les pages : /Pied désigne le formulaire propre à chaque page
+        make_stream_object(b'', b'q /Pied Do Q'),
+    ]
+    form_entries = (b'/Type /XObject /Subtype /Form /BBox [ 0 0 %.2f %.2f ]' % tuple(pagesize)
+                    + b' /Resources << /Font << /FPied %d 0 R >> >>' % font_num)
+    replaced = {}
+    for index, page in enumerate(pages):
+        form_num = font_num + len(added)
+        added.append(make_stream_object(form_entries, footer_objects(
+            doc_info.get('company_name', ''), doc_info.get('doc_number', ''), index + 1, len(pages), pagesize)))
+        replaced[page] = add_page_overlay(pdf.dictionary(page), b'Pied', form_num, content_num)
+
+    data = incremental_update(pdf, replaced, added)
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+def build_parallel(doc, elements, items, on_first_page, theme):
+    """Construire le PDF d'une très grosse facture : les pages d'articles sont mises en page par morceaux
+
+    La première page (avec l'en-tête) et la dernière (avec les totaux) sont mises en page ici
+    pendant que les processus traitent les morceaux du milieu (ici aussi, à la suite, sans pool) ;
+    les PDF des morceaux sont ensuite concaténés et les footers « page N/total » ajoutés une fois
+    le nombre total de pages connu. Chaque morceau commence par le report du sous-total HT des
+    articles précédents.
+    """
+    position = next(index for index, element in enumerate(elements) if isinstance(element, types.GeneratorType))
+    elements[position].close()
+    head, tail = elements[:position], elements[position + 1:]
+    options = _template_options(doc)
+    couleurs = compiled_theme(theme)['pdf']
+
+    segments = plan_segments(items, head, doc.width - 2 * MARGE_FRAME, doc.height - 2 * MARGE_FRAME)
+    # Sous-total HT avant chaque morceau, cumulé dans l'ordre des articles
+    carried = {}
+    subtotal = 0
+    starts = {start for start, _ in segments}
+    for index in range(len(items)):
+        if index in starts:
+            carried[index] = subtotal
+        subtotal += items[index].total_ht
+
+    folder = os.path.dirname(doc.filename) or '.'
+    with tempfile.TemporaryDirectory(prefix='.morceaux-', dir=folder) as tmp:
+        paths = [os.path.join(tmp, f'{index:05d}.pdf') for index in range(len(segments))]
+        middle = list(zip(paths[1:-1], segments[1:-1]))
+        futures = []
+        if middle and _pool_enabled():
+            executor = _layout_executor()
+            try:
+                futures = [executor.submit(render_segment, path, theme, items.slice(start, end), carried[start], options)
+                           for path, (start, end) in middle]
+            except BrokenProcessPool:
+                _reset_executor()
+                raise
+
+        # Première et dernière pages mises en page pendant ce temps
+        first_start, first_end = segments[0]
+        head_doc = SimpleDocTemplate(paths[0], **options)
+        if len(segments) == 1:
+            head_doc.build(head + [ItemsRun(items, first_start, first_end, couleurs)] + tail,
+                           canvasmaker=SegmentCanvas, onFirstPage=on_first_page)
+        else:
+            head_doc.build(head + [ItemsRun(items, first_start, first_end, couleurs, None, True)],
+                           canvasmaker=SegmentCanvas, onFirstPage=on_first_page)
+            last_start, last_end = segments[-1]
+            tail_doc = SimpleDocTemplate(paths[-1], **options)
+            tail_doc.build([ItemsRun(items, last_start, last_end, couleurs, carried[last_start])] + tail,
+                           canvasmaker=SegmentCanvas)
+
+        if not futures:
+            for path, (start, end) in middle:
+                render_segment(path, theme, items.slice(start, end), carried[start], options)
+        try:
+            for future in futures:
+                future.result()
+        except BrokenProcessPool:
+            # Un processus a disparu (mémoire) : le prochain rendu repart d'un pool neuf
+            _reset_executor()
+            raise
+
+        mark_stage('save')
+        with open(doc.filename, 'wb') as f:
+            for chunk in merge_pdfs(paths, keep_catalog=True):
+                f.write(chunk)
+    add_footers(doc.filename, head_doc.canv.doc_info, options['pagesize'])
+
+def _forget_executor():
+    # Les processus du pool appartiennent au parent : un processus forké en recrée un au besoin
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_executor)
@@ -1,60 +1,27 @@
 # pdf_generator.py - Version avec design professionnel, thèmes colorés et support logo
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, HRFlowable, Image
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, HRFlowable, Image, Flowable
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import cm, mm
 from reportlab.pdfgen import canvas
 from reportlab.lib.enums import TA_RIGHT, TA_CENTER, TA_JUSTIFY, TA_LEFT
+from reportlab.pdfbase.pdfmetrics import stringWidth
+import logging
+import math
 import os
-import requests
-from io import BytesIO
-
-# Thèmes de couleurs disponibles
-THEMES_COULEURS = {
-    'bleu': {
-        'principale': colors.HexColor('#2c3e50'),
-        'secondaire': colors.HexColor('#34495e'), 
-        'accent': colors.HexColor('#3498db'),
-        'fond': colors.HexColor('#ecf0f1'),
-        'header_bg': colors.HexColor('#2d3436')
-    },
-    'vert': {
-        'principale': colors.HexColor('#27ae60'),
-        'secondaire': colors.HexColor('#2d5016'), 
-        'accent': colors.HexColor('#58d68d'),
-        'fond': colors.HexColor('#e8f8f5'),
-        'header_bg': colors.HexColor('#1e8449')
-    },
-    'rouge': {
-        'principale': colors.HexColor('#e74c3c'),
-        'secondaire': colors.HexColor('#922b21'), 
-        'accent': colors.HexColor('#f1948a'),
-        'fond': colors.HexColor('#fadbd8'),
-        'header_bg': colors.HexColor('#c0392b')
-    },
-    'violet': {
-        'principale': colors.HexColor('#9b59b6'),
-        'secondaire': colors.HexColor('#6c3483'), 
-        'accent': colors.HexColor('#d7bde2'),
-        'fond': colors.HexColor('#f4ecf7'),
-        'header_bg': colors.HexColor('#8e44ad')
-    },
-    'orange': {
-        'principale': colors.HexColor('#e67e22'),
-        'secondaire': colors.HexColor('#a04000'), 
-        'accent': colors.HexColor('#f5b041'),
-        'fond': colors.HexColor('#fdeaa7'),
-        'header_bg': colors.HexColor('#d35400')
-    },
-    'noir': {
-        'principale': colors.HexColor('#2c3e50'),
-        'secondaire': colors.HexColor('#34495e'), 
-        'accent': colors.HexColor('#95a5a6'),
-        'fond': colors.HexColor('#ecf0f1'),
-        'header_bg': colors.HexColor('#2c3e50')
-    }
-}
+import threading
+import types
+from collections import OrderedDict, deque
+from models import CompactItems
+from profiles import register_block_cache, block_cache_key
+from logos import get_logo_data
+from request_log import mark_stage
+from themes import compiled_theme, register_theme_compiler
+from facturx import attach_facturx, facturx_xml
+from catalog import catalog_detail_key
+
+logger = logging.getLogger(__name__)
 
 # Couleurs par défaut (pour compatibilité)
 COULEUR_PRINCIPALE = colors.HexColor('#2c3e50')
@@ -63,6 +30,20 @@ COULEUR_ACCENT = colors.HexColor('#3498db')
 COULEUR_FOND = colors.HexColor('#ecf0f1')
 COULEUR_TEXTE = colors.HexColor('#2c3e50')
 
+# Blocs statiques des profils fournisseur : fragments de Paragraph déjà analysés
+BLOCS_PROFILS_PDF = register_block_cache({})
+
+def profile_paragraph(document, theme, block, text, style):
+    """Paragraph d'un bloc de profil fournisseur : le balisage n'est analysé qu'une fois par version"""
+    key = block_cache_key(document, theme, block)
+    frags = BLOCS_PROFILS_PDF.get(key) if key else None
+    if frags is not None:
+        return Paragraph(text, style, frags=frags)
+    paragraph = Paragraph(text, style)
+    if key:
+        BLOCS_PROFILS_PDF[key] = paragraph.frags
+    return paragraph
+
 class SimpleCanvas(canvas.Canvas):
     """Canvas simple pour ajouter le footer personnalisé"""
     def __init__(self, *args, **kwargs):
@@ -75,6 +56,14 @@ class SimpleCanvas(canvas.Canvas):
         self._startPage()
 
     def save(self):
+        mark_stage('save')
+        # Mode déterministe : l'identifiant du PDF dérive de l'empreinte des données
+        content_hash = self.doc_info.get('content_hash')
+        if content_hash:
+            self._doc.updateSignature(content_hash)
+        facturx = self.doc_info.get('facturx')
+        if facturx:
+            attach_facturx(self, *facturx)
         num_pages = len(self._saved_page_states)
         for idx, state in enumerate(self._saved_page_states):
             self.__dict__.update(state)
@@ -100,16 +89,83 @@ class SimpleCanvas(canvas.Canvas):
         
         self.restoreState()
 
-def download_logo(logo_url):
-    """Télécharger et traiter le logo depuis une URL"""
-    if not logo_url:
+class StreamingCanvas(SimpleCanvas):
+    """Canvas des très grosses factures : footer dessiné à chaque page, sans garder l'état des pages
+
+    Le nombre total de pages est un XObject référencé sur chaque page et rempli à l'enregistrement.
+    """
+    # Place réservée au nombre total de pages (chiffres Helvetica à chasse fixe)
+    TOTAL_DIGITS = 5
+
+    def showPage(self):
+        self.draw_footer(self.getPageNumber(), None)
+        canvas.Canvas.showPage(self)
+
+    def save(self):
+        mark_stage('save')
+        content_hash = self.doc_info.get('content_hash')
+        if content_hash:
+            self._doc.updateSignature(content_hash)
+        facturx = self.doc_info.get('facturx')
+        if facturx:
+            attach_facturx(self, *facturx)
+        self.beginForm('total_pages')
+        self.setFont("Helvetica", 9)
+        self.setFillColor(colors.grey)
+        self.drawString(0, 0, str(self.getPageNumber() - 1))
+        self.endForm()
+        canvas.Canvas.save(self)
+
+    def draw_footer(self, page_num, total_pages):
+        self.saveState()
+        self.setFont("Helvetica", 9)
+        self.setFillColor(colors.grey)
+        self.drawString(2*cm, 1.5*cm, f"{self.doc_info.get('company_name', '')}, SAS")
+        
+        total_x = A4[0] - 2*cm - stringWidth('0' * self.TOTAL_DIGITS, "Helvetica", 9)
+        self.drawRightString(total_x, 1.5*cm, f"{self.doc_info.get('doc_number', '')} · {page_num}/")
+        self.translate(total_x, 1.5*cm)
+        self.doForm('total_pages')
+        self.restoreState()
+
+class LazyFlowables(list):
+    """Liste de flowables dont les générateurs ne sont déroulés qu'au fil de la mise en page
+
+    doc.build consomme la liste par la tête : seuls les tableaux de la page en cours existent.
+    """
+    def __init__(self, flowables):
+        list.__init__(self)
+        self._pending = deque(flowables)
+
+    def _fill(self, count):
+        while list.__len__(self) < count and self._pending:
+            head = self._pending[0]
+            if isinstance(head, types.GeneratorType):
+                flowable = next(head, None)
+                if flowable is None:
+                    self._pending.popleft()
+                else:
+                    self.append(flowable)
+            else:
+                self.append(self._pending.popleft())
+
+    def __len__(self):
+        self._fill(1)
+        return list.__len__(self)
+
+    def __getitem__(self, index):
+        if isinstance(index, int) and index >= 0:
+            self._fill(index + 1)
+        return list.__getitem__(self, index)
+
+def download_logo(logo_url, logo_id=''):
+    """Charger le logo (registre local ou URL) et le dimensionner"""
+    if not logo_url and not logo_id:
         return None
     
     try:
-        # Télécharger l'image avec un timeout
-        response = requests.get(logo_url, timeout=10)
-        if response.status_code == 200:
-            img_data = BytesIO(response.content)
+        img_data = get_logo_data(logo_url, logo_id)
+        if img_data is not None:
             logo = Image(img_data)
             
             # Redimensionner le logo (hauteur max 2.5cm)
@@ -125,14 +181,14 @@ def download_logo(logo_url):
             
             return logo
     except Exception as e:
-        print(f"Erreur lors du téléchargement du logo: {e}")
+        logger.warning("Erreur lors du téléchargement du logo: %s", e, extra={'logo_url': logo_url, 'logo_id': logo_id})
         return None
     
     return None
 
-def create_header_with_logo(logo_url, title, title_size=18):
+def create_header_with_logo(logo_url, title, title_size=18, logo_id=''):
     """Créer l'en-tête avec logo et titre"""
-    logo = download_logo(logo_url)
+    logo = download_logo(logo_url, logo_id)
     
     title_paragraph = Paragraph(title, ParagraphStyle('Title', 
         fontSize=title_size, textColor=colors.black, fontName='Helvetica-Bold', leftIndent=0))
@@ -204,29 +260,338 @@ def create_styles(couleurs):
     
     return styles
 
-def generate_pdf_devis(devis, theme='bleu'):
+def items_table_style(couleurs):
+    """Commandes de style du tableau des articles (en-tête à la couleur du thème)"""
+    return [
+        # En-tête avec couleur du thème
+        ('BACKGROUND', (0, 0), (-1, 0), couleurs['header_bg']),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 10),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 10),
+        ('TOPPADDING', (0, 0), (-1, 0), 10),
+    
+        # Corps du tableau
+        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 1), (-1, -1), 9),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    
+        # Alignements
+        ('ALIGN', (1, 1), (1, -1), 'CENTER'),
+        ('ALIGN', (2, 1), (2, -1), 'RIGHT'),
+        ('ALIGN', (3, 1), (3, -1), 'CENTER'),
+        ('ALIGN', (4, 1), (4, -1), 'RIGHT'),
+    
+        # Bordures grises fines
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#b2bec3')),
+    
+        # Padding
+        ('LEFTPADDING', (0, 0), (-1, -1), 8),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 8),
+        ('TOPPADDING', (0, 1), (-1, -1), 10),
+        ('BOTTOMPADDING', (0, 1), (-1, -1), 10),
+    ]
+
+# Détails des produits du catalogue : fragments de Paragraph analysés une fois par version de produit
+# (le style des détails ne dépend pas du thème)
+CATALOG_FRAGMENT_CACHE_SIZE = int(os.environ.get('CATALOG_FRAGMENT_CACHE_SIZE', '4096'))
+DETAILS_CATALOGUE_PDF = OrderedDict()
+_details_lock = threading.Lock()
+
+STYLE_DETAILS_ARTICLE = ParagraphStyle('DetailStyle', fontSize=9, textColor=colors.black, leftIndent=0)
+
+def details_paragraph(item):
+    """Paragraph des détails d'un article : balisage réutilisé pour un produit du catalogue"""
+    detail_text = "<br/>".join(item.details)
+    key = catalog_detail_key(item)
+    frags = DETAILS_CATALOGUE_PDF.get(key) if key else None
+    if frags is not None:
+        return Paragraph(detail_text, STYLE_DETAILS_ARTICLE, frags=frags)
+    paragraph = Paragraph(detail_text, STYLE_DETAILS_ARTICLE)
+    if key:
+        with _details_lock:
+            DETAILS_CATALOGUE_PDF[key] = paragraph.frags
+            while len(DETAILS_CATALOGUE_PDF) > CATALOG_FRAGMENT_CACHE_SIZE:
+                DETAILS_CATALOGUE_PDF.popitem(last=False)
+    return paragraph
+
+# Largeurs des colonnes du tableau des articles - largeurs exactes du modèle
+LARGEURS_COLONNES_ARTICLES = [8.5*cm, 2*cm, 3*cm, 2.5*cm, 2.5*cm]
+
+# Styles des cellules d'articles
+STYLE_ARTICLE_DESCRIPTION = ParagraphStyle('ItemDesc', fontSize=9, textColor=colors.black)
+STYLE_ARTICLE_CENTRE = ParagraphStyle('ItemCenter', fontSize=9, textColor=colors.black, 
+                                      alignment=TA_CENTER)
+STYLE_ARTICLE_DROITE = ParagraphStyle('ItemRight', fontSize=9, textColor=colors.black, 
+                                      alignment=TA_RIGHT)
+
+def items_table_header():
+    """En-tête du tableau des articles (texte blanc sur la couleur du thème)"""
+    return [
+        Paragraph("<b>Description</b>", ParagraphStyle('TableHeader', 
+            textColor=colors.white, fontSize=10, fontName='Helvetica-Bold')),
+        Paragraph("<b>Qté</b>", ParagraphStyle('TableHeader', 
+            textColor=colors.white, fontSize=10, alignment=TA_CENTER, fontName='Helvetica-Bold')),
+        Paragraph("<b>Prix unitaire</b>", ParagraphStyle('TableHeader', 
+            textColor=colors.white, fontSize=10, alignment=TA_CENTER, fontName='Helvetica-Bold')),
+        Paragraph("<b>TVA (%)</b>", ParagraphStyle('TableHeader', 
+            textColor=colors.white, fontSize=10, alignment=TA_CENTER, fontName='Helvetica-Bold')),
+        Paragraph("<b>Total HT</b>", ParagraphStyle('TableHeader', 
+            textColor=colors.white, fontSize=10, alignment=TA_RIGHT, fontName='Helvetica-Bold'))
+    ]
+
+def item_rows(item):
+    """Lignes d'un article : ligne principale, détails (fusionnés sur toute la largeur), remise"""
+    # Description principale en gras
+    desc_text = f"<b>{item.description}</b>"
+    rows = [[
+        Paragraph(desc_text, STYLE_ARTICLE_DESCRIPTION),
+        Paragraph(str(item.quantite), STYLE_ARTICLE_CENTRE),
+        Paragraph(f"{item.prix_unitaire:.2f} €", STYLE_ARTICLE_DROITE),
+        Paragraph(f"{item.tva_taux} %", STYLE_ARTICLE_CENTRE),
+        Paragraph(f"{item.total_ht:.2f} €", STYLE_ARTICLE_DROITE)
+    ]]
+    
+    # Si il y a des détails, les ajouter sur une nouvelle ligne
+    if item.details:
+        rows.append([
+            details_paragraph(item),
+            '', '', '', ''
+        ])
+    
+    # Ligne de remise si applicable
+    if item.remise > 0:
+        rows.append([
+            '', '', '', 
+            Paragraph("Remise", STYLE_ARTICLE_DROITE),
+            Paragraph(f"-{item.remise:.2f} €", STYLE_ARTICLE_DROITE)
+        ])
+    return rows
+
+def create_items_table(items, couleurs):
+    """Créer le tableau des articles avec en-tête coloré selon le thème"""
+    items_data = [items_table_header()]
+    
+    # Style du tableau (compilé avec le thème) complété par les fusions des lignes de détails
+    table_style = list(couleurs['style_tableau'])
+    
+    for item in items:
+        if item.details:
+            # La ligne de détails doit span toutes les colonnes
+            table_style.append(('SPAN', (0, len(items_data) + 1), (-1, len(items_data) + 1)))
+        items_data.extend(item_rows(item))
+    
+    items_table = Table(items_data, colWidths=LARGEURS_COLONNES_ARTICLES, repeatRows=1)
+    items_table.setStyle(TableStyle(table_style))
+    return items_table
+
+def compile_pdf_theme(hex_colors):
+    """Couleurs reportlab, styles de paragraphe et style du tableau des articles d'un thème"""
+    couleurs = {name: colors.HexColor(value) for name, value in hex_colors.items()}
+    couleurs['styles'] = create_styles(couleurs)
+    couleurs['intro'] = ParagraphStyle('IntroStyle', fontSize=10, textColor=couleurs['principale'], alignment=TA_JUSTIFY)
+    couleurs['style_tableau'] = tuple(items_table_style(couleurs))
+    return couleurs
+
+register_theme_compiler('pdf', compile_pdf_theme)
+
+# Nombre d'articles par tableau pour les factures reçues en flux (environ une page)
+ARTICLES_PAR_TABLEAU = 25
+
+def create_items_flowables(items, couleurs):
+    """Tableau des articles, ou générateur de tableaux page par page pour les articles compacts"""
+    if isinstance(items, CompactItems):
+        return [(create_items_table(page, couleurs) for page in items.pages(ARTICLES_PAR_TABLEAU))]
+    return [create_items_table(items, couleurs)]
+
+# Hauteur d'une ligne de texte du tableau des articles (interlignage 12 pt) et marges haute + basse d'une cellule
+INTERLIGNE_ARTICLE = 12
+MARGES_CELLULE_ARTICLE = 20
+HAUTEUR_LIGNE_SIMPLE = INTERLIGNE_ARTICLE + MARGES_CELLULE_ARTICLE
+# Largeur utile de la description et des détails (fusionnés sur toute la largeur)
+LARGEUR_DESCRIPTION = LARGEURS_COLONNES_ARTICLES[0] - 16
+LARGEUR_DETAILS = sum(LARGEURS_COLONNES_ARTICLES) - 16
+
+def _line_count(text, font_name, width):
+    return max(1, math.ceil(stringWidth(text, font_name, 9) / width))
+
+def estimate_item_height(items, index):
+    """Hauteur estimée des lignes d'un article compact d'après le nombre de lignes de sa description et de ses détails"""
+    height = _line_count(items.descriptions[index], 'Helvetica-Bold', LARGEUR_DESCRIPTION) * INTERLIGNE_ARTICLE
+    height += MARGES_CELLULE_ARTICLE
+    details = items.details[index]
+    if details:
+        lines = sum(_line_count(line, 'Helvetica', LARGEUR_DETAILS) for line in details.split('\n'))
+        height += lines * INTERLIGNE_ARTICLE + MARGES_CELLULE_ARTICLE
+    if items.remises[index] > 0:
+        height += HAUTEUR_LIGNE_SIMPLE
+    return height
+
+def subtotal_row(label, amount):
+    """Ligne de report ou de sous-total à reporter : libellé sur trois colonnes, montant sur les deux dernières"""
+    return [Paragraph(f"<i>{label}</i>", STYLE_ARTICLE_DROITE), '', '',
+            Paragraph(f"<b>{amount:.2f} €</b>", STYLE_ARTICLE_DROITE), '']
+
+def subtotal_spans(row):
+    return [('SPAN', (0, row), (2, row)), ('SPAN', (3, row), (-1, row))]
+
+class ItemsRun(Flowable):
+    """Articles compacts items[start:end] en tableaux d'une page, report en tête et sous-total à reporter en pied
+
+    Chaque page est mesurée avant d'être coupée : le sous-total reporté est celui des lignes
+    réellement imprimées, même quand l'estimation des hauteurs se trompe. `carried` est le
+    sous-total HT des articles précédents (None en début de document), `continues` indique
+    que d'autres articles suivent `end` (mis en page ailleurs).
+    """
+    def __init__(self, items, start, end, couleurs, carried=None, continues=False):
+        Flowable.__init__(self)
+        self.items = items
+        self.start = start
+        self.end = end
+        self.couleurs = couleurs
+        self.carried = carried
+        self.continues = continues
+        self._fitted = None
+    
+    def _table(self, rows, spans, heights=None):
+        table = Table(rows, colWidths=LARGEURS_COLONNES_ARTICLES, rowHeights=heights)
+        table.setStyle(TableStyle(list(self.couleurs['style_tableau']) + spans))
+        return table
+    
+    def _fit(self, availWidth, availHeight):
+        """(articles qui tiennent dans la hauteur disponible, tableau de la page, sous-total après la page)"""
+        if self._fitted and self._fitted[0] == (availWidth, availHeight):
+            return self._fitted[1]
+        remaining = self.end - self.start
+        
+        # Nombre d'articles estimé, plus un : la mesure dit combien tiennent réellement
+        budget = availHeight - 3 * HAUTEUR_LIGNE_SIMPLE
+        guess = 0
+        while guess < remaining and budget >= 0:
+            budget -= estimate_item_height(self.items, self.start + guess)
+            guess += 1
+        guess = min(remaining, guess + 1)
+        
+        while True:
+            rows = [items_table_header()]
+            spans = []
+            if self.carried is not None:
+                spans.extend(subtotal_spans(1))
+                rows.append(subtotal_row("Report", self.carried))
+            # Fin de chaque article dans les lignes, et sous-total HT cumulé après lui
+            ends = []
+            subtotals = []
+            subtotal = self.carried or 0
+            for index in range(self.start, self.start + guess):
+                item = self.items[index]
+                if item.details:
+                    spans.append(('SPAN', (0, len(rows) + 1), (-1, len(rows) + 1)))
+                rows.extend(item_rows(item))
+                subtotal += item.total_ht
+                ends.append(len(rows))
+                subtotals.append(subtotal)
+            spans.extend(subtotal_spans(len(rows)))
+            rows.append(subtotal_row("Sous-total HT à reporter", subtotal))
+            
+            measure = self._table(rows, spans)
+            measure.wrap(availWidth, 1e9)
+            heights = measure._rowHeights
+            carry_height = heights[-1]
+            
+            count = 0
+            for fitted in range(guess, 0, -1):
+                needs_carry = self.continues or fitted < remaining
+                if sum(heights[:ends[fitted - 1]]) + (carry_height if needs_carry else 0) <= availHeight:
+                    count = fitted
+                    break
+            if count < guess or guess == remaining:
+                break
+            # Estimation trop prudente : mesurer une page plus longue
+            guess = min(remaining, guess * 2)
+        
+        if count == 0:
+            fitted = (0, None, self.carried)
+        else:
+            kept = ends[count - 1]
+            page_rows = rows[:kept]
+            page_heights = heights[:kept]
+            page_spans = [span for span in spans if span[1][1] < kept]
+            if self.continues or count < remaining:
+                page_spans.extend(subtotal_spans(kept))
+                page_rows.append(subtotal_row("Sous-total HT à reporter", subtotals[count - 1]))
+                page_heights.append(carry_height)
+            # Hauteurs déjà mesurées : le tableau de la page n'est pas remesuré
+            fitted = (count, self._table(page_rows, page_spans, page_heights), subtotals[count - 1])
+        self._fitted = ((availWidth, availHeight), fitted)
+        return fitted
+    
+    def wrap(self, availWidth, availHeight):
+        count, table, _ = self._fit(availWidth, availHeight)
+        if table is not None and count == self.end - self.start:
+            return table.wrap(availWidth, availHeight)
+        # Ne tient pas entièrement dans la page : la frame demandera le découpage
+        return availWidth, availHeight + 1
+    
+    def draw(self):
+        self._fitted[1][1].drawOn(self.canv, 0, 0)
+    
+    def split(self, availWidth, availHeight):
+        count, table, subtotal = self._fit(availWidth, availHeight)
+        if table is None:
+            return []
+        if count == self.end - self.start:
+            return [table]
+        return [table, ItemsRun(self.items, self.start + count, self.end, self.couleurs, subtotal, self.continues)]
+
+class SegmentCanvas(canvas.Canvas):
+    """Canvas d'un morceau de mise en page parallèle : footers ajoutés à l'assemblage (total de pages connu)"""
+    def __init__(self, *args, **kwargs):
+        canvas.Canvas.__init__(self, *args, **kwargs)
+        self.doc_info = {}
+    
+    def save(self):
+        facturx = self.doc_info.get('facturx')
+        if facturx:
+            attach_facturx(self, *facturx)
+        canvas.Canvas.save(self)
+
+def build_document(doc, elements, items, on_first_page, theme):
+    """Construire le PDF ; les articles compacts sont mis en page sans garder toutes les pages"""
+    mark_stage('build')
+    if isinstance(items, CompactItems):
+        # Import tardif : parallel_layout importe ce module (ses processus de mise en page aussi)
+        from parallel_layout import segmented_layout, build_parallel
+        if segmented_layout(items):
+            build_parallel(doc, elements, items, on_first_page, theme)
+            return
+        doc.build(LazyFlowables(elements), canvasmaker=StreamingCanvas, onFirstPage=on_first_page)
+    else:
+        doc.build(elements, canvasmaker=SimpleCanvas, onFirstPage=on_first_page)
+
+def generate_pdf_devis(devis, theme='bleu', deterministic=False):
     """Générer un PDF de devis avec le thème de couleur choisi"""
+    mark_stage('flowables')
     # Récupérer les couleurs du thème
-    couleurs = THEMES_COULEURS.get(theme, THEMES_COULEURS['bleu'])
+    couleurs = compiled_theme(theme)['pdf']
     
     filename = os.path.join('generated', f'devis_{devis.numero}_{theme}.pdf')
     
-    # Configuration du document
+    # Configuration du document (mode invariant : pas d'horodatage ni d'ID aléatoire)
     doc = SimpleDocTemplate(
         filename,
         pagesize=A4,
         rightMargin=2*cm,
         leftMargin=2*cm,
         topMargin=0.8*cm,
-        bottomMargin=3*cm
+        bottomMargin=3*cm,
+        invariant=1 if deterministic else None
     )
     
-    styles = create_styles(couleurs)
+    styles = couleurs['styles']
     elements = []
     
-    # En-tête avec logo et titre
-    header_table = create_header_with_logo(devis.logo_url, "Devis", 18)
-    elements.append(header_table)
+    # L'en-tête (titre et logo) est inséré en dernier : le logo se télécharge
+    # pendant la construction des autres éléments
     
     # Informations du devis - alignées en deux colonnes comme Fournisseur/Client
     left_column_data = """<b>Numéro de devis</b><br/>
@@ -279,7 +644,7 @@ Numéro de TVA: {devis.client_tva}"""
     
     # Table invisible pour les deux colonnes
     company_data = [[
-        Paragraph(fournisseur_text, company_info_style),
+        profile_paragraph(devis, theme, 'devis:fournisseur', fournisseur_text, company_info_style),
         Paragraph(client_text, company_info_style)
     ]]
     
@@ -297,125 +662,12 @@ Numéro de TVA: {devis.client_tva}"""
     
     # Texte d'introduction si présent
     if devis.texte_intro:
-        intro_style = ParagraphStyle('IntroStyle', fontSize=10, textColor=couleurs['principale'], alignment=TA_JUSTIFY)
+        intro_style = couleurs['intro']
         elements.append(Paragraph(devis.texte_intro, intro_style))
         elements.append(Spacer(1, 10*mm))
     
     # Tableau des articles avec en-tête coloré selon le thème
-    items_data = []
-    
-    # En-tête du tableau avec la couleur du thème
-    headers = [
-        Paragraph("<b>Description</b>", ParagraphStyle('TableHeader', 
-            textColor=colors.white, fontSize=10, fontName='Helvetica-Bold')),
-        Paragraph("<b>Qté</b>", ParagraphStyle('TableHeader', 
-            textColor=colors.white, fontSize=10, alignment=TA_CENTER, fontName='Helvetica-Bold')),
-        Paragraph("<b>Prix unitaire</b>", ParagraphStyle('TableHeader', 
-            textColor=colors.white, fontSize=10, alignment=TA_CENTER, fontName='Helvetica-Bold')),
-        Paragraph("<b>TVA (%)</b>", ParagraphStyle('TableHeader', 
-            textColor=colors.white, fontSize=10, alignment=TA_CENTER, fontName='Helvetica-Bold')),
-        Paragraph("<b>Total HT</b>", ParagraphStyle('TableHeader', 
-            textColor=colors.white, fontSize=10, alignment=TA_RIGHT, fontName='Helvetica-Bold'))
-    ]
-    items_data.append(headers)
-    
-    # Style pour les items
-    item_desc_style = ParagraphStyle('ItemDesc', fontSize=9, textColor=colors.black)
-    item_center_style = ParagraphStyle('ItemCenter', fontSize=9, textColor=colors.black, 
-                                      alignment=TA_CENTER)
-    item_right_style = ParagraphStyle('ItemRight', fontSize=9, textColor=colors.black, 
-                                     alignment=TA_RIGHT)
-    
-    # Articles
-    for item in devis.items:
-        # Description principale en gras
-        desc_text = f"<b>{item.description}</b>"
-        
-        # Si il y a des détails, les ajouter sur des lignes séparées
-        if item.details:
-            items_data.append([
-                Paragraph(desc_text, item_desc_style),
-                Paragraph(str(item.quantite), item_center_style),
-                Paragraph(f"{item.prix_unitaire:.2f} €", item_right_style),
-                Paragraph(f"{item.tva_taux} %", item_center_style),
-                Paragraph(f"{item.total_ht:.2f} €", item_right_style)
-            ])
-            
-            # Ajouter les détails sur une nouvelle ligne
-            detail_text = "<br/>".join(item.details)
-            items_data.append([
-                Paragraph(detail_text, ParagraphStyle('DetailStyle', fontSize=9, 
-                         textColor=colors.black, leftIndent=0)),
-                '', '', '', ''
-            ])
-        else:
-            # Pas de détails, juste la ligne principale
-            items_data.append([
-                Paragraph(desc_text, item_desc_style),
-                Paragraph(str(item.quantite), item_center_style),
-                Paragraph(f"{item.prix_unitaire:.2f} €", item_right_style),
-                Paragraph(f"{item.tva_taux} %", item_center_style),
-                Paragraph(f"{item.total_ht:.2f} €", item_right_style)
-            ])
-        
-        # Ligne de remise si applicable
-        if item.remise > 0:
-            items_data.append([
-                '', '', '', 
-                Paragraph("Remise", item_right_style),
-                Paragraph(f"-{item.remise:.2f} €", item_right_style)
-            ])
-    
-    # Créer le tableau - largeurs exactes du modèle
-    col_widths = [8.5*cm, 2*cm, 3*cm, 2.5*cm, 2.5*cm]
-    items_table = Table(items_data, colWidths=col_widths, repeatRows=1)
-    
-    # Style du tableau avec la couleur du thème pour l'en-tête
-    table_style = [
-        # En-tête avec couleur du thème
-        ('BACKGROUND', (0, 0), (-1, 0), couleurs['header_bg']),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 10),
-        ('TOPPADDING', (0, 0), (-1, 0), 10),
-        
-        # Corps du tableau
-        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 1), (-1, -1), 9),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        
-        # Alignements
-        ('ALIGN', (1, 1), (1, -1), 'CENTER'),
-        ('ALIGN', (2, 1), (2, -1), 'RIGHT'),
-        ('ALIGN', (3, 1), (3, -1), 'CENTER'),
-        ('ALIGN', (4, 1), (4, -1), 'RIGHT'),
-        
-        # Bordures grises fines
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#b2bec3')),
-        
-        # Padding
-        ('LEFTPADDING', (0, 0), (-1, -1), 8),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 1), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 10),
-    ]
-    
-    # Pour les lignes de détails, faire un span
-    row_num = 1
-    for item in devis.items:
-        if item.details:
-            # La ligne de détails doit span toutes les colonnes
-            table_style.append(('SPAN', (0, row_num + 1), (-1, row_num + 1)))
-            row_num += 2
-        else:
-            row_num += 1
-        
-        if item.remise > 0:
-            row_num += 1
-    
-    items_table.setStyle(TableStyle(table_style))
-    elements.append(items_table)
+    elements.extend(create_items_flowables(devis.items, couleurs))
     elements.append(Spacer(1, 15*mm))
     
     # Totaux alignés à droite
@@ -454,10 +706,10 @@ Numéro de TVA: {devis.client_tva}"""
         text_style = ParagraphStyle('TextStyle', fontSize=10, textColor=colors.black)
         
         elements.append(Paragraph("CONDITIONS DE PAIEMENT", cond_style))
-        elements.append(Paragraph(devis.conditions_paiement, text_style))
+        elements.append(profile_paragraph(devis, theme, 'devis:conditions', devis.conditions_paiement, text_style))
         if devis.penalites_retard:
             elements.append(Spacer(1, 3*mm))
-            elements.append(Paragraph(devis.penalites_retard, ParagraphStyle('SmallText', 
+            elements.append(profile_paragraph(devis, theme, 'devis:penalites', devis.penalites_retard, ParagraphStyle('SmallText', 
                 fontSize=8, textColor=colors.grey, fontName='Helvetica')))
         elements.append(Spacer(1, 10*mm))
     
@@ -470,9 +722,9 @@ Numéro de TVA: {devis.client_tva}"""
         elements.append(Paragraph("COORDONNÉES BANCAIRES", bank_style))
         elements.append(Spacer(1, 3*mm))
         
-        elements.append(Paragraph(f"<b>Banque:</b> {devis.banque_nom}", text_style))
-        elements.append(Paragraph(f"<b>IBAN:</b> {devis.banque_iban}", text_style))
-        elements.append(Paragraph(f"<b>BIC:</b> {devis.banque_bic}", text_style))
+        elements.append(profile_paragraph(devis, theme, 'devis:banque_nom', f"<b>Banque:</b> {devis.banque_nom}", text_style))
+        elements.append(profile_paragraph(devis, theme, 'devis:banque_iban', f"<b>IBAN:</b> {devis.banque_iban}", text_style))
+        elements.append(profile_paragraph(devis, theme, 'devis:banque_bic', f"<b>BIC:</b> {devis.banque_bic}", text_style))
         
         elements.append(Spacer(1, 10*mm))
     
@@ -504,36 +756,46 @@ Numéro de TVA: {devis.client_tva}"""
     def build_with_canvas(canvas_obj, doc):
         canvas_obj.doc_info = {
             'company_name': devis.fournisseur_nom,
-            'doc_number': devis.numero
+            'doc_number': devis.numero,
+            'content_hash': devis.content_hash() if deterministic else None
         }
     
-    doc.build(elements, canvasmaker=SimpleCanvas, onFirstPage=build_with_canvas)
+    # En-tête avec logo et titre
+    mark_stage('logo')
+    header_table = create_header_with_logo(devis.logo_url, "Devis", 18, devis.logo_id)
+    elements.insert(0, header_table)
+    
+    build_document(doc, elements, devis.items, build_with_canvas, theme)
     
     return filename
 
-def generate_pdf_facture(facture, theme='bleu'):
-    """Générer un PDF de facture avec le thème de couleur choisi"""
+def generate_pdf_facture(facture, theme='bleu', deterministic=False, facturx=None):
+    """Générer un PDF de facture avec le thème de couleur choisi
+
+    `facturx` ('minimum', 'basic', 'en16931') : XML Factur-X joint au PDF pendant son écriture.
+    """
+    mark_stage('flowables')
     # Récupérer les couleurs du thème
-    couleurs = THEMES_COULEURS.get(theme, THEMES_COULEURS['bleu'])
+    couleurs = compiled_theme(theme)['pdf']
     
     filename = os.path.join('generated', f'facture_{facture.numero}_{theme}.pdf')
     
-    # Configuration du document
+    # Configuration du document (mode invariant : pas d'horodatage ni d'ID aléatoire)
     doc = SimpleDocTemplate(
         filename,
         pagesize=A4,
         rightMargin=2*cm,
         leftMargin=2*cm,
         topMargin=0.8*cm,
-        bottomMargin=3*cm
+        bottomMargin=3*cm,
+        invariant=1 if deterministic else None
     )
     
-    styles = create_styles(couleurs)
+    styles = couleurs['styles']
     elements = []
     
-    # En-tête avec logo et titre
-    header_table = create_header_with_logo(facture.logo_url, "Facture", 16)
-    elements.append(header_table)
+    # L'en-tête (titre et logo) est inséré en dernier : le logo se télécharge
+    # pendant la construction des autres éléments
     
     # Informations de la facture - alignées en deux colonnes
     left_column_data = "<b>Numéro de facture</b><br/>"
@@ -604,7 +866,7 @@ Numéro de TVA: {facture.client_tva}"""
     
     # Table invisible pour les deux colonnes
     company_data = [[
-        Paragraph(fournisseur_text, company_info_style),
+        profile_paragraph(facture, theme, 'facture:fournisseur', fournisseur_text, company_info_style),
         Paragraph(client_text, company_info_style)
     ]]
     
@@ -621,108 +883,7 @@ Numéro de TVA: {facture.client_tva}"""
     elements.append(Spacer(1, 15*mm))
     
     # Tableau des articles - même style que devis
-    items_data = []
-    
-    # En-tête avec couleur du thème
-    headers = [
-        Paragraph("<b>Description</b>", ParagraphStyle('TableHeader', 
-            textColor=colors.white, fontSize=10, fontName='Helvetica-Bold')),
-        Paragraph("<b>Qté</b>", ParagraphStyle('TableHeader', 
-            textColor=colors.white, fontSize=10, alignment=TA_CENTER, fontName='Helvetica-Bold')),
-        Paragraph("<b>Prix unitaire</b>", ParagraphStyle('TableHeader', 
-            textColor=colors.white, fontSize=10, alignment=TA_CENTER, fontName='Helvetica-Bold')),
-        Paragraph("<b>TVA (%)</b>", ParagraphStyle('TableHeader', 
-            textColor=colors.white, fontSize=10, alignment=TA_CENTER, fontName='Helvetica-Bold')),
-        Paragraph("<b>Total HT</b>", ParagraphStyle('TableHeader', 
-            textColor=colors.white, fontSize=10, alignment=TA_RIGHT, fontName='Helvetica-Bold'))
-    ]
-    items_data.append(headers)
-    
-    # Styles pour les items
-    item_desc_style = ParagraphStyle('ItemDesc', fontSize=9, textColor=colors.black)
-    item_center_style = ParagraphStyle('ItemCenter', fontSize=9, textColor=colors.black, 
-                                      alignment=TA_CENTER)
-    item_right_style = ParagraphStyle('ItemRight', fontSize=9, textColor=colors.black, 
-                                     alignment=TA_RIGHT)
-    
-    # Articles
-    for item in facture.items:
-        desc_text = f"<b>{item.description}</b>"
-        
-        if item.details:
-            items_data.append([
-                Paragraph(desc_text, item_desc_style),
-                Paragraph(str(item.quantite), item_center_style),
-                Paragraph(f"{item.prix_unitaire:.2f} €", item_right_style),
-                Paragraph(f"{item.tva_taux} %", item_center_style),
-                Paragraph(f"{item.total_ht:.2f} €", item_right_style)
-            ])
-            
-            detail_text = "<br/>".join(item.details)
-            items_data.append([
-                Paragraph(detail_text, ParagraphStyle('DetailStyle', fontSize=9, 
-                         textColor=colors.black, leftIndent=0)),
-                '', '', '', ''
-            ])
-        else:
-            items_data.append([
-                Paragraph(desc_text, item_desc_style),
-                Paragraph(str(item.quantite), item_center_style),
-                Paragraph(f"{item.prix_unitaire:.2f} €", item_right_style),
-                Paragraph(f"{item.tva_taux} %", item_center_style),
-                Paragraph(f"{item.total_ht:.2f} €", item_right_style)
-            ])
-        
-        if item.remise > 0:
-            items_data.append([
-                '', '', '', 
-                Paragraph("Remise", item_right_style),
-                Paragraph(f"-{item.remise:.2f} €", item_right_style)
-            ])
-    
-    # Créer le tableau
-    col_widths = [8.5*cm, 2*cm, 3*cm, 2.5*cm, 2.5*cm]
-    items_table = Table(items_data, colWidths=col_widths, repeatRows=1)
-    
-    # Style du tableau avec couleur du thème
-    table_style = [
-        ('BACKGROUND', (0, 0), (-1, 0), couleurs['header_bg']),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 10),
-        ('TOPPADDING', (0, 0), (-1, 0), 10),
-        
-        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 1), (-1, -1), 9),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        
-        ('ALIGN', (1, 1), (1, -1), 'CENTER'),
-        ('ALIGN', (2, 1), (2, -1), 'RIGHT'),
-        ('ALIGN', (3, 1), (3, -1), 'CENTER'),
-        ('ALIGN', (4, 1), (4, -1), 'RIGHT'),
-        
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#b2bec3')),
-        
-        ('LEFTPADDING', (0, 0), (-1, -1), 8),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 1), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 10),
-    ]
-    
-    # Gérer les spans pour les détails
-    row_num = 1
-    for item in facture.items:
-        if item.details:
-            table_style.append(('SPAN', (0, row_num + 1), (-1, row_num + 1)))
-            row_num += 2
-        else:
-            row_num += 1
-        if item.remise > 0:
-            row_num += 1
-    
-    items_table.setStyle(TableStyle(table_style))
-    elements.append(items_table)
+    elements.extend(create_items_flowables(facture.items, couleurs))
     elements.append(Spacer(1, 15*mm))
     
     # Totaux
@@ -761,10 +922,10 @@ Numéro de TVA: {facture.client_tva}"""
         text_style = ParagraphStyle('TextStyle', fontSize=10, textColor=colors.black)
         
         elements.append(Paragraph("CONDITIONS DE PAIEMENT", cond_style))
-        elements.append(Paragraph(facture.conditions_paiement, text_style))
+        elements.append(profile_paragraph(facture, theme, 'facture:conditions', facture.conditions_paiement, text_style))
         if facture.penalites_retard:
             elements.append(Spacer(1, 3*mm))
-            elements.append(Paragraph(facture.penalites_retard, ParagraphStyle('SmallText', 
+            elements.append(profile_paragraph(facture, theme, 'facture:penalites', facture.penalites_retard, ParagraphStyle('SmallText', 
                 fontSize=8, textColor=colors.grey, fontName='Helvetica')))
         elements.append(Spacer(1, 10*mm))
     
@@ -777,9 +938,9 @@ Numéro de TVA: {facture.client_tva}"""
         elements.append(Paragraph("COORDONNÉES BANCAIRES POUR LE RÈGLEMENT", bank_style))
         elements.append(Spacer(1, 3*mm))
         
-        elements.append(Paragraph(f"<b>Banque:</b> {facture.banque_nom}", text_style))
-        elements.append(Paragraph(f"<b>IBAN:</b> {facture.banque_iban}", text_style))
-        elements.append(Paragraph(f"<b>BIC:</b> {facture.banque_bic}", text_style))
+        elements.append(profile_paragraph(facture, theme, 'facture:banque_nom', f"<b>Banque:</b> {facture.banque_nom}", text_style))
+        elements.append(profile_paragraph(facture, theme, 'facture:banque_iban', f"<b>IBAN:</b> {facture.banque_iban}", text_style))
+        elements.append(profile_paragraph(facture, theme, 'facture:banque_bic', f"<b>BIC:</b> {facture.banque_bic}", text_style))
     
     # Mentions légales
     elements.append(Spacer(1, 10*mm))
@@ -787,13 +948,23 @@ Numéro de TVA: {facture.client_tva}"""
     elements.append(Paragraph(legal_text, ParagraphStyle('LegalText', 
         fontSize=8, textColor=colors.grey, fontName='Helvetica', alignment=TA_JUSTIFY)))
     
+    # XML Factur-X calculé sur les mêmes totaux, joint à l'enregistrement du canvas
+    facturx_data = (facturx_xml(facture, facturx), facturx) if facturx else None
+    
     # Construire le PDF avec footer personnalisé
     def build_with_canvas(canvas_obj, doc):
         canvas_obj.doc_info = {
             'company_name': facture.fournisseur_nom,
-            'doc_number': facture.numero
+            'doc_number': facture.numero,
+            'content_hash': facture.content_hash() if deterministic else None,
+            'facturx': facturx_data
         }
     
-    doc.build(elements, canvasmaker=SimpleCanvas, onFirstPage=build_with_canvas)
+    # En-tête avec logo et titre
+    mark_stage('logo')
+    header_table = create_header_with_logo(facture.logo_url, "Facture", 16, facture.logo_id)
+    elements.insert(0, header_table)
+    
+    build_document(doc, elements, facture.items, build_with_canvas, theme)
     
     return filename
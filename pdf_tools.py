@@ -0,0 +1,277 @@
+# pdf_tools.py - Lecture minimale et mises à jour incrémentales des PDF générés par ReportLab
+import hashlib
+import re
+
+OBJ_RE = re.compile(rb'(\d+)\s+(\d+)\s+obj\b')
+REF_RE = re.compile(rb'(\d+)\s+0\s+R\b')
+STARTXREF_RE = re.compile(rb'startxref\s+(\d+)\s*%%EOF\s*$')
+
+class PDFFile:
+    """PDF déjà rendu : table xref, trailer et accès brut aux objets"""
+    def __init__(self, data):
+        self.data = data
+        self.offsets = {}
+        self.trailer = b''
+        match = STARTXREF_RE.search(data[-64:])
+        if not match:
+            raise ValueError("PDF invalide : startxref introuvable")
+        self.startxref = int(match.group(1))
+        self._read_xref(self.startxref)
+        self.size = int(self._trailer_value(b'Size'))
+        self.root = int(self._trailer_value(b'Root').split()[0])
+        info = self._trailer_value(b'Info')
+        self.info = int(info.split()[0]) if info else None
+
+    def _read_xref(self, offset):
+        """Lire une section xref et les sections précédentes (/Prev)"""
+        end = self.data.index(b'trailer', offset)
+        lines = self.data[offset:end].split(b'\n')[1:]
+        index = 0
+        while index < len(lines):
+            header = lines[index].split()
+            index += 1
+            if len(header) != 2:
+                continue
+            first, count = int(header[0]), int(header[1])
+            for num in range(first, first + count):
+                entry = lines[index].split()
+                index += 1
+                # Les sections récentes sont lues d'abord : ne pas les écraser
+                if entry[2] == b'n' and num not in self.offsets:
+                    self.offsets[num] = int(entry[0])
+        trailer = self.data[end:self.data.index(b'startxref', end)]
+        if not self.trailer:
+            self.trailer = trailer
+        prev = re.search(rb'/Prev\s+(\d+)', trailer)
+        if prev:
+            self._read_xref(int(prev.group(1)))
+
+    def _trailer_value(self, key):
+        match = re.search(rb'/' + key + rb'\s+(\d+(?:\s+0\s+R)?)', self.trailer)
+        return match.group(1) if match else None
+
+    def object_bytes(self, num):
+        """Contenu brut de l'objet (entre 'obj' et 'endobj')"""
+        offset = self.offsets[num]
+        match = OBJ_RE.match(self.data, offset)
+        if not match or int(match.group(1)) != num:
+            raise ValueError(f"Objet {num} introuvable à l'offset {offset}")
+        start = match.end()
+        stream = self.data.find(b'stream', start)
+        endobj = self.data.find(b'endobj', start)
+        if 0 <= stream < endobj:
+            # Sauter les données du flux d'après /Length pour ne pas s'arrêter sur un faux 'endobj'
+            length = int(re.search(rb'/Length\s+(\d+)', self.data[start:stream]).group(1))
+            data_start = stream + len(b'stream')
+            data_start += 2 if self.data[data_start:data_start + 2] == b'\r\n' else 1
+            endobj = self.data.index(b'endobj', data_start + length)
+        return self.data[start:endobj].strip()
+
+    def dictionary(self, num):
+        """Partie dictionnaire de l'objet (sans les données de flux)"""
+        body = self.object_bytes(num)
+        stream = body.find(b'stream')
+        return body[:stream].strip() if stream >= 0 else body
+
+    def stream_data(self, num):
+        """Données brutes (encodées) du flux de l'objet"""
+        body = self.object_bytes(num)
+        start = body.index(b'stream') + len(b'stream')
+        start += 2 if body[start:start + 2] == b'\r\n' else 1
+        length = int(re.search(rb'/Length\s+(\d+)', body[:start]).group(1))
+        return body[start:start + length]
+
+    def pages(self):
+        """Numéros des objets page, dans l'ordre du document"""
+        catalog = self.dictionary(self.root)
+        pages_ref = int(re.search(rb'/Pages\s+(\d+)\s+0\s+R', catalog).group(1))
+        return self._collect_pages(pages_ref)
+
+    def _collect_pages(self, num):
+        node = self.dictionary(num)
+        if re.search(rb'/Type\s*/Page\b', node):
+            return [num]
+        kids = re.search(rb'/Kids\s*\[(.*?)\]', node, re.S).group(1)
+        pages = []
+        for kid in REF_RE.findall(kids):
+            pages.extend(self._collect_pages(int(kid)))
+        return pages
+
+def pdf_string(text):
+    """Encoder un texte en chaîne PDF (WinAnsi ; caractères hors de l'encodage remplacés)"""
+    raw = text.encode('cp1252', 'replace')
+    return b'(' + raw.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+def make_stream_object(dictionary_entries, data):
+    """Construire le corps d'un objet flux à partir de ses entrées et de ses données"""
+    return (b'<< ' + dictionary_entries + b' /Length ' + str(len(data)).encode() + b' >>\nstream\n'
+            + data + b'\nendstream')
+
+def add_page_overlay(page_dict, xobject_name, xobject_num, content_num):
+    """Ajouter un XObject et un flux de contenu supplémentaire à un dictionnaire de page"""
+    resources = re.search(rb'/Resources\s*<<', page_dict)
+    if not resources:
+        raise ValueError("Ressources de page indirectes non prises en charge")
+    entry = b'/' + xobject_name + b' ' + str(xobject_num).encode() + b' 0 R '
+    xobjects = re.compile(rb'/XObject\s*<<').search(page_dict, resources.end())
+    if xobjects:
+        page_dict = page_dict[:xobjects.end()] + b' ' + entry + page_dict[xobjects.end():]
+    else:
+        page_dict = (page_dict[:resources.end()] + b' /XObject << ' + entry + b'>> '
+                     + page_dict[resources.end():])
+
+    extra = str(content_num).encode() + b' 0 R'
+    contents = re.search(rb'/Contents\s*(\[[^\]]*\]|\d+\s+0\s+R)', page_dict)
+    if contents:
+        current = contents.group(1).strip(b'[] ')
+        replacement = b'/Contents [ ' + current + b' ' + extra + b' ]'
+        page_dict = page_dict[:contents.start()] + replacement + page_dict[contents.end():]
+    else:
+        page_dict = page_dict.replace(b'/Type /Page', b'/Contents ' + extra + b' /Type /Page', 1)
+    return page_dict
+
+def incremental_update(pdf, replaced, added):
+    """Ajouter une mise à jour incrémentale : objets remplacés {num: corps} et nouveaux objets [corps]
+
+    Le PDF d'origine est conservé tel quel ; seuls les objets modifiés et une
+    nouvelle section xref sont ajoutés à la fin du fichier.
+    """
+    data = pdf.data if pdf.data.endswith(b'\n') else pdf.data + b'\n'
+    objects = dict(replaced)
+    next_num = pdf.size
+    for body in added:
+        objects[next_num] = body
+        next_num += 1
+
+    chunks = [data]
+    position = len(data)
+    offsets = {}
+    for num in sorted(objects):
+        chunk = str(num).encode() + b' 0 obj\n' + objects[num] + b'\nendobj\n'
+        offsets[num] = position
+        chunks.append(chunk)
+        position += len(chunk)
+
+    # La sous-section 0 (objet libre) évite aux lecteurs de croire à une table mal indexée
+    xref = [b'xref\n0 1\n0000000000 65535 f \n']
+    for num in sorted(offsets):
+        xref.append(b'%d 1\n%010d 00000 n \n' % (num, offsets[num]))
+    trailer = b'trailer\n<< /Size %d /Root %d 0 R' % (next_num, pdf.root)
+    if pdf.info:
+        trailer += b' /Info %d 0 R' % pdf.info
+    file_id = re.search(rb'/ID\s*(\[[^\]]*\])', pdf.trailer)
+    if file_id:
+        trailer += b' /ID ' + re.sub(rb'%[^\n]*', b'', file_id.group(1)).replace(b'\n', b'')
+    trailer += b' /Prev %d >>\nstartxref\n%d\n%%%%EOF\n' % (pdf.startxref, position)
+    chunks.extend(xref)
+    chunks.append(trailer)
+    return b''.join(chunks)
+
+def _split_stream(body):
+    """Séparer le dictionnaire d'un objet de ses éventuelles données de flux"""
+    stream = body.find(b'stream')
+    if stream < 0:
+        return body, b''
+    return body[:stream], body[stream:]
+
+def merge_pdfs(paths, keep_catalog=False):
+    """Concaténer des PDF déjà rendus, sans nouvelle mise en page, en produisant le fichier par morceaux
+
+    Les objets de chaque page sont renumérotés ; un objet identique après renumérotation
+    (polices, logo, XObjects du tampon) n'est écrit qu'une fois pour tout le fichier.
+    Un seul PDF source est chargé à la fois. `keep_catalog` conserve les entrées du catalogue
+    du premier PDF (fichiers joints Factur-X, métadonnées XMP).
+    """
+    header = b'%PDF-1.4\n%\x93\x8c\x8b\x9e\n'
+    yield header
+    position = len(header)
+    # 1 : catalogue, 2 : arbre des pages (écrits à la fin)
+    offsets = {}
+    next_num = 3
+    seen = {}
+    kids = []
+    catalog_entries = b''
+
+    for source_index, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            pdf = PDFFile(f.read())
+        mapping = {}
+        in_progress = set()
+        chunks = []
+
+        def copy(num):
+            nonlocal next_num
+            if num in mapping and num not in in_progress:
+                return mapping[num]
+            if num in in_progress:
+                # Référence circulaire : réserver le numéro, l'objet ne sera pas dédupliqué
+                if num not in mapping:
+                    mapping[num] = next_num
+                    next_num += 1
+                return mapping[num]
+            in_progress.add(num)
+            dictionary, stream = _split_stream(pdf.object_bytes(num))
+            is_page = re.search(rb'/Type\s*/Page\b', dictionary) is not None
+            if is_page:
+                # Les pages sont rattachées à l'arbre des pages du fichier fusionné
+                dictionary = re.sub(rb'/Parent\s+\d+\s+0\s+R', b'', dictionary)
+            dictionary = REF_RE.sub(lambda m: b'%d 0 R' % copy(int(m.group(1))), dictionary)
+            if is_page:
+                dictionary = dictionary.replace(b'<<', b'<< /Parent 2 0 R', 1)
+            in_progress.discard(num)
+            body = dictionary + stream
+
+            reserved = mapping.get(num)
+            if reserved is None:
+                key = hashlib.sha256(body).digest()
+                if not is_page and key in seen:
+                    mapping[num] = seen[key]
+                    return seen[key]
+                reserved = next_num
+                next_num += 1
+                seen[key] = reserved
+                mapping[num] = reserved
+            chunks.append((reserved, body))
+            return reserved
+
+        for page in pdf.pages():
+            kids.append(copy(page))
+            for out_num, body in chunks:
+                chunk = str(out_num).encode() + b' 0 obj\n' + body + b'\nendobj\n'
+                offsets[out_num] = position
+                position += len(chunk)
+                yield chunk
+            chunks.clear()
+
+        if keep_catalog and source_index == 0:
+            # Arbre des pages et type remplacés par ceux du fichier fusionné
+            catalog = re.sub(rb'/Pages\s+\d+\s+0\s+R|/Type\s*/Catalog', b'', pdf.dictionary(pdf.root))
+            catalog = catalog.strip()[2:-2].strip()
+            catalog_entries = REF_RE.sub(lambda m: b'%d 0 R' % copy(int(m.group(1))), catalog) + b' '
+            for out_num, body in chunks:
+                chunk = str(out_num).encode() + b' 0 obj\n' + body + b'\nendobj\n'
+                offsets[out_num] = position
+                position += len(chunk)
+                yield chunk
+            chunks.clear()
+
+    trailer_objects = [
+        (2, b'<< /Count %d /Kids [ %s ] /Type /Pages >>'
+            % (len(kids), b' '.join(b'%d 0 R' % kid for kid in kids))),
+        (1, b'<< ' + catalog_entries + b'/Pages 2 0 R /Type /Catalog >>'),
+    ]
+    for out_num, body in trailer_objects:
+        chunk = str(out_num).encode() + b' 0 obj\n' + body + b'\nendobj\n'
+        offsets[out_num] = position
+        position += len(chunk)
+        yield chunk
+
+    # Les numéros réservés puis dédupliqués n'existent pas : entrées libres
+    xref = [b'xref\n0 %d\n0000000000 65535 f \n' % next_num]
+    for num in range(1, next_num):
+        if num in offsets:
+            xref.append(b'%010d 00000 n \n' % offsets[num])
+        else:
+            xref.append(b'0000000000 65535 f \n')
+    yield b''.join(xref)
+    yield b'trailer\n<< /Root 1 0 R /Size %d >>\nstartxref\n%d\n%%%%EOF\n' % (next_num, position)
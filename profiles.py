@@ -0,0 +1,103 @@
+# profiles.py - Profils fournisseur enregistrés et cache des blocs statiques pré-rendus
+import hashlib
+import json
+import os
+import re
+import threading
+
+DATA_FOLDER = os.environ.get('DATA_FOLDER', 'data')
+PROFILES_FOLDER = os.path.join(DATA_FOLDER, 'profiles')
+
+# Champs portés par un profil fournisseur
+CHAMPS_PROFIL = [
+    'fournisseur_nom', 'fournisseur_adresse', 'fournisseur_ville', 'fournisseur_email',
+    'fournisseur_siret', 'fournisseur_telephone', 'fournisseur_tva',
+    'banque_nom', 'banque_iban', 'banque_bic',
+    'conditions_paiement', 'penalites_retard', 'logo_url', 'logo_id',
+]
+
+# Profils chargés : profile_id -> (mtime du fichier, profil)
+_profiles = {}
+_lock = threading.Lock()
+
+# Caches de blocs pré-rendus enregistrés par les générateurs (clé : (profile_id, version, thème, bloc))
+_block_caches = []
+
+def register_block_cache(cache):
+    """Déclarer un cache de blocs à invalider lors de la mise à jour d'un profil"""
+    _block_caches.append(cache)
+    return cache
+
+def _profile_path(profile_id):
+    return os.path.join(PROFILES_FOLDER, f'{profile_id}.json')
+
+def is_valid_profile_id(profile_id):
+    return bool(re.fullmatch(r'[A-Za-z0-9_-]{1,64}', str(profile_id)))
+
+def _version(fields):
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+def save_profile(profile_id, data):
+    """Créer ou mettre à jour un profil ; les blocs pré-rendus de l'ancienne version sont invalidés"""
+    fields = {champ: data.get(champ, '') or '' for champ in CHAMPS_PROFIL}
+    profile = {'profile_id': profile_id, 'version': _version(fields), **fields}
+
+    os.makedirs(PROFILES_FOLDER, exist_ok=True)
+    path = _profile_path(profile_id)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+    with _lock:
+        _profiles.pop(profile_id, None)
+    for cache in _block_caches:
+        for key in [key for key in list(cache) if key[0] == profile_id]:
+            cache.pop(key, None)
+    return profile
+
+def get_profile(profile_id):
+    """Charger un profil (relu seulement si le fichier a changé, y compris depuis un autre worker)"""
+    if not is_valid_profile_id(profile_id):
+        return None
+    path = _profile_path(profile_id)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    cached = _profiles.get(profile_id)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, encoding='utf-8') as f:
+        profile = json.load(f)
+    with _lock:
+        _profiles[profile_id] = (mtime, profile)
+    return profile
+
+def apply_profile(data, profile, defaults):
+    """Valeurs fournisseur pour un document : payload, sinon profil, sinon valeurs par défaut
+
+    Retourne les champs et la version du profil à utiliser pour les blocs pré-rendus
+    (None si le payload surcharge un champ du profil : les blocs doivent alors être reconstruits).
+    """
+    fields = dict(defaults)
+    version = None
+    if profile:
+        fields.update({champ: profile[champ] for champ in CHAMPS_PROFIL if profile.get(champ)})
+        version = profile['version']
+    for champ in CHAMPS_PROFIL:
+        if champ in data:
+            fields[champ] = data[champ]
+            if profile and data[champ] != profile.get(champ):
+                version = None
+    return fields, version
+
+def block_cache_key(document, theme, block):
+    """Clé de cache d'un bloc statique, ou None si le document n'utilise pas un profil intact"""
+    version = getattr(document, 'profile_version', None)
+    if not version:
+        return None
+    return (document.profile_id, version, theme, block)
@@ -0,0 +1,224 @@
+# profiling.py - Profilage d'un rendu à la demande (échantillonnage ou cProfile) et export flamegraph
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+# Activation explicite : sans ce drapeau, la route de profilage n'est pas enregistrée
+PROFILING_ENABLED = os.environ.get('ENABLE_PROFILING', '0').lower() in ('1', 'true', 'yes', 'oui')
+
+MODES = ['sample', 'cprofile']
+FORMATS_PROFIL = ['speedscope', 'collapsed']
+
+# Nombre de fonctions retenues par catégorie dans le résumé
+TOP_FONCTIONS = 15
+
+# Part minimale du temps total pour développer une branche du graphe d'appels cProfile
+CPROFILE_SEUIL_BRANCHE = 0.0005
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+# Intervalle de bascule entre threads : réglage du processus, partagé par les profilages en cours
+_switch_lock = threading.Lock()
+_switch_original = None
+_switch_requests = []
+
+def category(filename):
+    """Catégorie d'un fichier source : reportlab, docx, application ou autre"""
+    path = filename.replace('\\', '/')
+    if '/reportlab/' in path:
+        return 'reportlab'
+    if '/docx/' in path:
+        return 'docx'
+    if os.path.abspath(filename).startswith(REPO):
+        return 'application'
+    return 'autre'
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _request_switch_interval(interval):
+    """Abaisser l'intervalle de bascule le temps d'un profilage (None : fin du profilage)
+
+    Le plus petit intervalle demandé par les profilages en cours s'applique ; le réglage
+    d'origine est remis à la fin du dernier, quel que soit l'ordre de fin des requêtes.
+    """
+    global _switch_original
+    with _switch_lock:
+        if interval is not None:
+            if not _switch_requests:
+                _switch_original = sys.getswitchinterval()
+            _switch_requests.append(interval)
+        else:
+            _switch_requests.pop()
+        sys.setswitchinterval(min([_switch_original, *_switch_requests]))
+
+class SamplingProfiler:
+    """Échantillonner la pile d'un thread à intervalle fixe (coût nul hors profilage)"""
+    def __init__(self, thread_id, interval_ms=1.0):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.stacks = Counter()
+        self.frames = {}
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = _frame_name(code)
+                self.frames.setdefault(name, (code.co_filename, code.co_firstlineno))
+                stack.append(name)
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+            self._stop_event.wait(self.interval)
+
+    def __enter__(self):
+        # Rendre la main plus souvent au thread d'échantillonnage
+        _request_switch_interval(self.interval / 2)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop_event.set()
+        self._thread.join()
+        _request_switch_interval(None)
+
+def sampled_summary(profiler):
+    """Fonctions les plus coûteuses par catégorie (échantillons propres et cumulés)"""
+    total = sum(profiler.stacks.values()) or 1
+    own = Counter()
+    cumulative = Counter()
+    for stack, count in profiler.stacks.items():
+        own[stack[-1]] += count
+        for name in set(stack):
+            cumulative[name] += count
+    summary = {}
+    for name, count in cumulative.most_common():
+        group = summary.setdefault(category(profiler.frames[name][0]), [])
+        if len(group) < TOP_FONCTIONS:
+            group.append({
+                'fonction': name,
+                'cumule_pct': round(100 * count / total, 1),
+                'propre_pct': round(100 * own[name] / total, 1),
+            })
+    return summary
+
+def collapsed(profiler):
+    """Piles au format « collapsed » (flamegraph.pl, speedscope, inferno)"""
+    return '\n'.join(f"{';'.join(stack)} {count}" for stack, count in sorted(profiler.stacks.items()))
+
+def speedscope(profiler, name, duration_ms):
+    """Profil échantillonné au format JSON de speedscope"""
+    names = list(profiler.frames)
+    index = {frame: position for position, frame in enumerate(names)}
+    samples = []
+    weights = []
+    for stack, count in profiler.stacks.items():
+        samples.append([index[frame] for frame in stack])
+        weights.append(count * profiler.interval * 1000)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'shared': {'frames': [{'name': frame, 'file': profiler.frames[frame][0],
+                               'line': profiler.frames[frame][1]} for frame in names]},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': round(duration_ms, 3),
+            'samples': samples,
+            'weights': weights,
+        }],
+    }
+
+def cprofile_summary(profile):
+    """Fonctions les plus coûteuses par catégorie d'après cProfile (temps exacts, appels)"""
+    stats = pstats.Stats(profile)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    summary = {}
+    for (filename, line, function), (_, calls, own_time, cumulative_time, _) in rows:
+        group = summary.setdefault(category(filename), [])
+        if len(group) < TOP_FONCTIONS:
+            group.append({
+                'fonction': f"{function} ({os.path.basename(filename)}:{line})",
+                'appels': calls,
+                'cumule_ms': round(cumulative_time * 1000, 2),
+                'propre_ms': round(own_time * 1000, 2),
+            })
+    return summary
+
+class CallGraphStacks:
+    """Piles reconstituées depuis le graphe d'appels de cProfile, en microsecondes
+
+    cProfile ne garde que les arcs appelant -> appelé : le temps d'une fonction appelée par
+    plusieurs chemins est réparti entre eux au prorata, comme le font les outils flamegraph
+    pour pstats. Mêmes attributs que SamplingProfiler (collapsed et speedscope s'appliquent).
+    """
+    interval = 1e-6
+
+    def __init__(self, profile):
+        self.stats = pstats.Stats(profile).stats
+        self.stacks = Counter()
+        self.frames = {}
+        self.children = {}
+        for function, (_, _, _, _, callers) in self.stats.items():
+            for caller, (_, _, _, cumulative_time) in callers.items():
+                self.children.setdefault(caller, []).append((function, cumulative_time))
+        roots = [function for function, row in self.stats.items() if not row[4]]
+        self.threshold = sum(self.stats[root][3] for root in roots) * CPROFILE_SEUIL_BRANCHE
+        for root in roots:
+            self._walk(root, self.stats[root][3], ())
+
+    def _name(self, function):
+        filename, line, name = function
+        frame = f"{name} ({os.path.basename(filename)}:{line})"
+        self.frames.setdefault(frame, (filename, line))
+        return frame
+
+    def _walk(self, function, seconds, stack):
+        _, _, own_time, cumulative_time, _ = self.stats[function]
+        stack += (self._name(function),)
+        share = seconds / cumulative_time if cumulative_time else 0
+        own = round(own_time * share / self.interval)
+        if own:
+            self.stacks[stack] += own
+        for child, child_time in self.children.get(function, ()):
+            # Récursion : le temps de l'appel récursif est déjà compté dans celui de l'appelant
+            if child != function and child_time * share >= self.threshold and self._name(child) not in stack:
+                self._walk(child, child_time * share, stack)
+
+def profile_render(render, name, mode='sample', output='speedscope', interval_ms=1.0):
+    """Exécuter render() sous le profileur choisi ; retourne le résultat et le rapport"""
+    started = time.perf_counter()
+    if mode == 'cprofile':
+        profile = cProfile.Profile()
+        result = profile.runcall(render)
+        duration_ms = (time.perf_counter() - started) * 1000
+        stacks = CallGraphStacks(profile)
+        return result, {
+            'mode': mode,
+            'duree_ms': round(duration_ms, 2),
+            'top': cprofile_summary(profile),
+            'profil': speedscope(stacks, name, duration_ms) if output == 'speedscope' else collapsed(stacks),
+        }
+
+    with SamplingProfiler(threading.get_ident(), interval_ms) as profiler:
+        result = render()
+    duration_ms = (time.perf_counter() - started) * 1000
+    report = {
+        'mode': mode,
+        'duree_ms': round(duration_ms, 2),
+        'echantillons': sum(profiler.stacks.values()),
+        'top': sampled_summary(profiler),
+        'profil': speedscope(profiler, name, duration_ms) if output == 'speedscope' else collapsed(profiler),
+    }
+    return result, report
@@ -0,0 +1,351 @@
+# recurring.py - Factures récurrentes : définitions, échéancier par période et émission en lot (cron)
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from docx_generator import generate_docx_facture
+from document_index import flush, index_document
+from document_store import save_document
+from numbering import next_numero, release_numero
+from pdf_generator import generate_pdf_facture
+from reports import record_facture
+from schema import FACTURE_SCHEMA, SchemaError
+
+DATA_FOLDER = os.environ.get('DATA_FOLDER', 'data')
+RECURRING_FOLDER = os.path.join(DATA_FOLDER, 'recurring')
+LEDGER_PATH = os.path.join(DATA_FOLDER, 'recurring.sqlite3')
+
+# Processus de rendu d'un lot (le rendu est limité par le CPU)
+RECURRING_WORKERS = int(os.environ.get('RECURRING_WORKERS', min(4, os.cpu_count() or 1)))
+
+# Nombre de mois entre deux factures (voir schema.FREQUENCES)
+MOIS_PAR_PERIODE = {
+    'mensuelle': 1,
+    'trimestrielle': 3,
+    'annuelle': 12,
+}
+
+# Champs fixés par l'échéancier : ignorés dans le modèle de facture
+CHAMPS_PERIODE = ['numero', 'date_emission', 'date_echeance']
+
+GENERATEURS_FACTURE = {
+    'pdf': generate_pdf_facture,
+    'docx': generate_docx_facture,
+}
+
+# Une ligne par période : le numéro est réservé avant le rendu, une reprise le réutilise ;
+# la facture est datée du jour de la réservation (numérotation chronologique, série de l'année).
+# Numéro vide : payload invalide, aucun numéro réservé (nouvel essai à l'exécution suivante)
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS emissions (
+    recurrence_id TEXT NOT NULL,
+    periode TEXT NOT NULL,
+    numero TEXT NOT NULL,
+    statut TEXT NOT NULL,
+    erreur TEXT NOT NULL DEFAULT '',
+    updated_at TEXT NOT NULL,
+    date_emission TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (recurrence_id, periode)
+);
+"""
+
+def _connect():
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    # isolation_level=None : transactions gérées explicitement (BEGIN IMMEDIATE)
+    connection = sqlite3.connect(LEDGER_PATH, timeout=30, isolation_level=None)
+    connection.executescript(SCHEMA_SQL)
+    # Registres créés avant la date d'émission enregistrée
+    if 'date_emission' not in {row[1] for row in connection.execute("PRAGMA table_info(emissions)")}:
+        connection.execute("ALTER TABLE emissions ADD COLUMN date_emission TEXT NOT NULL DEFAULT ''")
+    return connection
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+def is_valid_recurrence_id(recurrence_id):
+    return bool(re.fullmatch(r'[A-Za-z0-9_-]{1,64}', str(recurrence_id)))
+
+def _recurrence_path(recurrence_id):
+    return os.path.join(RECURRING_FOLDER, f'{recurrence_id}.json')
+
+def save_recurrence(definition, template):
+    """Créer ou remplacer une définition ; le modèle de facture est gardé brut (dates calculées à l'émission)"""
+    data = dict(definition, facture={k: v for k, v in template.items() if k not in CHAMPS_PERIODE})
+    os.makedirs(RECURRING_FOLDER, exist_ok=True)
+    path = _recurrence_path(definition['recurrence_id'])
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return data
+
+def get_recurrence(recurrence_id):
+    """Définition enregistrée, ou None"""
+    if not is_valid_recurrence_id(recurrence_id):
+        return None
+    try:
+        with open(_recurrence_path(recurrence_id), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def iter_recurrences():
+    if not os.path.isdir(RECURRING_FOLDER):
+        return
+    for name in sorted(os.listdir(RECURRING_FOLDER)):
+        if name.endswith('.json'):
+            with open(os.path.join(RECURRING_FOLDER, name), encoding='utf-8') as f:
+                yield json.load(f)
+
+def emissions(recurrence_id):
+    """Périodes déjà réservées ou émises d'une définition"""
+    if not os.path.exists(LEDGER_PATH):
+        return []
+    connection = _connect()
+    try:
+        rows = connection.execute(
+            "SELECT periode, numero, statut, erreur, updated_at FROM emissions "
+            "WHERE recurrence_id = ? ORDER BY periode", (recurrence_id,)).fetchall()
+    finally:
+        connection.close()
+    return [{'periode': periode, 'numero': numero, 'statut': statut, 'erreur': erreur, 'updated_at': updated_at}
+            for periode, numero, statut, erreur, updated_at in rows]
+
+# --- Échéancier ---
+
+def _parse_date(value):
+    return datetime.strptime(value, '%d/%m/%Y').date()
+
+def _add_months(day, months):
+    """Même jour `months` mois plus tard (ramené au dernier jour des mois plus courts)"""
+    month_index = day.month - 1 + months
+    year, month = day.year + month_index // 12, month_index % 12 + 1
+    next_month = datetime(year + month // 12, month % 12 + 1, 1).date()
+    return day.replace(year=year, month=month, day=min(day.day, (next_month - timedelta(days=1)).day))
+
+def due_periods(definition, today):
+    """Débuts des périodes échues au `today` (toutes depuis le début : les périodes manquées sont rattrapées)"""
+    step = MOIS_PAR_PERIODE[definition['frequence']]
+    first = _parse_date(definition['debut'])
+    last = min(today, _parse_date(definition['fin'])) if definition.get('fin') else today
+    index = 0
+    start = first
+    while start <= last:
+        yield start
+        index += 1
+        # Calculé depuis le début : un 31 janvier reste le 31 des mois qui en ont un
+        start = _add_months(first, index * step)
+
+def period_label(definition, start):
+    """Libellé de la période pour les articles : '03/2026', 'T1 2026', '2026'"""
+    frequence = definition['frequence']
+    if frequence == 'mensuelle':
+        return start.strftime('%m/%Y')
+    if frequence == 'trimestrielle':
+        return f'T{(start.month - 1) // 3 + 1} {start.year}'
+    return str(start.year)
+
+def _with_period(value, label):
+    if isinstance(value, str):
+        return value.replace('{periode}', label)
+    if isinstance(value, list):
+        return [_with_period(line, label) for line in value]
+    return value
+
+def facture_payload(definition, start, numero, emission):
+    """Payload de la facture d'une période : modèle, numéro réservé, dates et libellé de période
+
+    La période ne figure que dans le libellé des articles ({periode}) : la facture est datée
+    de son émission `emission`, pas du début de la période.
+    """
+    label = period_label(definition, start)
+    payload = dict(definition['facture'])
+    payload['items'] = [
+        {champ: _with_period(value, label) if champ in ('description', 'details') else value
+         for champ, value in item.items()} if isinstance(item, dict) else item
+        for item in payload.get('items', [])
+    ]
+    if numero:
+        payload['numero'] = numero
+    payload['date_emission'] = emission.strftime('%d/%m/%Y')
+    payload['date_echeance'] = (emission + timedelta(days=definition['delai_paiement'])).strftime('%d/%m/%Y')
+    return payload
+
+# --- Émission ---
+
+def materialize(today, dry_run=False):
+    """Réserver un numéro pour chaque période échue qui n'en a pas encore (une seule transaction)
+
+    `today` fixe les périodes échues ; les numéros sont réservés et datés du jour réel de
+    l'exécution, à la suite des autres factures. Un payload invalide ne réserve pas de numéro.
+    Le verrou d'écriture sérialise les exécutions concurrentes : une période n'a qu'un numéro.
+    """
+    emission = datetime.now().date()
+    connection = _connect()
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        existing = dict(((recurrence_id, periode), numero) for recurrence_id, periode, numero
+                        in connection.execute("SELECT recurrence_id, periode, numero FROM emissions"))
+        planned = []
+        invalid = []
+        for definition in iter_recurrences():
+            if not definition.get('active', True):
+                continue
+            for start in due_periods(definition, today):
+                key = (definition['recurrence_id'], start.isoformat())
+                if existing.get(key):
+                    continue
+                try:
+                    FACTURE_SCHEMA.validate(facture_payload(definition, start, '', emission))
+                except SchemaError as e:
+                    invalid.append(key + (json.dumps(e.errors, ensure_ascii=False),))
+                    continue
+                planned.append(key)
+        if dry_run:
+            connection.execute('ROLLBACK')
+            return planned
+        connection.executemany(
+            "INSERT INTO emissions (recurrence_id, periode, numero, statut, erreur, updated_at) VALUES (?, ?, '', 'erreur', ?, ?) "
+            "ON CONFLICT (recurrence_id, periode) DO UPDATE SET erreur = excluded.erreur, updated_at = excluded.updated_at",
+            [(recurrence_id, periode, erreur[:500], _now()) for recurrence_id, periode, erreur in invalid])
+        connection.executemany(
+            "INSERT INTO emissions (recurrence_id, periode, numero, statut, updated_at, date_emission) "
+            "VALUES (?, ?, ?, 'prevue', ?, ?) "
+            "ON CONFLICT (recurrence_id, periode) DO UPDATE SET numero = excluded.numero, statut = 'prevue', "
+            "erreur = '', updated_at = excluded.updated_at, date_emission = excluded.date_emission",
+            [(recurrence_id, periode, next_numero('F'), _now(), emission.isoformat())
+             for recurrence_id, periode in planned])
+        connection.execute('COMMIT')
+    except Exception:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+    return planned
+
+def render_facture(facture, theme, options):
+    """Rendu d'une facture dans un processus du lot (ni base ni index : le parent les met à jour)"""
+    return GENERATEURS_FACTURE[options.pop('format')](facture, theme=theme, **options)
+
+def _release(connection, recurrence_id, periode, numero, erreur):
+    """Rendre le numéro d'une période qui ne peut pas être émise (définition absente, payload invalide)"""
+    release_numero(numero)
+    connection.execute(
+        "UPDATE emissions SET numero = '', statut = 'erreur', erreur = ?, updated_at = ? "
+        "WHERE recurrence_id = ? AND periode = ?",
+        (erreur[:500], _now(), recurrence_id, periode))
+
+def _mark(connection, recurrence_id, periode, statut, erreur=''):
+    connection.execute(
+        "UPDATE emissions SET statut = ?, erreur = ?, updated_at = ? WHERE recurrence_id = ? AND periode = ?",
+        (statut, erreur[:500], _now(), recurrence_id, periode))
+
+def render_pending(workers=RECURRING_WORKERS):
+    """Rendre toutes les périodes réservées et pas encore émises (reprise après un arrêt comprise)
+
+    Un rendu déjà fait mais non marqué est refait sous le même numéro : le fichier, le stockage,
+    l'index et les agrégats sont remplacés, jamais dupliqués.
+    """
+    # Import tardif : app importe ce module pour ses routes
+    from app import build_facture, render_options
+
+    connection = _connect()
+    rows = connection.execute(
+        "SELECT recurrence_id, periode, numero, date_emission FROM emissions WHERE statut != 'emise' AND numero != '' "
+        "ORDER BY numero").fetchall()
+    result = {'emises': 0, 'erreurs': 0}
+    if not rows:
+        connection.close()
+        return result
+
+    definitions = {}
+    pending = {}
+    # Processus démarrés à neuf : le parent a des threads (journal, index) qu'un fork copierait mal
+    context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            def collect(done):
+                for future in done:
+                    recurrence_id, periode, facture, theme, output_format = pending.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        _mark(connection, recurrence_id, periode, 'erreur', str(e))
+                        result['erreurs'] += 1
+                        continue
+                    save_document('facture', facture, theme)
+                    index_document('facture', facture, theme, output_format)
+                    record_facture(facture)
+                    # Index et agrégats écrits avant de marquer la période émise : un arrêt
+                    # entre les deux fait refaire la période au lieu de la perdre
+                    if flush():
+                        _mark(connection, recurrence_id, periode, 'erreur', "écriture de l'index ou des agrégats impossible")
+                        result['erreurs'] += 1
+                        continue
+                    _mark(connection, recurrence_id, periode, 'emise')
+                    result['emises'] += 1
+
+            for recurrence_id, periode, numero, date_emission in rows:
+                if recurrence_id not in definitions:
+                    definitions[recurrence_id] = get_recurrence(recurrence_id)
+                definition = definitions[recurrence_id]
+                # Registres antérieurs à la date d'émission enregistrée : datée du jour
+                emission = datetime.fromisoformat(date_emission).date() if date_emission else datetime.now().date()
+                try:
+                    if definition is None:
+                        raise LookupError(f"Définition {recurrence_id} introuvable")
+                    start = datetime.fromisoformat(periode).date()
+                    payload = FACTURE_SCHEMA.validate(facture_payload(definition, start, numero, emission))
+                    facture = build_facture(payload)
+                except (LookupError, SchemaError) as e:
+                    # Définition supprimée ou modifiée depuis la réservation : numéro rendu
+                    _release(connection, recurrence_id, periode, numero, str(e))
+                    result['erreurs'] += 1
+                    continue
+                except Exception as e:
+                    _mark(connection, recurrence_id, periode, 'erreur', str(e))
+                    result['erreurs'] += 1
+                    continue
+
+                options = dict(render_options(payload), format=payload['format'])
+                future = executor.submit(render_facture, facture, payload['theme'], options)
+                pending[future] = (recurrence_id, periode, facture, payload['theme'], payload['format'])
+                # File bornée : au plus deux factures en attente par processus
+                if len(pending) >= 2 * workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(wait(pending).done)
+    finally:
+        connection.close()
+        flush()
+    return result
+
+def run(today, workers=RECURRING_WORKERS, dry_run=False):
+    """Réserver les périodes échues puis émettre tout ce qui n'est pas encore émis"""
+    planned = materialize(today, dry_run)
+    if dry_run:
+        return {'prevues': len(planned), 'periodes': [f'{recurrence_id} {periode}' for recurrence_id, periode in planned]}
+    return {'prevues': len(planned), **render_pending(workers)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Émission des factures récurrentes échues (à lancer par cron)")
+    parser.add_argument('command', choices=['run'])
+    parser.add_argument('--date', help="date des périodes échues JJ/MM/AAAA (aujourd'hui par défaut ; "
+                                       "les factures sont datées du jour de l'exécution)")
+    parser.add_argument('--workers', type=int, default=RECURRING_WORKERS, help="processus de rendu")
+    parser.add_argument('--dry-run', action='store_true', help="lister les périodes à émettre sans rien réserver")
+    options = parser.parse_args()
+
+    try:
+        today = _parse_date(options.date) if options.date else datetime.now().date()
+    except ValueError:
+        parser.error("date attendue au format JJ/MM/AAAA")
+    print(json.dumps(run(today, options.workers, options.dry_run), ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# reports.py - Chiffre d'affaires et TVA collectée, agrégés au fil des rendus de factures
+import argparse
+import json
+from document_index import connect, ensure_schema, register_schema, submit, iso_date
+from document_store import iter_documents
+from models import tva_breakdown
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS aggregats (
+    dimension TEXT NOT NULL,
+    groupe TEXT NOT NULL,
+    documents INTEGER NOT NULL DEFAULT 0,
+    total_ht REAL NOT NULL DEFAULT 0,
+    total_tva REAL NOT NULL DEFAULT 0,
+    total_ttc REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (dimension, groupe)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS aggregats_sources (
+    numero TEXT PRIMARY KEY,
+    contributions TEXT NOT NULL,
+    annulee INTEGER NOT NULL DEFAULT 0
+);
+""")
+
+# Regroupements disponibles pour /api/reports/summary
+GROUPES = ['month', 'client', 'tva_rate']
+
+# Factures qui ne comptent pas dans le chiffre d'affaires
+STATUTS_EXCLUS = ['Annulée']
+
+ADD_SQL = """
+INSERT INTO aggregats (dimension, groupe, documents, total_ht, total_tva, total_ttc)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (dimension, groupe) DO UPDATE SET
+    documents = documents + excluded.documents,
+    total_ht = total_ht + excluded.total_ht,
+    total_tva = total_tva + excluded.total_tva,
+    total_ttc = total_ttc + excluded.total_ttc
+"""
+
+def contributions(facture):
+    """Part d'une facture dans chaque groupe : [dimension, groupe, HT, TVA, TTC]"""
+    month = iso_date(facture.date_emission)[:7] or 'inconnu'
+    result = [
+        ['month', month, facture.total_ht, facture.total_tva, facture.total_ttc],
+        ['client', facture.client_nom, facture.total_ht, facture.total_tva, facture.total_ttc],
+    ]
+    # Ventilation calculée avec les totaux (recalculée pour les documents stockés avant elle)
+    breakdown = getattr(facture, 'tva_par_taux', None) or tva_breakdown(facture.items)
+    for rate, line in sorted(breakdown.items()):
+        result.append(['tva_rate', rate, line['base_ht'], line['tva'], line['base_ht'] + line['tva']])
+    return result
+
+def _apply(connection, parts, sign):
+    connection.executemany(ADD_SQL, [
+        (dimension, groupe, sign, sign * ht, sign * tva, sign * ttc)
+        for dimension, groupe, ht, tva, ttc in parts
+    ])
+
+def _record(connection, numero, parts, annulee):
+    """Remplacer la contribution d'une facture (un nouveau rendu ne la compte pas deux fois)"""
+    row = connection.execute(
+        "SELECT contributions, annulee FROM aggregats_sources WHERE numero = ?", (numero,)).fetchone()
+    if row and not row[1]:
+        _apply(connection, json.loads(row[0]), -1)
+    if not annulee:
+        _apply(connection, parts, 1)
+    connection.execute(
+        "INSERT OR REPLACE INTO aggregats_sources (numero, contributions, annulee) VALUES (?, ?, ?)",
+        (numero, json.dumps(parts, ensure_ascii=False), int(annulee)))
+
+def record_facture(facture):
+    """Mettre à jour les agrégats après le rendu d'une facture (écriture différée)"""
+    parts = contributions(facture)
+    annulee = facture.statut_paiement in STATUTS_EXCLUS
+    submit(lambda connection: _record(connection, facture.numero, parts, annulee))
+
+def record_status(numero, statut):
+    """Retirer ou réintégrer une facture selon son nouveau statut"""
+    annulee = statut in STATUTS_EXCLUS
+    def job(connection):
+        row = connection.execute(
+            "SELECT contributions, annulee FROM aggregats_sources WHERE numero = ?", (numero,)).fetchone()
+        if row is None or bool(row[1]) == annulee:
+            return
+        _apply(connection, json.loads(row[0]), -1 if annulee else 1)
+        connection.execute("UPDATE aggregats_sources SET annulee = ? WHERE numero = ?", (int(annulee), numero))
+    submit(job)
+
+def summary(group):
+    """Agrégats d'un regroupement (lecture en O(groupes))"""
+    connection = connect()
+    try:
+        rows = connection.execute(
+            "SELECT groupe, documents, total_ht, total_tva, total_ttc FROM aggregats "
+            "WHERE dimension = ? AND documents > 0 ORDER BY groupe", (group,)).fetchall()
+    except Exception:
+        # Tables pas encore créées : aucune facture rendue
+        rows = []
+    finally:
+        connection.close()
+    return [{
+        'groupe': groupe,
+        'documents': documents,
+        'total_ht': round(total_ht, 2),
+        'total_tva': round(total_tva, 2),
+        'total_ttc': round(total_ttc, 2),
+    } for groupe, documents, total_ht, total_tva, total_ttc in rows]
+
+def rebuild():
+    """Recalculer tous les agrégats à partir du stockage des documents"""
+    connection = connect()
+    ensure_schema(connection)
+    # Le statut à jour est celui de l'index (les tampons ne réécrivent pas le document stocké)
+    statuts = dict(connection.execute(
+        "SELECT numero, statut_paiement FROM documents WHERE type = 'facture'").fetchall())
+    count = 0
+    with connection:
+        connection.execute("DELETE FROM aggregats")
+        connection.execute("DELETE FROM aggregats_sources")
+        for facture, _theme in iter_documents('facture'):
+            statut = statuts.get(facture.numero, facture.statut_paiement)
+            _record(connection, facture.numero, contributions(facture), statut in STATUTS_EXCLUS)
+            count += 1
+    connection.close()
+    return count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Agrégats de chiffre d'affaires et de TVA")
+    parser.add_argument('command', choices=['rebuild'])
+    parser.parse_args()
+    print(f"{rebuild()} factures agrégées")
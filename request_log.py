@@ -0,0 +1,179 @@
+# request_log.py - Journaux JSON non bloquants, identifiant de requête et durées des étapes de rendu
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from memory_tracing import memory_stage, finish_request
+from metrics import observe
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# Part des requêtes réussies (et rapides) écrites dans le journal d'accès ; erreurs et
+# requêtes lentes sont toujours journalisées
+LOG_SUCCESS_SAMPLE_RATE = float(os.environ.get('LOG_SUCCESS_SAMPLE_RATE', '1.0'))
+LOG_SLOW_REQUEST_MS = float(os.environ.get('LOG_SLOW_REQUEST_MS', '1000'))
+
+# Identifiant reçu dans X-Request-ID (réutilisé s'il est raisonnable) ou généré
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+request_id_var = contextvars.ContextVar('request_id', default='-')
+
+access_logger = logging.getLogger('access')
+
+# Requête et étape en cours, propres à chaque thread
+_state = threading.local()
+
+# Attributs d'un LogRecord : tout le reste vient de `extra` et devient un champ JSON
+_ATTRIBUTS_STANDARD = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'request_id'}
+
+class JsonFormatter(logging.Formatter):
+    """Une ligne JSON par enregistrement, avec les champs passés dans `extra`"""
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'niveau': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _ATTRIBUTS_STANDARD:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RequestIdFilter(logging.Filter):
+    """Rattacher l'identifiant de la requête en cours (lu dans le thread appelant)"""
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class AsyncQueueHandler(QueueHandler):
+    """Mettre les enregistrements en file ; un thread par processus les formate et les écrit
+
+    Le thread d'écriture démarre au premier enregistrement de chaque processus : avec
+    gunicorn en préchargement, celui du maître n'existe pas dans les workers.
+    """
+    def __init__(self, target):
+        super().__init__(queue.SimpleQueue())
+        self.target = target
+        self._lock = threading.Lock()
+        self._listener = None
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def prepare(self, record):
+        # Message et trace figés dans le thread appelant (les arguments peuvent changer ensuite),
+        # la sérialisation JSON et l'écriture se font dans le thread d'écriture
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._listener is None:
+            with self._lock:
+                if self._listener is None:
+                    self._listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+                    self._listener.start()
+        self.queue.put_nowait(record)
+
+    def _after_fork(self):
+        self.queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def stop(self):
+        """Vider la file puis arrêter le thread d'écriture"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+_handler = None
+
+def configure_logging():
+    """Brancher le journal JSON asynchrone sur le logger racine (une seule fois)"""
+    global _handler
+    if _handler is not None:
+        return
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter())
+    _handler = AsyncQueueHandler(target)
+    _handler.addFilter(RequestIdFilter())
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(LOG_LEVEL)
+    atexit.register(_handler.stop)
+
+def begin_request(incoming_id=None):
+    """Début de requête : identifiant, chronomètre et durées des étapes remises à zéro"""
+    request_id = incoming_id if incoming_id and REQUEST_ID_PATTERN.fullmatch(incoming_id) else uuid.uuid4().hex
+    request_id_var.set(request_id)
+    _state.started = time.perf_counter()
+    _state.stage = None
+    _state.stages = {}
+    return request_id
+
+def mark_stage(name):
+    """Ouvrir l'étape `name` du rendu en cours (model, flowables, logo, build, save) et clore la précédente"""
+    now = time.perf_counter()
+    _close_stage(now)
+    _state.stage = name
+    _state.stage_started = now
+    memory_stage(name)
+
+def _close_stage(now):
+    stage = getattr(_state, 'stage', None)
+    if stage is None:
+        return
+    duration_ms = (now - _state.stage_started) * 1000
+    stages = getattr(_state, 'stages', None)
+    if stages is None:
+        stages = _state.stages = {}
+    stages[stage] = stages.get(stage, 0) + duration_ms
+    observe(f'render_{stage}_ms', duration_ms)
+    _state.stage = None
+
+def end_request():
+    """Clore la dernière étape ; retourne la durée de la requête et celles des étapes (en ms)"""
+    now = time.perf_counter()
+    _close_stage(now)
+    finish_request()
+    started = getattr(_state, 'started', None)
+    stages = getattr(_state, 'stages', None) or {}
+    _state.started = None
+    _state.stages = {}
+    if started is None:
+        return None, stages
+    return (now - started) * 1000, stages
+
+def access_log(method, path, status, **fields):
+    """Ligne du journal d'accès, échantillonnée pour les requêtes réussies et rapides"""
+    duration_ms, stages = end_request()
+    if duration_ms is None:
+        return
+    if status < 400 and duration_ms < LOG_SLOW_REQUEST_MS and random.random() >= LOG_SUCCESS_SAMPLE_RATE:
+        return
+    access_logger.info(f"{method} {path} {status}", extra={
+        'methode': method,
+        'chemin': path,
+        'statut': status,
+        'duree_ms': round(duration_ms, 2),
+        'etapes_ms': {stage: round(value, 2) for stage, value in stages.items()},
+        **fields,
+    })
@@ -0,0 +1,323 @@
+# schema.py - Validation et normalisation des payloads JSON, compilées une fois à l'import
+import os
+import re
+from datetime import datetime, timedelta
+from profiling import FORMATS_PROFIL, MODES
+from themes import theme_exists
+
+# Limites qui bornent le coût d'un rendu
+MAX_ITEMS = int(os.environ.get('MAX_ITEMS', '500'))
+MAX_DETAIL_LINES = int(os.environ.get('MAX_DETAIL_LINES', '50'))
+MAX_STRING_LENGTH = int(os.environ.get('MAX_STRING_LENGTH', '500'))
+MAX_TEXT_LENGTH = int(os.environ.get('MAX_TEXT_LENGTH', '5000'))
+MAX_MERGE_DOCUMENTS = int(os.environ.get('MAX_MERGE_DOCUMENTS', '1000'))
+MAX_CATALOG_IMPORT = int(os.environ.get('MAX_CATALOG_IMPORT', '10000'))
+
+FORMATS = ['pdf', 'docx']
+TYPES_DOCUMENT = ['devis', 'facture']
+# Profils Factur-X de l'XML joint aux factures PDF
+PROFILS_FACTURX = ['minimum', 'basic', 'en16931']
+# Périodicités des factures récurrentes
+FREQUENCES = ['mensuelle', 'trimestrielle', 'annuelle']
+
+# Valeur absente : le champ n'apparaît pas dans le payload normalisé
+ABSENT = object()
+
+class SchemaError(ValueError):
+    """Payload invalide : erreurs par champ (renvoyées en 400 avant tout rendu)"""
+    def __init__(self, errors):
+        super().__init__("Données invalides")
+        self.errors = errors
+
+    def to_dict(self):
+        return {"error": "Données invalides", "champs": self.errors}
+
+# --- Convertisseurs : retournent la valeur normalisée ou lèvent ValueError avec le message ---
+
+def string(max_length=MAX_STRING_LENGTH):
+    def convert(value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(value)
+        if not isinstance(value, str):
+            raise ValueError("doit être une chaîne")
+        if len(value) > max_length:
+            raise ValueError(f"{max_length} caractères maximum")
+        return value
+    return convert
+
+def number(minimum=None, maximum=None):
+    def convert(value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("doit être un nombre")
+        if value != value or value in (float('inf'), float('-inf')):
+            raise ValueError("doit être un nombre fini")
+        if minimum is not None and value < minimum:
+            raise ValueError(f"doit être supérieur ou égal à {minimum}")
+        if maximum is not None and value > maximum:
+            raise ValueError(f"doit être inférieur ou égal à {maximum}")
+        return value
+    return convert
+
+def boolean(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, str)) and str(value).strip().lower() in ('1', 'true', 'yes', 'oui', '0', 'false', 'no', 'non', ''):
+        return str(value).strip().lower() in ('1', 'true', 'yes', 'oui')
+    raise ValueError("doit être un booléen")
+
+def choice(options, lower=False, fallback=ABSENT):
+    def convert(value):
+        if lower and isinstance(value, str):
+            value = value.lower()
+        if value not in options:
+            if fallback is not ABSENT:
+                return fallback
+            raise ValueError(f"valeurs possibles : {', '.join(options)}")
+        return value
+    return convert
+
+def string_list(max_items, max_length=MAX_STRING_LENGTH):
+    item = string(max_length)
+    def convert(value):
+        if not isinstance(value, list):
+            raise ValueError("doit être une liste")
+        if len(value) > max_items:
+            raise ValueError(f"{max_items} lignes maximum")
+        return [item(line) for line in value]
+    return convert
+
+def hex_color(value):
+    """'#1A2b3c' ou '1a2b3c' -> '#1a2b3c'"""
+    if not isinstance(value, str) or not re.fullmatch(r'#?[0-9A-Fa-f]{6}', value.strip()):
+        raise ValueError("couleur hexadécimale attendue (#rrggbb)")
+    return '#' + value.strip().lstrip('#').lower()
+
+def date_fr(value):
+    """Date 'jj/mm/aaaa' vérifiée (calculs d'échéances)"""
+    try:
+        return datetime.strptime(str(value).strip(), '%d/%m/%Y').strftime('%d/%m/%Y')
+    except ValueError:
+        raise ValueError("date attendue (jj/mm/aaaa)")
+
+def known_theme(value):
+    if not isinstance(value, str) or not theme_exists(value):
+        raise ValueError("thème inconnu (voir GET /api/themes)")
+    return value
+
+# --- Compilation ---
+
+class Schema:
+    """Schéma compilé : liste figée de (champ, convertisseur, défaut, obligatoire)"""
+    def __init__(self, fields):
+        self._fields = tuple(fields)
+
+    def validate(self, data, errors=None, prefix=''):
+        """Valider et normaliser en une seule passe ; lève SchemaError si un champ est invalide"""
+        own_errors = errors is None
+        if own_errors:
+            errors = {}
+        if not isinstance(data, dict):
+            errors[prefix.rstrip('.') or 'body'] = "objet JSON attendu"
+            raise SchemaError(errors)
+
+        result = {}
+        for name, convert, default, required in self._fields:
+            value = data.get(name, ABSENT)
+            if value is None and isinstance(convert, Nested):
+                # Une liste d'articles à null est une erreur, pas une liste vide
+                errors[prefix + name] = "doit être une liste"
+                continue
+            if value is ABSENT or value is None:
+                if required:
+                    errors[prefix + name] = "champ obligatoire"
+                elif default is not ABSENT:
+                    result[name] = default() if callable(default) else default
+                continue
+            try:
+                result[name] = convert(value, errors, f'{prefix}{name}') if isinstance(convert, Nested) else convert(value)
+            except ValueError as e:
+                errors[prefix + name] = str(e)
+
+        if own_errors and errors:
+            raise SchemaError(errors)
+        return result
+
+class Nested:
+    """Liste d'objets validés par un sous-schéma (les erreurs sont préfixées par l'index)"""
+    def __init__(self, schema, max_items):
+        self.schema = schema
+        self.max_items = max_items
+
+    def __call__(self, value, errors, path):
+        if not isinstance(value, list):
+            raise ValueError("doit être une liste")
+        if len(value) > self.max_items:
+            raise ValueError(f"{self.max_items} éléments maximum")
+        items = []
+        for index, item in enumerate(value):
+            prefix = f'{path}[{index}].'
+            if not isinstance(item, dict):
+                errors[prefix.rstrip('.')] = "objet JSON attendu"
+                continue
+            items.append(self.schema.validate(item, errors, prefix))
+        return items
+
+def field(name, convert, default=ABSENT, required=False):
+    return (name, convert, default, required)
+
+def _today():
+    return datetime.now().strftime('%d/%m/%Y')
+
+def _in_30_days():
+    return (datetime.now() + timedelta(days=30)).strftime('%d/%m/%Y')
+
+# Article saisi librement (description obligatoire) ou produit du catalogue référencé par son sku :
+# les champs absents viennent alors du produit (voir catalog.resolve_item)
+ITEM_SCHEMA = Schema([
+    field('sku', string(64)),
+    field('description', string()),
+    field('details', string_list(MAX_DETAIL_LINES)),
+    field('quantite', number(), default=1),
+    field('prix_unitaire', number()),
+    field('tva_taux', number(minimum=0, maximum=100)),
+    field('remise', number(minimum=0), default=0),
+])
+
+# Champs fournisseur : absents si non fournis (le profil ou les valeurs par défaut s'appliquent)
+CHAMPS_FOURNISSEUR = [
+    field('fournisseur_nom', string()),
+    field('fournisseur_adresse', string()),
+    field('fournisseur_ville', string()),
+    field('fournisseur_email', string()),
+    field('fournisseur_siret', string()),
+    field('fournisseur_telephone', string()),
+    field('fournisseur_tva', string()),
+    field('logo_url', string(2000)),
+    field('logo_id', string(64)),
+    field('banque_nom', string()),
+    field('banque_iban', string()),
+    field('banque_bic', string()),
+    field('conditions_paiement', string(MAX_TEXT_LENGTH)),
+    field('penalites_retard', string(MAX_TEXT_LENGTH)),
+]
+
+CHAMPS_CLIENT = [
+    field('client_nom', string(), required=True),
+    field('client_adresse', string(), default=''),
+    field('client_ville', string(), default=''),
+    field('client_siret', string(), default=''),
+    field('client_tva', string(), default=''),
+    field('client_telephone', string(), default=''),
+    field('client_email', string(), default=''),
+]
+
+CHAMPS_RENDU = [
+    field('theme', known_theme, default='bleu'),
+    field('format', choice(FORMATS, lower=True), default='pdf'),
+    field('deterministic', boolean, default=False),
+]
+
+DEVIS_SCHEMA = Schema([
+    # Numéro absent : attribué par la séquence une fois la requête validée
+    field('numero', string()),
+    field('date_emission', string(), default=_today),
+    field('date_expiration', string(), default=_in_30_days),
+    field('profile_id', string(64)),
+    *CHAMPS_FOURNISSEUR,
+    *CHAMPS_CLIENT,
+    field('texte_intro', string(MAX_TEXT_LENGTH), default=''),
+    field('texte_conclusion', string(MAX_TEXT_LENGTH),
+          default='Nous restons à votre disposition pour toute information complémentaire.'),
+    field('items', Nested(ITEM_SCHEMA, MAX_ITEMS), default=list),
+    *CHAMPS_RENDU,
+])
+
+FACTURE_SCHEMA = Schema([
+    field('numero', string()),
+    field('date_emission', string(), default=_today),
+    field('date_echeance', string(), default=_in_30_days),
+    field('profile_id', string(64)),
+    *CHAMPS_FOURNISSEUR,
+    *CHAMPS_CLIENT,
+    field('statut_paiement', string(), default='En attente'),
+    field('numero_commande', string(), default=''),
+    field('reference_devis', string(), default=''),
+    field('items', Nested(ITEM_SCHEMA, MAX_ITEMS), default=list),
+    # XML Factur-X joint au PDF (ignoré en DOCX)
+    field('facturx', choice(PROFILS_FACTURX, lower=True)),
+    *CHAMPS_RENDU,
+])
+
+# Conversion d'un devis stocké : seuls les champs propres à la facture
+CONVERSION_SCHEMA = Schema([
+    field('numero', string()),
+    field('date_emission', string(), default=_today),
+    field('date_echeance', string(), default=_in_30_days),
+    field('statut_paiement', string(), default='En attente'),
+    field('numero_commande', string(), default=''),
+    field('conditions_paiement', string(MAX_TEXT_LENGTH)),
+    field('facturx', choice(PROFILS_FACTURX, lower=True)),
+    *CHAMPS_RENDU,
+])
+
+STATUT_SCHEMA = Schema([
+    field('statut_paiement', string(), required=True),
+    # Thème du dernier rendu si absent (comme pour l'assemblage)
+    field('theme', known_theme),
+    field('format', choice(FORMATS, lower=True), default='pdf'),
+    field('deterministic', boolean, default=False),
+])
+
+# Référence à un document déjà rendu (thème du dernier rendu si absent)
+DOCUMENT_REF_SCHEMA = Schema([
+    field('type', choice(TYPES_DOCUMENT, lower=True), default='facture'),
+    field('numero', string(), required=True),
+    field('theme', string()),
+])
+
+MERGE_SCHEMA = Schema([
+    field('documents', Nested(DOCUMENT_REF_SCHEMA, MAX_MERGE_DOCUMENTS), required=True),
+])
+
+# Profilage d'un rendu (le document lui-même est validé par DEVIS_SCHEMA ou FACTURE_SCHEMA)
+PROFILE_SCHEMA = Schema([
+    field('type', choice(TYPES_DOCUMENT, lower=True), default='facture'),
+    field('mode', choice(MODES), default='sample'),
+    field('format', choice(FORMATS_PROFIL), default='speedscope'),
+    field('interval_ms', number(minimum=0.1, maximum=50), default=1.0),
+])
+
+# Thème personnalisé (le nom est vérifié par themes.is_valid_theme_name)
+THEME_SCHEMA = Schema([
+    field('theme', string(32), required=True),
+    field('principale', hex_color, required=True),
+    field('accent', hex_color, required=True),
+    field('secondaire', hex_color),
+    field('fond', hex_color),
+    field('header_bg', hex_color),
+])
+
+# Produit du catalogue (import en masse par POST /api/catalog)
+PRODUIT_SCHEMA = Schema([
+    field('sku', string(64), required=True),
+    field('description', string(), required=True),
+    field('details', string_list(MAX_DETAIL_LINES), default=list),
+    field('prix_unitaire', number(), default=0),
+    field('tva_taux', number(minimum=0, maximum=100), default=20),
+])
+
+CATALOG_SCHEMA = Schema([
+    field('produits', Nested(PRODUIT_SCHEMA, MAX_CATALOG_IMPORT), required=True),
+    # Remplacer tout le catalogue plutôt que compléter / mettre à jour les produits reçus
+    field('remplacer', boolean, default=False),
+])
+
+# Facture récurrente : le modèle `facture` est validé à part par FACTURE_SCHEMA
+RECURRENCE_SCHEMA = Schema([
+    field('recurrence_id', string(64), required=True),
+    field('frequence', choice(FREQUENCES, lower=True), default='mensuelle'),
+    field('debut', date_fr, required=True),
+    field('fin', date_fr),
+    field('delai_paiement', number(minimum=0, maximum=365), default=30),
+    field('active', boolean, default=True),
+])
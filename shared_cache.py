@@ -0,0 +1,233 @@
+# shared_cache.py - Caches d'octets : LRU par processus ou segments projetés en mémoire partagés entre workers
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from metrics import increment, register_gauge
+
+DATA_FOLDER = os.environ.get('DATA_FOLDER', 'data')
+CACHE_FOLDER = os.path.join(DATA_FOLDER, 'cache')
+
+# 'local' : un cache par processus ; 'shared' : un seul cache sur disque lu par tous les workers
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'local')
+BACKENDS = ['local', 'shared']
+
+# Nombre de segments d'un cache partagé : l'éviction retire le plus ancien (1/N de la taille)
+SHARED_CACHE_SEGMENTS = int(os.environ.get('SHARED_CACHE_SEGMENTS', '8'))
+
+# En-tête d'un enregistrement : magique, taille de la clé, taille de la valeur, CRC32 (clé + valeur)
+HEADER = struct.Struct('<4sIQI')
+MAGIC = b'SCv1'
+
+def source_version(*module_names):
+    """Empreinte du code de modules chargés : une clé de cache change avec le code qui produit la valeur"""
+    digest = hashlib.sha256()
+    for name in module_names:
+        with open(sys.modules[name].__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+class LocalCache:
+    """LRU en mémoire, propre au processus, borné en octets (et en entrées si demandé)"""
+    def __init__(self, name, max_bytes, max_entries=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        register_gauge(f'cache_{name}_ko', lambda: round(self._size / 1024, 1))
+        register_gauge(f'cache_{name}_entries', lambda: len(self._entries))
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+        increment(f'cache_{self.name}_misses' if value is None else f'cache_{self.name}_hits')
+        return value
+
+    def put(self, key, value):
+        value = bytes(value)
+        if len(value) > self.max_bytes:
+            return False
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes or (self.max_entries and len(self._entries) > self.max_entries):
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                increment(f'cache_{self.name}_evictions')
+        return True
+
+class SharedCache:
+    """Cache partagé par les workers d'une machine : segments en ajout seul, lus par mmap sans copie
+
+    Chaque enregistrement (en-tête, clé, valeur) est écrit en une fois sous verrou de fichier ;
+    un lecteur ne l'indexe qu'une fois complet (taille et CRC vérifiés) : la publication est
+    atomique. Chaque processus tient son propre index clé -> (segment, position), complété en
+    relisant la fin des segments lors d'un défaut. Les valeurs sont des vues sur les pages du
+    fichier, communes à tous les workers dans le cache de pages du système.
+
+    Au-delà de `max_bytes`, le segment le plus ancien est supprimé : un worker qui le projette
+    encore garde des pages valides (le fichier n'est libéré qu'à la dernière projection).
+    """
+    def __init__(self, name, max_bytes, segments=SHARED_CACHE_SEGMENTS):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.segment_bytes = max(max_bytes // segments, 1024 * 1024)
+        self.folder = os.path.join(CACHE_FOLDER, name)
+        # segment -> (projection, octets indexés) ; segment -> taille du fichier ; segment -> clés
+        self._segments = {}
+        self._sizes = {}
+        self._keys = {}
+        # clé -> (segment, position de la valeur, taille)
+        self._index = {}
+        self._lock = threading.Lock()
+        register_gauge(f'cache_{name}_ko', lambda: round(sum(self._sizes.values()) / 1024, 1))
+        register_gauge(f'cache_{name}_entries', lambda: len(self._index))
+
+    def _segment_path(self, seq):
+        return os.path.join(self.folder, f'{seq:08d}.seg')
+
+    def _drop(self, seq):
+        self._segments.pop(seq, None)
+        self._sizes.pop(seq, None)
+        for key in self._keys.pop(seq, ()):
+            if self._index.get(key, (None,))[0] == seq:
+                del self._index[key]
+
+    def _scan(self, seq):
+        """Indexer les enregistrements complets ajoutés au segment depuis la dernière lecture"""
+        try:
+            with open(self._segment_path(seq), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                mapped, scanned = self._segments.get(seq, (None, 0))
+                self._sizes[seq] = size
+                if size <= scanned:
+                    return
+                # Nouvelle projection couvrant la fin du fichier ; l'ancienne vit tant que des vues l'utilisent
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            self._drop(seq)
+            return
+
+        offset = scanned
+        keys = self._keys.setdefault(seq, [])
+        while offset + HEADER.size <= size:
+            magic, key_size, value_size, crc = HEADER.unpack_from(mapped, offset)
+            start = offset + HEADER.size
+            end = start + key_size + value_size
+            if magic != MAGIC or end > size:
+                break
+            with memoryview(mapped)[start:end] as record:
+                if zlib.crc32(record) != crc:
+                    break
+                key = bytes(record[:key_size])
+            self._index[key] = (seq, start + key_size, value_size)
+            keys.append(key)
+            offset = end
+        self._segments[seq] = (mapped, offset)
+
+    def _refresh(self):
+        """Suivre les segments créés, agrandis ou supprimés par les autres workers"""
+        try:
+            names = os.listdir(self.folder)
+        except FileNotFoundError:
+            names = []
+        live = sorted(int(name[:-4]) for name in names if name.endswith('.seg') and name[:-4].isdigit())
+        for seq in set(self._sizes) - set(live):
+            self._drop(seq)
+        for seq in live:
+            self._scan(seq)
+
+    def __contains__(self, key):
+        key = key.encode('utf-8')
+        with self._lock:
+            if key not in self._index:
+                self._refresh()
+            return key in self._index
+
+    def get(self, key):
+        """Vue en lecture seule sur la valeur (sans copie), ou None"""
+        key = key.encode('utf-8')
+        with self._lock:
+            location = self._index.get(key)
+            if location is None:
+                self._refresh()
+                location = self._index.get(key)
+            if location is not None:
+                seq, offset, size = location
+                mapped = self._segments[seq][0]
+        if location is None:
+            increment(f'cache_{self.name}_misses')
+            return None
+        increment(f'cache_{self.name}_hits')
+        return memoryview(mapped)[offset:offset + size]
+
+    def put(self, key, value):
+        """Publier une valeur ; ignorée si un autre worker l'a déjà publiée"""
+        key = key.encode('utf-8')
+        record_size = HEADER.size + len(key) + len(value)
+        if record_size > self.max_bytes:
+            return False
+        crc = zlib.crc32(value, zlib.crc32(key))
+        record = HEADER.pack(MAGIC, len(key), len(value), crc) + key + bytes(value)
+
+        os.makedirs(self.folder, exist_ok=True)
+        # Verrou ouvert à chaque écriture : un descripteur hérité du maître serait commun aux workers
+        with self._lock, open(os.path.join(self.folder, '.lock'), 'ab') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._refresh()
+            if key in self._index:
+                return False
+
+            active = max(self._sizes, default=0)
+            # Segment plein, ou terminé par un enregistrement incomplet (écriture interrompue) : en ouvrir un autre
+            if not active or (self._sizes[active] and (
+                    self._sizes[active] + record_size > self.segment_bytes
+                    or self._segments.get(active, (None, 0))[1] < self._sizes[active])):
+                active += 1
+                self._sizes[active] = 0
+
+            total = sum(self._sizes.values())
+            for seq in sorted(self._sizes):
+                if seq == active or total + record_size <= self.max_bytes:
+                    break
+                total -= self._sizes[seq]
+                try:
+                    os.remove(self._segment_path(seq))
+                except FileNotFoundError:
+                    pass
+                self._drop(seq)
+                increment(f'cache_{self.name}_evictions')
+
+            fd = os.open(self._segment_path(active), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                view = memoryview(record)
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+            self._scan(active)
+        return True
+
+def make_cache(name, max_mb, max_entries=None, backend=None):
+    """Cache d'octets `name` selon CACHE_BACKEND (le nombre d'entrées ne borne que le cache local)"""
+    backend = backend or CACHE_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"CACHE_BACKEND inconnu : {backend} ({', '.join(BACKENDS)})")
+    if backend == 'shared':
+        return SharedCache(name, max_mb * 1024 * 1024)
+    return LocalCache(name, max_mb * 1024 * 1024, max_entries)
@@ -0,0 +1,171 @@
+# status_stamp.py - Tampon de statut appliqué sur une facture déjà rendue (sans nouveau rendu)
+import math
+import os
+import zipfile
+from functools import lru_cache
+from io import BytesIO
+from lxml import etree
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from themes import theme_colors
+from pdf_tools import PDFFile, make_stream_object, add_page_overlay, incremental_update, pdf_string
+
+# Statut de paiement -> texte du tampon et couleur (None = couleur d'accent du thème)
+TAMPONS = {
+    'Payée': ('PAYÉ', '#27ae60'),
+    'Annulée': ('ANNULÉE', '#e74c3c'),
+    'Brouillon': ('BROUILLON', None),
+}
+
+# Statuts affichés sans tampon (la facture de base reste valable)
+STATUTS_SANS_TAMPON = ['En attente', 'En retard']
+
+STATUTS_DISPONIBLES = list(TAMPONS) + STATUTS_SANS_TAMPON
+
+# Couleurs du statut dans le tableau d'informations DOCX (identiques au rendu complet)
+COULEURS_STATUT_DOCX = {
+    'En retard': 'E74C3C',
+    'Payée': '27AE60',
+}
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+
+# Ordre imposé des enfants de w:rPr (CT_RPr) : Word refuse un élément hors de sa place
+ORDRE_RPR = [
+    'rStyle', 'rFonts', 'b', 'bCs', 'i', 'iCs', 'caps', 'smallCaps', 'strike', 'dstrike', 'outline',
+    'shadow', 'emboss', 'imprint', 'noProof', 'snapToGrid', 'vanish', 'webHidden', 'color', 'spacing',
+    'w', 'kern', 'position', 'sz', 'szCs', 'highlight', 'u', 'effect', 'bdr', 'shd', 'fitText',
+    'vertAlign', 'rtl', 'cs', 'em', 'lang', 'eastAsianLayout', 'specVanish', 'oMath',
+]
+
+@lru_cache(maxsize=64)
+def stamp_objects(statut, theme):
+    """Objets PDF du tampon (police, Form XObject), calculés une fois par statut et par thème"""
+    texte, couleur = TAMPONS[statut]
+    if couleur is None:
+        couleur_rl = colors.HexColor(theme_colors(theme)['accent'])
+    else:
+        couleur_rl = colors.HexColor(couleur)
+    rgb = b'%.3f %.3f %.3f' % (couleur_rl.red, couleur_rl.green, couleur_rl.blue)
+
+    font_size = 48
+    text_width = stringWidth(texte, 'Helvetica-Bold', font_size)
+    width = text_width + 40
+    height = font_size + 30
+
+    # Cadre et texte centrés sur l'origine du formulaire
+    form_ops = b'\n'.join([
+        b'q /GSTampon gs',
+        rgb + b' RG ' + rgb + b' rg 4 w',
+        b'%.2f %.2f %.2f %.2f re S' % (-width / 2, -height / 2, width, height),
+        b'BT /FTampon %d Tf %.2f %.2f Td ' % (font_size, -text_width / 2, -font_size * 0.35)
+        + pdf_string(texte) + b' Tj ET',
+        b'Q',
+    ])
+    bbox = b'[ %.2f %.2f %.2f %.2f ]' % (-width / 2 - 2, -height / 2 - 2, width / 2 + 2, height / 2 + 2)
+    font = b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>'
+    form_entries = (b'/Type /XObject /Subtype /Form /BBox ' + bbox
+                    + b' /Resources << /Font << /FTampon {font} >> /ExtGState << /GSTampon << /CA 0.7 /ca 0.7 >> >> >>')
+
+    # Placement : centre de la page, rotation de 30 degrés
+    angle = math.radians(30)
+    cos_a, sin_a = math.cos(angle), math.sin(angle)
+    page_ops = b'q %.4f %.4f %.4f %.4f %.2f %.2f cm /Tampon Do Q' % (
+        cos_a, sin_a, -sin_a, cos_a, A4[0] / 2, A4[1] / 2)
+    return font, form_entries, form_ops, page_ops
+
+def stamp_pdf(base_path, output_path, statut, theme='bleu'):
+    """Appliquer le tampon sur la première page via une mise à jour incrémentale du PDF"""
+    with open(base_path, 'rb') as f:
+        pdf = PDFFile(f.read())
+
+    font, form_entries, form_ops, page_ops = stamp_objects(statut, theme)
+    font_num = pdf.size
+    form_num = font_num + 1
+    content_num = font_num + 2
+    form_entries = form_entries.replace(b'{font}', str(font_num).encode() + b' 0 R')
+
+    first_page = pdf.pages()[0]
+    page_dict = add_page_overlay(pdf.dictionary(first_page), b'Tampon', form_num, content_num)
+
+    data = incremental_update(
+        pdf,
+        {first_page: page_dict},
+        [font, make_stream_object(form_entries, form_ops), make_stream_object(b'', page_ops)]
+    )
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    return output_path
+
+def _cell_text(cell):
+    return ''.join(cell.itertext()).strip()
+
+def _insert_run_property(run_props, element):
+    """Insérer un enfant de w:rPr à sa place dans l'ordre du schéma"""
+    rank = ORDRE_RPR.index(etree.QName(element).localname)
+    for index, child in enumerate(run_props):
+        name = etree.QName(child).localname
+        if name in ORDRE_RPR and ORDRE_RPR.index(name) > rank:
+            run_props.insert(index, element)
+            return element
+    run_props.append(element)
+    return element
+
+def stamp_docx(base_path, output_path, statut, theme='bleu'):
+    """Remplacer le statut directement dans word/document.xml, sans reconstruire le document"""
+    with zipfile.ZipFile(base_path) as source:
+        tree = etree.fromstring(source.read('word/document.xml'))
+        w = '{%s}' % W_NS
+
+        patched = False
+        for row in tree.iter(w + 'tr'):
+            cells = row.findall(w + 'tc')
+            if len(cells) == 2 and _cell_text(cells[0]) == 'Statut:':
+                run = cells[1].find('.//' + w + 'r')
+                text = run.find(w + 't')
+                text.text = statut
+                run_props = run.find(w + 'rPr')
+                if run_props is None:
+                    run_props = etree.SubElement(run, w + 'rPr')
+                    run.insert(0, run_props)
+                color = run_props.find(w + 'color')
+                if color is None:
+                    color = _insert_run_property(run_props, etree.Element(w + 'color'))
+                principale = theme_colors(theme)['principale'][1:].upper()
+                color.set(w + 'val', COULEURS_STATUT_DOCX.get(statut, principale))
+                patched = True
+                break
+        if not patched:
+            raise ValueError("Statut introuvable dans le document DOCX")
+
+        document_xml = etree.tostring(tree, xml_declaration=True, encoding='UTF-8', standalone=True)
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as target:
+            for info in source.infolist():
+                data = document_xml if info.filename == 'word/document.xml' else source.read(info)
+                target.writestr(info, data)
+
+    with open(output_path, 'wb') as f:
+        f.write(buffer.getvalue())
+    return output_path
+
+def apply_status(numero, statut, theme='bleu', output_format='pdf', folder='generated'):
+    """Produire la version de la facture avec le nouveau statut à partir du rendu stocké"""
+    base_path = os.path.join(folder, f'facture_{numero}_{theme}.{output_format}')
+    if not os.path.exists(base_path):
+        raise FileNotFoundError(base_path)
+
+    if output_format == 'docx':
+        output_path = os.path.join(folder, f'facture_{numero}_{theme}_statut.docx')
+        return stamp_docx(base_path, output_path, statut, theme)
+
+    output_path = os.path.join(folder, f'facture_{numero}_{theme}_statut.pdf')
+    if statut in STATUTS_SANS_TAMPON:
+        # Un tampon d'un statut précédent ne doit plus être servi (fusion, téléchargement)
+        try:
+            os.remove(output_path)
+        except FileNotFoundError:
+            pass
+        return base_path
+    return stamp_pdf(base_path, output_path, statut, theme)
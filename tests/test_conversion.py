@@ -0,0 +1,38 @@
+# test_conversion.py - Facture créée depuis un devis stocké : champs repris, profil fournisseur compris
+import pytest
+import profiles
+from app import CONSTRUCTEURS, GENERATEURS, SCHEMAS
+from models import facture_from_devis
+from profiles import block_cache_key, save_profile
+
+@pytest.fixture(autouse=True)
+def working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(profiles, 'PROFILES_FOLDER', str(tmp_path / 'profiles'))
+    (tmp_path / 'generated').mkdir()
+
+@pytest.fixture
+def devis():
+    save_profile('acme', {'fournisseur_nom': 'ACME SARL', 'fournisseur_ville': '75001 Paris',
+                          'banque_iban': 'FR7630006000011234567890189'})
+    payload = SCHEMAS['devis'].validate({
+        'numero': 'D-TEST-1', 'client_nom': 'Client Test', 'date_emission': '01/03/2026',
+        'date_expiration': '31/03/2026', 'profile_id': 'acme',
+        'items': [{'description': 'Développement', 'quantite': 3, 'prix_unitaire': 450, 'tva_taux': 20}],
+    })
+    return CONSTRUCTEURS['devis'](payload)
+
+def test_facture_keeps_devis_profile(devis):
+    facture = facture_from_devis(devis, 'F-TEST-1', '01/04/2026', '30/04/2026')
+    assert devis.profile_version
+    assert (facture.profile_id, facture.profile_version) == ('acme', devis.profile_version)
+    assert facture.fournisseur_nom == 'ACME SARL'
+    # Même clé que le devis : les blocs statiques pré-rendus du profil sont réutilisés
+    assert block_cache_key(facture, 'bleu', 'header') == block_cache_key(devis, 'bleu', 'header')
+
+def test_converted_facture_renders(devis):
+    facture = facture_from_devis(devis, 'F-TEST-1', '01/04/2026', '30/04/2026')
+    for output_format in ('pdf', 'docx'):
+        filename = GENERATEURS[('facture', output_format)](facture, theme='bleu')
+        with open(filename, 'rb') as f:
+            assert f.read(4) in (b'%PDF', b'PK\x03\x04')
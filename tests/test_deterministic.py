@@ -0,0 +1,65 @@
+# test_deterministic.py - Mode déterministe : deux rendus des mêmes données donnent les mêmes octets
+import os
+import subprocess
+import sys
+import time
+import pytest
+from app import CONSTRUCTEURS, GENERATEURS, SCHEMAS
+from themes import THEMES_INTEGRES
+
+ARTICLES = [
+    {'description': 'Développement', 'details': ['Module de facturation', 'Tests'],
+     'quantite': 3, 'prix_unitaire': 450, 'tva_taux': 20, 'remise': 50},
+    {'description': 'Hébergement', 'quantite': 12, 'prix_unitaire': 9.9, 'tva_taux': 5.5},
+]
+
+PAYLOADS = {
+    'devis': {'numero': 'D-TEST-1', 'client_nom': 'Client Test', 'date_emission': '01/03/2026',
+              'date_expiration': '31/03/2026', 'items': ARTICLES},
+    'facture': {'numero': 'F-TEST-1', 'client_nom': 'Client Test', 'date_emission': '01/03/2026',
+                'date_echeance': '31/03/2026', 'items': ARTICLES},
+}
+
+CAS = [(kind, output_format, theme)
+       for kind in ('devis', 'facture') for output_format in ('pdf', 'docx') for theme in THEMES_INTEGRES]
+
+def render(kind, output_format, theme):
+    payload = SCHEMAS[kind].validate(dict(PAYLOADS[kind], theme=theme, format=output_format))
+    document = CONSTRUCTEURS[kind](payload)
+    filename = GENERATEURS[(kind, output_format)](document, theme=theme, deterministic=True)
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def render_all(folder):
+    """Rendre tous les cas dans `folder` (exécuté dans un autre processus)"""
+    os.chdir(folder)
+    os.makedirs('generated', exist_ok=True)
+    for kind, output_format, theme in CAS:
+        with open(f'{kind}_{theme}.{output_format}', 'wb') as f:
+            f.write(render(kind, output_format, theme))
+
+@pytest.fixture(scope='module')
+def other_process(tmp_path_factory):
+    """Rendus d'un autre processus (autre graine de hachage, autres identifiants aléatoires)
+
+    Au moins deux secondes avant les rendus du test : la résolution des dates d'un zip.
+    """
+    folder = tmp_path_factory.mktemp('autre_processus')
+    tests_folder = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run([sys.executable, '-c', f'import test_deterministic; test_deterministic.render_all({str(folder)!r})'],
+                   cwd=tests_folder, check=True, capture_output=True,
+                   env=dict(os.environ, PYTHONPATH=os.pathsep.join([tests_folder, os.path.dirname(tests_folder)])))
+    time.sleep(2)
+    return folder
+
+@pytest.fixture(autouse=True)
+def working_directory(tmp_path, monkeypatch):
+    """Rendus et données dans un dossier temporaire (les générateurs écrivent dans ./generated)"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'generated').mkdir()
+
+@pytest.mark.parametrize('kind,output_format,theme', CAS)
+def test_render_twice_gives_same_bytes(kind, output_format, theme, other_process):
+    first = render(kind, output_format, theme)
+    assert render(kind, output_format, theme) == first
+    assert (other_process / f'{kind}_{theme}.{output_format}').read_bytes() == first
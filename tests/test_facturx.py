@@ -0,0 +1,80 @@
+# test_facturx.py - XML Factur-X des trois profils : bien formé, vendeur complet, XSD officiels si disponibles
+import re
+import pytest
+from docx import Document
+from lxml import etree
+from app import CONSTRUCTEURS, GENERATEURS, SCHEMAS
+from facturx import FACTURX_XSD_DIR, _schema_path, facturx_xml, validate_xml
+from schema import PROFILS_FACTURX
+
+RAM = '{urn:un:unece:uncefact:data:standard:ReusableAggregateBusinessInformationEntity:100}'
+
+@pytest.fixture(autouse=True)
+def working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'generated').mkdir()
+
+def build(items):
+    payload = SCHEMAS['facture'].validate({
+        'numero': 'F-TEST-1', 'client_nom': 'Client Test', 'client_ville': '69001 Lyon',
+        'client_tva': 'FR40303265045', 'date_emission': '01/03/2026', 'date_echeance': '31/03/2026',
+        'items': items,
+    })
+    return CONSTRUCTEURS['facture'](payload)
+
+@pytest.fixture
+def facture():
+    return build([
+        {'description': 'Développement', 'quantite': 3, 'prix_unitaire': 450, 'tva_taux': 20, 'remise': 50},
+        {'description': 'Hébergement', 'quantite': 12, 'prix_unitaire': 9.9, 'tva_taux': 5.5},
+    ])
+
+@pytest.mark.parametrize('profile', PROFILS_FACTURX)
+def test_xml_well_formed_with_seller_vat_id(facture, profile):
+    xml = facturx_xml(facture, profile)
+    assert validate_xml(xml, profile, xsd_dir='') == []
+    seller = etree.fromstring(xml).find(f'.//{RAM}SellerTradeParty')
+    # BT-31 : requis par BR-S-02 dès qu'une ligne est à la TVA standard
+    assert seller.findtext(f'{RAM}SpecifiedTaxRegistration/{RAM}ID') == facture.fournisseur_tva
+    assert seller.findtext(f'{RAM}PostalTradeAddress/{RAM}CountryID') == 'FR'
+    if profile != 'minimum':
+        assert seller.findtext(f'{RAM}PostalTradeAddress/{RAM}PostcodeCode') == '75012'
+        assert seller.findtext(f'{RAM}PostalTradeAddress/{RAM}CityName') == 'Paris'
+
+@pytest.mark.parametrize('profile', PROFILS_FACTURX)
+def test_xml_valid_against_official_xsd(facture, profile):
+    # XSD officiels non livrés avec le dépôt : FACTURX_XSD_DIR désigne le dossier où ils sont extraits
+    if not FACTURX_XSD_DIR:
+        pytest.skip("FACTURX_XSD_DIR non renseigné")
+    try:
+        _schema_path(profile, FACTURX_XSD_DIR)
+    except FileNotFoundError as e:
+        pytest.skip(str(e))
+    assert validate_xml(facturx_xml(facture, profile), profile, FACTURX_XSD_DIR) == []
+
+def test_printed_ttc_matches_grand_total():
+    # Sommes flottantes non arrondies : 164.79 imprimé contre 164.80 dans l'XML
+    facture = build([
+        {'description': 'Audit', 'quantite': 5, 'prix_unitaire': 16.88, 'tva_taux': 10},
+        {'description': 'Formation', 'quantite': 4, 'prix_unitaire': 14.79, 'tva_taux': 10},
+        {'description': 'Livre', 'quantite': 1, 'prix_unitaire': 6.52, 'tva_taux': 5.5},
+    ])
+    grand_total = etree.fromstring(facturx_xml(facture, 'en16931')).findtext(f'.//{RAM}GrandTotalAmount')
+    assert grand_total == '164.80'
+
+    docx_path = GENERATEURS[('facture', 'docx')](facture, deterministic=True)
+    cells = [cell.text for table in Document(docx_path).tables for row in table.rows for cell in row.cells]
+    assert cells[cells.index('TOTAL TTC') + 1] == f'{grand_total} €'
+
+    pypdf = pytest.importorskip('pypdf')
+    pdf_path = GENERATEURS[('facture', 'pdf')](facture, deterministic=True)
+    text = ''.join(page.extract_text() for page in pypdf.PdfReader(pdf_path).pages)
+    assert re.search(r'Total TTC\s*' + re.escape(grand_total) + ' €', text)
+
+def test_pdf_embeds_xml_without_pdfa_claim(facture):
+    # Polices non incorporées, pas d'OutputIntent : aucune conformité PDF/A-3 ne doit être déclarée
+    pdf_path = GENERATEURS[('facture', 'pdf')](facture, deterministic=True, facturx='en16931')
+    with open(pdf_path, 'rb') as f:
+        data = f.read()
+    assert b'factur-x.xml' in data
+    assert b'pdfaid' not in data and b'/Metadata' not in data
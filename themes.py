@@ -0,0 +1,128 @@
+# themes.py - Thèmes de couleurs (intégrés et enregistrés par API) et cache des thèmes compilés
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+DATA_FOLDER = os.environ.get('DATA_FOLDER', 'data')
+THEMES_FOLDER = os.path.join(DATA_FOLDER, 'themes')
+
+# Nombre de thèmes compilés gardés en mémoire (les moins récemment utilisés sont recompilés)
+THEME_CACHE_SIZE = int(os.environ.get('THEME_CACHE_SIZE', '64'))
+
+THEME_PAR_DEFAUT = 'bleu'
+
+# Couleurs d'un thème : principale, secondaire, accent, fond, header_bg ('#rrggbb')
+THEMES_INTEGRES = {
+    'bleu': {'principale': '#2c3e50', 'secondaire': '#34495e', 'accent': '#3498db',
+             'fond': '#ecf0f1', 'header_bg': '#2d3436'},
+    'vert': {'principale': '#27ae60', 'secondaire': '#2d5016', 'accent': '#58d68d',
+             'fond': '#e8f8f5', 'header_bg': '#1e8449'},
+    'rouge': {'principale': '#e74c3c', 'secondaire': '#922b21', 'accent': '#f1948a',
+              'fond': '#fadbd8', 'header_bg': '#c0392b'},
+    'violet': {'principale': '#9b59b6', 'secondaire': '#6c3483', 'accent': '#d7bde2',
+               'fond': '#f4ecf7', 'header_bg': '#8e44ad'},
+    'orange': {'principale': '#e67e22', 'secondaire': '#a04000', 'accent': '#f5b041',
+               'fond': '#fdeaa7', 'header_bg': '#d35400'},
+    'noir': {'principale': '#2c3e50', 'secondaire': '#34495e', 'accent': '#95a5a6',
+             'fond': '#ecf0f1', 'header_bg': '#2c3e50'},
+}
+
+# Compilateurs déclarés par les générateurs : cible ('pdf', 'docx') -> fonction(couleurs hex)
+_compilers = {}
+
+# Thèmes compilés : nom -> {cible: objets prêts à l'emploi}
+_compiled = OrderedDict()
+_lock = threading.Lock()
+
+def register_theme_compiler(target, compile_theme):
+    """Déclarer la compilation d'un thème pour un format de sortie"""
+    _compilers[target] = compile_theme
+    return compile_theme
+
+def is_valid_theme_name(name):
+    return bool(re.fullmatch(r'[a-z0-9_-]{1,32}', str(name)))
+
+def _theme_path(name):
+    return os.path.join(THEMES_FOLDER, f'{name}.json')
+
+def _load_colors(name):
+    if name in THEMES_INTEGRES:
+        return THEMES_INTEGRES[name]
+    if not is_valid_theme_name(name):
+        return None
+    try:
+        with open(_theme_path(name), encoding='utf-8') as f:
+            return json.load(f)['couleurs']
+    except FileNotFoundError:
+        return None
+
+def theme_colors(name):
+    """Couleurs hexadécimales ('#rrggbb') d'un thème intégré ou enregistré"""
+    hex_colors = _load_colors(name)
+    if hex_colors is None:
+        raise LookupError(f"Thème {name} introuvable")
+    return hex_colors
+
+def theme_exists(name):
+    """Thème connu : intégré, déjà compilé, ou enregistré par un autre worker"""
+    return name in _compiled or name in THEMES_INTEGRES or (
+        is_valid_theme_name(name) and os.path.exists(_theme_path(name)))
+
+def list_themes():
+    """Noms des thèmes intégrés puis des thèmes enregistrés"""
+    try:
+        custom = sorted(filename[:-5] for filename in os.listdir(THEMES_FOLDER) if filename.endswith('.json'))
+    except FileNotFoundError:
+        custom = []
+    return list(THEMES_INTEGRES) + custom
+
+def compiled_theme(name):
+    """Thème compilé pour tous les formats ; une simple lecture de dictionnaire hors premier usage"""
+    compiled = _compiled.get(name)
+    if compiled is not None:
+        return compiled
+
+    hex_colors = theme_colors(name)
+    compiled = {target: compile_theme(hex_colors) for target, compile_theme in _compilers.items()}
+    with _lock:
+        _compiled[name] = compiled
+        _compiled.move_to_end(name)
+        while len(_compiled) > THEME_CACHE_SIZE:
+            _compiled.popitem(last=False)
+    return compiled
+
+def save_theme(name, data):
+    """Enregistrer un thème ; un thème existant n'est pas modifiable (les rendus portent son nom)
+
+    Seules `principale` et `accent` sont obligatoires, les autres couleurs en dérivent.
+    """
+    hex_colors = {
+        'principale': data['principale'],
+        'secondaire': data.get('secondaire') or data['principale'],
+        'accent': data['accent'],
+        'fond': data.get('fond') or '#ffffff',
+        'header_bg': data.get('header_bg') or data['principale'],
+    }
+    existing = _load_colors(name)
+    if existing is not None:
+        if existing != hex_colors:
+            raise ValueError(f"Le thème {name} existe déjà avec d'autres couleurs")
+        return {'theme': name, 'couleurs': existing}
+
+    theme = {'theme': name, 'couleurs': hex_colors}
+    os.makedirs(THEMES_FOLDER, exist_ok=True)
+    path = _theme_path(name)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(theme, f, ensure_ascii=False)
+    try:
+        # Création exclusive : deux workers qui enregistrent le même nom ne s'écrasent pas
+        os.link(tmp_path, path)
+    except FileExistsError:
+        return save_theme(name, data)
+    finally:
+        os.remove(tmp_path)
+    compiled_theme(name)
+    return theme